@@ -1,8 +1,24 @@
-"""Steam + OpenDota API Interaction."""
+"""
+Steam + OpenDota API Interaction.
+
+The sync helpers import requests when first called, so the async code
+paths never pay for it. The async ones only wait as long as the command
+they serve has left (see deadlines.py), and fail right away with
+CircuitOpenError while their service is down (see circuit_breaker.py).
+
+OpenDota's responses are projected onto slim records with only the fields
+TangyBot reads (see project_account_info, project_account_heroes and
+project_account_matches) as soon as they are parsed, so caches, snapshots
+and responses never carry the rest of the payload around.
+"""
+import collections
 from urllib.error import HTTPError
 
 import aiohttp
-import requests
+
+import deadlines
+from circuit_breaker import CircuitBreaker
+from metrics import UPSTREAM_LATENCY
 
 # Magic number (from steam) :O
 INDIVIDUAL_CONSTANT = 0x0110000100000000
@@ -10,6 +26,28 @@ INDIVIDUAL_CONSTANT = 0x0110000100000000
 # Conversion factor between steam32 ID and account number
 CONVERSION_FACTOR = 76561197960265728
 
+# OpenDota players endpoint, the account ID is appended to it
+OPENDOTA_PLAYERS_API = "https://api.opendota.com/api/players/"
+
+# CSL team pages, the team number is appended to it
+CSL_TEAMS_URL = "https://cstarleague.com/dota2/teams/"
+
+# Circuit breaker of each upstream service
+BREAKERS = dict(csl=CircuitBreaker("csl"),
+                opendota=CircuitBreaker("opendota"))
+
+# A player's record with one hero, of OpenDota's /players/{id}/heroes
+HeroRecord = collections.namedtuple("HeroRecord", "hero_id games win")
+
+# A player's recent match, of OpenDota's /players/{id}/matches
+MatchRecord = collections.namedtuple("MatchRecord",
+                                     "match_id start_time radiant win "
+                                     "hero_id")
+
+# Fields of /players/{id}/matches that project_account_matches reads
+MATCH_FIELDS = ("match_id", "start_time", "player_slot", "radiant_win",
+                "hero_id")
+
 
 def convert_text_to_32id(steam_id):
     """Convert steam ID text to steam 32 ID."""
@@ -26,6 +64,78 @@ def convert_32id_to_account(steam_id):
     return steam_id + CONVERSION_FACTOR
 
 
+def project_account_info(player_resp):
+    """
+    Keep the fields TangyBot uses of a /players/{id} response.
+
+    Parameters
+    ----------
+    player_resp: dict
+        The response as OpenDota sends it
+
+    Returns
+    -------
+    account_info: dict
+        personaname, rank_tier, leaderboard_rank, solo_competitive_rank and
+        mmr_estimate (the estimate itself), each None if OpenDota has none
+
+    """
+    profile = player_resp.get('profile') or {}
+    mmr_estimate = player_resp.get('mmr_estimate') or {}
+    return dict(personaname=profile.get('personaname'),
+                rank_tier=player_resp.get('rank_tier'),
+                leaderboard_rank=player_resp.get('leaderboard_rank'),
+                solo_competitive_rank=player_resp.get(
+                    'solo_competitive_rank'),
+                mmr_estimate=mmr_estimate.get('estimate'))
+
+
+def project_account_heroes(heroes_resp):
+    """
+    Keep the fields TangyBot uses of a /players/{id}/heroes response.
+
+    Parameters
+    ----------
+    heroes_resp: list of dicts
+        The response as OpenDota sends it
+
+    Returns
+    -------
+    played_heroes: list of HeroRecord
+        hero_id (an int, OpenDota sends a str), games and win per hero, in
+        OpenDota's order
+
+    """
+    return [HeroRecord(int(hero['hero_id']), hero['games'], hero['win'])
+            for hero in heroes_resp]
+
+
+def project_account_matches(matches_resp):
+    """
+    Keep the fields TangyBot uses of a /players/{id}/matches response.
+
+    Parameters
+    ----------
+    matches_resp: list of dicts
+        The response as OpenDota sends it
+
+    Returns
+    -------
+    matches: list of MatchRecord
+        match_id, start_time, radiant (whether the player was on the
+        Radiant), win (whether the player won) and hero_id per match, in
+        OpenDota's order, newest first
+
+    """
+    matches = []
+    for match in matches_resp:
+        radiant = match['player_slot'] < 128
+        matches.append(MatchRecord(match['match_id'], match['start_time'],
+                                   radiant, radiant == match['radiant_win'],
+                                   match['hero_id']))
+    return matches
+
+
 def get_account_info_sync(id_32):
     """
     Get account details synchronously with requests.
@@ -37,17 +147,19 @@ def get_account_info_sync(id_32):
 
     Returns
     -------
-    player_resp: dict
-        Dict containing player information
+    account_info: dict
+        Player information, see project_account_info
 
     """
-    api = "https://api.opendota.com/api/players/" + str(id_32)
+    import requests
+
+    api = OPENDOTA_PLAYERS_API + str(id_32)
     req = requests.get(api)
     if req.status_code != 200:
         raise HTTPError(url=api, code=req.status_code, hdrs=[], fp=None,
                         msg="bad call to api in get_account_info_sync")
     else:
-        return req.json()
+        return project_account_info(req.json())
 
 
 async def get_account_info_async(session, id_32):
@@ -64,17 +176,22 @@ async def get_account_info_async(session, id_32):
 
     Returns
     -------
-    player_resp: dict
-        Dict containing player information
+    account_info: dict
+        Player information, see project_account_info
 
     """
-    api = "https://api.opendota.com/api/players/" + str(id_32)
-    async with session.get(api) as req:
-        if req.status != 200:
-            raise HTTPError(url=api, code=req.status, hdrs=[], fp=None,
-                            msg="bad call to api in get_account_info_async")
-        else:
-            return await req.json()
+    api = OPENDOTA_PLAYERS_API + str(id_32)
+    with BREAKERS['opendota'].guard(), \
+            UPSTREAM_LATENCY.time(upstream="opendota_info",
+                                  status="error") as timer:
+        async with session.get(api, **deadlines.timeout_kwargs()) as req:
+            timer['status'] = req.status
+            if req.status != 200:
+                raise HTTPError(url=api, code=req.status, hdrs=[], fp=None,
+                                msg="bad call to api in "
+                                    "get_account_info_async")
+            else:
+                return project_account_info(await req.json())
 
 
 def get_account_heroes_sync(id_32, matches_limit=100, lobby_only=False):
@@ -84,10 +201,6 @@ def get_account_heroes_sync(id_32, matches_limit=100, lobby_only=False):
     For more information about the API endpoint used here, see the docs at:
     https://docs.opendota.com/#tag/players%2Fpaths%2F~1players~1%7Baccount_id%7D~1heroes%2Fget
 
-    Additionally, we add the following key-value pairs to the dictionary:
-        loc_name, containing the hero's English name
-        winrate, containing the player's winrate with the hero
-
     Parameters
     ----------
     id_32: int
@@ -101,11 +214,14 @@ def get_account_heroes_sync(id_32, matches_limit=100, lobby_only=False):
 
     Returns
     -------
-    played_heroes: list of dicts
-        The list of num_heroes heroes that the player has played the most.
+    played_heroes: list of HeroRecord
+        Every hero with the player's games and wins on it, see
+        project_account_heroes
 
     """
-    api = "https://api.opendota.com/api/players/" + str(id_32) + "/heroes"
+    import requests
+
+    api = OPENDOTA_PLAYERS_API + str(id_32) + "/heroes"
     api_params = dict(limit=matches_limit)
     if lobby_only:
         api_params['lobby_type'] = 1
@@ -114,7 +230,7 @@ def get_account_heroes_sync(id_32, matches_limit=100, lobby_only=False):
         raise HTTPError(url=api, code=req.status_code, hdrs=[], fp=None,
                         msg="bad call to api in get_account_heroes_sync")
     else:
-        return req.json()
+        return project_account_heroes(req.json())
 
 
 async def get_account_heroes_async(session: aiohttp.ClientSession, id_32,
@@ -125,10 +241,6 @@ async def get_account_heroes_async(session: aiohttp.ClientSession, id_32,
     For more information about the API endpoint used here, see the docs at:
     https://docs.opendota.com/#tag/players%2Fpaths%2F~1players~1%7Baccount_id%7D~1heroes%2Fget
 
-    Additionally, we add the following key-value pairs to the dictionary:
-        loc_name, containing the hero's English name
-        winrate, containing the player's winrate with the hero
-
     Parameters
     ----------
     session: aiohttp.ClientSession
@@ -145,20 +257,117 @@ async def get_account_heroes_async(session: aiohttp.ClientSession, id_32,
 
     Returns
     -------
-    played_heroes: list of dicts
-        The list of num_heroes heroes that the player has played the most.
+    played_heroes: list of HeroRecord
+        Every hero with the player's games and wins on it, see
+        project_account_heroes
 
     """
-    api = "https://api.opendota.com/api/players/" + str(id_32) + "/heroes"
+    api = OPENDOTA_PLAYERS_API + str(id_32) + "/heroes"
     api_params = dict(limit=matches_limit)
     if lobby_only:
         api_params['lobby_type'] = 1
-    async with session.get(api, params=api_params) as req:
-        if req.status != 200:
-            raise HTTPError(url=api, code=req.status, hdrs=[], fp=None,
-                            msg="bad call to api in get_account_heroes_async")
-        else:
-            return await req.json()
+    with BREAKERS['opendota'].guard(), \
+            UPSTREAM_LATENCY.time(upstream="opendota_heroes",
+                                  status="error") as timer:
+        async with session.get(api, params=api_params,
+                               **deadlines.timeout_kwargs()) as req:
+            timer['status'] = req.status
+            if req.status != 200:
+                raise HTTPError(url=api, code=req.status, hdrs=[], fp=None,
+                                msg="bad call to api in "
+                                    "get_account_heroes_async")
+            else:
+                return project_account_heroes(await req.json())
+
+
+async def get_account_matches_async(session, id_32, matches_limit=100,
+                                    days=None, lobby_only=False):
+    """
+    Get the recent matches of this player asynchronously with aiohttp.
+
+    For more information about the API endpoint used here, see the docs at:
+    https://docs.opendota.com/#tag/players%2Fpaths%2F~1players~1%7Baccount_id%7D~1matches%2Fget
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        Client session to manage outgoing requests
+
+    id_32: int
+        The Steam32 ID of a player
+
+    matches_limit: int (default 100)
+        The maximum number of recent matches to get.
+
+    days: int or None
+        Only get matches of the last days, None for any age
+
+    lobby_only: bool (default False)
+        Limit match results to lobby matches only?
+
+    Returns
+    -------
+    matches: list of MatchRecord
+        The player's matches, newest first, see project_account_matches
+
+    """
+    api = OPENDOTA_PLAYERS_API + str(id_32) + "/matches"
+    # Only ask for the fields we keep, the rest is most of the payload
+    api_params = [('limit', matches_limit)] + [('project', field)
+                                               for field in MATCH_FIELDS]
+    if days is not None:
+        api_params.append(('date', days))
+    if lobby_only:
+        api_params.append(('lobby_type', 1))
+    with BREAKERS['opendota'].guard(), \
+            UPSTREAM_LATENCY.time(upstream="opendota_matches",
+                                  status="error") as timer:
+        async with session.get(api, params=api_params,
+                               **deadlines.timeout_kwargs()) as req:
+            timer['status'] = req.status
+            if req.status != 200:
+                raise HTTPError(url=api, code=req.status, hdrs=[], fp=None,
+                                msg="bad call to api in "
+                                    "get_account_matches_async")
+            else:
+                return project_account_matches(await req.json())
+
+
+async def get_team_page_async(session, team_id):
+    """
+    Get a CSL team page asynchronously with aiohttp.
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        Client session to manage outgoing requests
+
+    team_id: int
+        The CSL team number
+
+    Returns
+    -------
+    content: str
+        The team page's html
+
+    """
+    url = CSL_TEAMS_URL + str(team_id)
+    print("Looking up URL " + url)
+    # Pepega
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) '
+                      'AppleWebKit/537.36 (KHTML, like Gecko) '
+                      'Chrome/39.0.2171.95 Safari/537.36'
+    }
+    with BREAKERS['csl'].guard(), \
+            UPSTREAM_LATENCY.time(upstream="csl", status="error") as timer:
+        async with session.get(url, headers=headers,
+                               **deadlines.timeout_kwargs()) as req:
+            timer['status'] = req.status
+            if req.status != 200:
+                raise HTTPError(url=url, code=req.status, hdrs=[], fp=None,
+                                msg="bad call to CSL in get_team_page_async")
+            return await req.text()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,30 @@
 """Main TangyBot backend logic."""
 
 import asyncio
+import concurrent.futures
+import contextlib
+import os
+import time
+from urllib.error import HTTPError
 
-import boto3
-from bs4 import BeautifulSoup
+import aiohttp
 
+import deadlines
 import hero_data
-import util
-from api_dispatch import *
+import snapshot
+import storage
+from api_dispatch import (convert_text_to_32id, get_account_heroes_async,
+                          get_account_info_async, get_account_matches_async,
+                          get_team_page_async)
+from cache import TTLCache
+from circuit_breaker import CircuitOpenError, is_outage
+from league_stats import LEAGUE_WINDOW, LeagueStats
+from metrics import (COMMAND_LATENCY, PERSIST_WRITE_LATENCY,
+                     UPSTREAM_LATENCY, cache_hit_ratios)
+from profiling import CommandProfiler
+from refresh import Refresher
+from shared_cache import SharedCache
+from stacks import MatchHistory, find_stacks, hero_records
 
 
 def extract_id_user(players):
@@ -42,13 +59,146 @@ def extract_team_id(team_banner_div):
     return team_banner_div
 
 
+def _timed_call(func, *args, **kwargs):
+    """Call func, returning how many seconds it took."""
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def parse_roster(content):
+    """Parse the team name and player dict out of a CSL team page."""
+    # bs4 and lxml take a while to import, only do it when we scrape
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, 'lxml')
+
+    team_name_div = soup.findAll("div", {"class": "hero-title"})
+    team_name = extract_team_id(team_name_div)
+
+    players = soup.findAll("span", {"class": "tool-tip"})
+
+    # Maps steam 32 id to names
+    return team_name, extract_id_user(players)
+
+
+def aggregate_hero_pool(records_by_player):
+    """
+    Combine the hero records of a team's players in a single pass.
+
+    Parameters
+    ----------
+    records_by_player: dict
+        Player -> list of HeroRecord (see api_dispatch.project_account_heroes)
+
+    Returns
+    -------
+    player_games: dict
+        Player -> games played in total
+
+    heroes: dict
+        Hero ID -> [games, wins, players], combined over the players, where
+        players lists those with at least one game on the hero
+
+    """
+    player_games = {}
+    heroes = {}
+    for player, records in records_by_player.items():
+        total = 0
+        for hero_id, games, win in records:
+            if not games:
+                continue
+            total += games
+            entry = heroes.get(hero_id)
+            if entry is None:
+                heroes[hero_id] = [games, win, [player]]
+            else:
+                entry[0] += games
+                entry[1] += win
+                entry[2].append(player)
+        player_games[player] = total
+    return player_games, heroes
+
+
+def rank_position(rank_tier):
+    """Position of a rank tier on a linear scale, 0 for Herald 1."""
+    badge, stars = divmod(rank_tier, 10)
+    # Immortal has no stars
+    return 5 * (badge - 1) + (max(stars, 1) - 1 if badge < 8 else 0)
+
+
+def mean_rank_tier(rank_tiers):
+    """Rank tier of the average of rank_tiers, None if there are none."""
+    if not rank_tiers:
+        return None
+    mean = round(sum(map(rank_position, rank_tiers)) / len(rank_tiers))
+    badge, stars = divmod(mean, 5)
+    return 80 if badge >= 7 else 10 * (badge + 1) + stars + 1
+
+
+def ban_score(games, win):
+    """Expected wins on a hero, pulling small samples towards 50%."""
+    return games * (win + 1) / (games + 2)
+
+
+def top_heroes(records, hero_info, max_heroes=5, min_games=0):
+    """
+    Turn a player's most played heroes into dicts.
+
+    Each dict has hero_id, games and win as in the records, loc_name, the
+    hero's English name, and winrate, the player's winrate with the hero.
+
+    Parameters
+    ----------
+    records: list of HeroRecord
+        The player's hero aggregate (see api_dispatch.HeroRecord)
+
+    hero_info: HeroData
+        Hero information, for the names
+
+    max_heroes: int (default 5)
+        The maximum number of most played heroes to keep
+
+    min_games: int (default 0)
+        The minimum number of games on a hero to keep it
+
+    """
+    played = sorted([record for record in records
+                     if record.games >= min_games],
+                    key=lambda record: record.games,
+                    reverse=True)[:max_heroes]
+    return [dict(hero_id=record.hero_id, games=record.games,
+                 win=record.win,
+                 loc_name=hero_info[record.hero_id]['loc_name'],
+                 # Unplayed heroes have no winrate to speak of
+                 winrate=record.win / record.games if record.games
+                 else 0.0)
+            for record in played]
+
+
 class TangyBotError(Exception):
     """Basic TangyBot Error to differentiate from other Exceptions."""
     pass
 
 
-# Mapping of resource to primary key values on aws
-RESOURCE_KEY_NAMES = dict(session="username", profile="steamid")
+# Seconds each kind of upstream response stays fresh in the backend caches
+#   roster      CSL team page, team_id -> (team_name, player_dict)
+#   account     OpenDota player info, steam 32 id -> response
+#   heroes      OpenDota hero aggregates, (id, num_games, tourney) -> response
+CACHE_TTLS = dict(roster=1800, account=600, heroes=600)
+
+# Seconds the hero table stays fresh in the shared cache, see _load_hero_info
+HERO_TABLE_TTL = 24 * 60 * 60
+
+# Most upstream requests a versus makes at once, for both teams together
+VERSUS_FANOUT = 16
+
+# Most match lists a stacks command fetches at once
+STACKS_FANOUT = 8
+
+# Usernames allowed to run admin commands, comma separated
+ADMIN_USERS = set(filter(None, os.environ.get("TANGYBOT_ADMINS",
+                                              "").split(",")))
 
 
 class PersistentData:
@@ -58,14 +208,18 @@ class PersistentData:
     This information includes session data and player profile information.
 
     The backend chosen for storing the persistent information can be
-    configured; the following backends are currently supported:
+    configured; the following backends are currently supported (see
+    storage.py):
         "file"  gzipped pickled file
         "aws"   aws dynamodb + boto3 wrapper
 
     Attributes
     ----------
     backend: str
-        The backend to use for storing the data
+        The name of the backend used for storing the data
+
+    storage: StorageBackend
+        The backend used for storing the data
 
     session_data: dict
         The data for user sessions, at least until it overruns memory
@@ -73,33 +227,31 @@ class PersistentData:
     profile_data: dict
         The data for player profiles, at least until it overruns memory
 
-    AWS Exclusive Attributes
-    ------------------------
-    dynamodb: DynamoDB resource
-        The dynamoDB instance
-        Only exists if backend is set to aws
-
-    session_table: DynamoDB Table
-        The dynamodb table holding user session information
-
-    profile_table: DynamoDB Table
-        The dynamodb table holding user profile information
-
     """
 
     def __init__(self, backend="file"):
-        self.backend = backend
-        if backend == "aws":
-            self.dynamodb = boto3.resource('dynamodb', region_name='us-east-2')
-            self.session_table = self.dynamodb.Table("TangyBot_Session")
-            self.profile_table = self.dynamodb.Table("TangyBot_Profile")
-        elif backend == "file":
-            pass
-        else:
-            raise ValueError("Backend must be either aws or file")
+        """
+        Parameters
+        ----------
+        backend: str or StorageBackend
+            Name of the backend to use, or the backend itself
+
+        """
+        if isinstance(backend, str):
+            backend = storage.create_storage(backend)
+        self.storage = backend
+        self.backend = backend.name
         self.profile_data = self._load('profile')
         self.session_data = self._load('session')
 
+        # Writes run in order on their own thread, off the event loop
+        self._writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="tangybot-persist")
+        # resource -> keys updated since the last flush
+        self._dirty = {}
+        self._flush_scheduled = False
+        self._writes = set()
+
     def _load(self, resource):
         """
         Load the requested resource from source.
@@ -114,22 +266,7 @@ class PersistentData:
             The resource requested to be loaded
 
         """
-        if self.backend == "aws":
-            table = getattr(self, resource + "_table")
-            return_dict = {}
-            for item in table.scan()['Items']:
-                # Even though numeric keys have the weird type Decimal('123')
-                # they still compare fine when we try to access their values
-                key = item.pop(RESOURCE_KEY_NAMES[resource])
-                return_dict[key] = item
-            return return_dict
-        elif self.backend == "file":
-            try:
-                return util.load(resource + '.pkl.gzip')
-            except FileNotFoundError:
-                return {}
-        else:
-            raise ValueError("Backend must be either aws or file")
+        return self.storage.load(resource)
 
     def update(self, resource, resource_key, dict_key, new_val):
         """
@@ -159,18 +296,81 @@ class PersistentData:
             target[resource_key] = {}
         target[resource_key][dict_key] = new_val
 
-        # Update persistent storage
-        if self.backend == "aws":
-            # AWS wants the data in this format lol
-            aws_dict = target[resource_key].copy()
-            aws_dict[RESOURCE_KEY_NAMES[resource]] = resource_key
+        # Update persistent storage, once for all the updates made before
+        # the event loop gets back to us
+        self._dirty.setdefault(resource, set()).add(resource_key)
+        if self._flush_scheduled:
+            return
+        self._flush_scheduled = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Nobody to hold up, write right away
+            for resource, future in self._flush():
+                self._write_done(resource, future)
+        else:
+            loop.call_soon(self._flush, loop)
+
+    def _flush(self, loop=None):
+        """
+        Hand the updates since the last flush to the writer thread.
+
+        Returns
+        -------
+        writes: list of (str, Future)
+            The resource and future of each write, asyncio futures of loop
+            if a loop is given
 
-            table = getattr(self, resource + "_table")
-            table.put_item(Item=aws_dict)
-        elif self.backend == "file":
-            util.save(target, resource + '.pkl.gzip')
+        """
+        self._flush_scheduled = False
+        dirty, self._dirty = self._dirty, {}
+        writes = []
+        for resource, keys in dirty.items():
+            target = getattr(self, resource + "_data")
+            # Copy here, the loop keeps changing target
+            items = {resource_key: dict(target[resource_key])
+                     for resource_key in keys}
+            writes.append((resource, self._writer.submit(
+                _timed_call, self._write, resource, items)))
+
+        if loop is not None:
+            writes = [(resource, asyncio.wrap_future(future, loop=loop))
+                      for resource, future in writes]
+            for resource, future in writes:
+                self._writes.add(future)
+                future.add_done_callback(
+                    lambda done, resource=resource:
+                    self._write_done(resource, done))
+        return writes
+
+    def _write(self, resource, items):
+        """Write items of a resource, on the writer thread."""
+        self.storage.batch_put(resource, items)
+        self.storage.flush()
+
+    def _write_done(self, resource, future):
+        """Record a finished write, or report that it failed."""
+        self._writes.discard(future)
+        try:
+            elapsed = future.result()
+        except Exception as err:
+            print("Failed to write", resource, "to", self.backend + ":",
+                  repr(err))
         else:
-            raise ValueError("Backend must be either aws or file")
+            PERSIST_WRITE_LATENCY.observe(elapsed, backend=self.backend,
+                                          resource=resource)
+
+    async def flush(self):
+        """Wait until every update so far has been written."""
+        if self._flush_scheduled:
+            self._flush(asyncio.get_running_loop())
+        await asyncio.gather(*self._writes, return_exceptions=True)
+
+    async def close(self):
+        """Write every update so far and close the storage."""
+        await self.flush()
+        await asyncio.wrap_future(self._writer.submit(self.storage.close))
+        self._writer.shutdown()
 
 
 class TangyBotBackend:
@@ -206,35 +406,126 @@ class TangyBotBackend:
         The ClientSession to use in TangyBot
         If None, uses our own session, but please close it when needed
 
-    hero_info: HeroData
+    hero_info: HeroData or None
         The hero information store (i.e. localized name)
+        Fetched when first needed (see _get_hero_info), or loaded from the
+        snapshot in TANGYBOT_SNAPSHOT along with the caches
+
+    league: LeagueStats or None
+        Hero statistics of every player seen, see get_league
+
+    match_history: MatchHistory
+        Recent matches of the players stacks looked at, see stacks.py
+
+    caches: dict, str -> TTLCache
+        Caches of upstream responses, keyed as in CACHE_TTLS
+
+    shared_cache: SharedCache or None
+        Cache tier shared with the other TangyBot processes on the host,
+        from TANGYBOT_SHARED_CACHE (see shared_cache.py), None if unset
+
+    profiler: CommandProfiler or None
+        Sampling profiler for dispatched commands, None if disabled
+
+    deadline: float or None
+        Seconds each dispatched command gets, None for no limit
+        Players not fetched in time are left out of responses, see
+        deadlines.py
+
+    refresher: Refresher or None
+        Refreshes recently used cache entries while idle, once started
+        (see start_refresher), None if disabled
+
+    commands_running: int
+        Number of dispatched commands not finished yet
+
+    last_command_at: float
+        Monotonic time the last dispatched command finished
 
     """
 
-    def __init__(self, backend="file", session=None):
+    def __init__(self, backend="file", session=None, profiler=None):
         """
         Construct TangyBot's backend
 
         Parameters
         ----------
-        backend: str
-            The backend to use for persistent storage
+        backend: str or StorageBackend
+            The backend to use for persistent storage, see storage.py
 
         session: Asynchronous request maker, or None
             The ClientSession to use in TangyBot
             If None, create a new session, but please close it when needed
 
+        profiler: CommandProfiler or None
+            Profiler to use for dispatched commands
+            If None, configure one from the environment (off by default)
+
         """
         self.persist = PersistentData(backend)
         self.session = session or aiohttp.ClientSession()
-        self.hero_info = hero_data.HeroData()
+        self.hero_info = None
+        self.league = None
+        self.match_history = MatchHistory()
+        self._hero_info_task = None
+        self.shared_cache = SharedCache.from_env()
+        self.caches = {name: TTLCache(name, ttl)
+                       for name, ttl in CACHE_TTLS.items()}
+        self.profiler = profiler or CommandProfiler.from_env()
+        self.deadline = deadlines.budget_from_env()
+        self.refresher = Refresher.from_env(self)
+        self.commands_running = 0
+        self.last_command_at = 0.0
+        snapshot.import_from_env(self)
 
     # TODO stolen from discord client. Is this needed?
     async def close(self):
-        """Close the session on cleanup."""
+        """Finish persistent writes and close the session on cleanup."""
+        if self.refresher is not None:
+            self.refresher.stop()
+        await self.persist.close()
+        if self.shared_cache is not None:
+            await self.shared_cache.close()
         if not self.session.closed:
             await self.session.close()
 
+    async def warm_up(self):
+        """Fetch what commands need up front, for long running frontends."""
+        await self._get_hero_info()
+
+    def start_refresher(self):
+        """Start refreshing in the background, for long running frontends."""
+        if self.refresher is not None:
+            self.refresher.start()
+
+    async def _get_hero_info(self):
+        """Get the hero information, fetching it on first use."""
+        if self.hero_info is None:
+            # Concurrent commands share a single fetch
+            if self._hero_info_task is None:
+                self._hero_info_task = asyncio.ensure_future(
+                    self._load_hero_info())
+            try:
+                self.hero_info = await asyncio.shield(self._hero_info_task)
+            except aiohttp.ClientError as err:
+                self._hero_info_task = None
+                raise TangyBotError("Could not get hero data: " + str(err))
+        return self.hero_info
+
+    async def _load_hero_info(self):
+        """Get the hero table from the shared cache, or from Steam."""
+        shared = self.shared_cache
+        entry = (await shared.get('hero_table', 'en') if shared is not None
+                 else None)
+        if entry is not None and entry[1] > time.time():
+            return hero_data.HeroData(api_hero_resp=entry[2])
+        hero_info = await hero_data.HeroData.create_async(self.session)
+        if shared is not None:
+            now = time.time()
+            shared.put('hero_table', 'en', now, now + HERO_TABLE_TTL,
+                       hero_info.api_response())
+        return hero_info
+
     async def dispatch(self, args, username="user"):
         """
         Dispatch function for TangyBot to perform actions based on args.
@@ -283,10 +574,23 @@ class TangyBotBackend:
         # Splatter and pass username as kwargs
         # Looks like the call site will have to have their own
         # **_ kwargs declaration to eat up the unused kwargs...
-        res = await func_to_call(username=username, **vars(args))
+        trace = (self.profiler.trace("backend", args.command, vars(args),
+                                     username)
+                 if self.profiler else contextlib.nullcontext())
+        self.commands_running += 1
+        try:
+            with trace, deadlines.deadline(self.deadline), \
+                    COMMAND_LATENCY.time(command=args.command,
+                                         outcome="error") as timer:
+                res = await func_to_call(username=username, **vars(args))
+                timer['outcome'] = "ok"
+        finally:
+            self.commands_running -= 1
+            self.last_command_at = time.monotonic()
         return res
 
-    async def lookup(self, last, team_number, username="user", **_):
+    async def lookup(self, last, team_number, other=False, username="user",
+                     **_):
         """
         Perform a team lookup based on passed in arguments.
 
@@ -298,6 +602,9 @@ class TangyBotBackend:
         team_number: int or str
             Team number or URL to lookup
 
+        other: bool
+            Whether to use the other team of the last versus
+
         username: str or None
             The username to use a session
             If None, use the default session
@@ -318,92 +625,255 @@ class TangyBotBackend:
             team_name: str, the university's name
 
             players: dict, steam 32 id -> dict of values
-                The dict of values is mostly in the OpenDota API response
-                format, but also includes steam_name and csl_name if they exist
+                The dict of values holds the OpenDota account information
+                (see api_dispatch.project_account_info), but also includes
+                steam_name and csl_name if they exist
+                Players whose account information could not be fetched in
+                time only have a status of deadlines.PENDING or UNAVAILABLE
+                instead
+                While OpenDota is down, players answered from stale data
+                have its age in seconds as stale_age
+
+            roster_age: float, only if the roster is stale because CSL is
+                down, seconds since it was fetched
 
         """
+        team_id = self._resolve_team("Lookup", last, team_number, username,
+                                     other)
+        return await self._lookup(team_id, username,
+                                  "other" if other else "last")
+
+    def _resolve_team(self, command, last, team_number, username,
+                      other=False):
+        """Get the team a command is about, remembering it for --last."""
         # Check args for validity first
-        if last and not team_number:
-            # Check for last team number
+        if (last or other) and not team_number:
+            # Check for last (or other) team number
+            slot = "other" if other else "last"
             try:
-                last_team = self.persist.session_data[username]['last_team']
+                last_team = self.persist.session_data[username][
+                    slot + '_team']
             except KeyError:
-                raise TangyBotError("Lookup: " + username + " has no last "
-                                                            "team to use")
+                raise TangyBotError(command + ": " + username + " has no " +
+                                    slot + " team to use")
             if last_team is None:
-                raise TangyBotError("Lookup: " + username + " has no last "
-                                                            "team to use")
-            return await self._lookup(last_team, username)
+                raise TangyBotError(command + ": " + username + " has no " +
+                                    slot + " team to use")
+            return last_team
         elif team_number and not last:
             self.persist.update('session', username, 'last_team',
                                 team_number)
-            return await self._lookup(team_number, username)
+            return team_number
         else:
-            raise TangyBotError("Lookup: must specify either last or "
+            raise TangyBotError(command + ": must specify either last or "
                                 "team_number, but got neither!")
 
-    async def _lookup(self, team_id, username):
-        """Internal lookup implementation."""
-        url = "https://cstarleague.com/dota2/teams/" + str(team_id)
-        print("Looking up URL " + url)
-        # Pepega
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) '
-                          'AppleWebKit/537.36 (KHTML, like Gecko) '
-                          'Chrome/39.0.2171.95 Safari/537.36'
-        }
+    async def _fetch_cached(self, cache_name, key, fetch):
+        """
+        Get a value from cache if it is fresh, otherwise await fetch().
+
+        Entries missing or expired here are looked up in the shared cache
+        first, if there is one, and values fetched are written through to
+        it.
+
+        If fetching fails because the upstream is down (see
+        circuit_breaker.is_outage), the last value cached is returned
+        instead, however old it is.
 
+        Returns
+        -------
+        value: any
+            The cached or fetched value
+
+        age: float or None
+            Seconds since a stale value was fetched, None if it is fresh
+
+        """
+        if self.refresher is not None:
+            self.refresher.note(cache_name, key)
+        cache = self.caches[cache_name]
+        cached = cache.get(key)
+        if cached is None and self.shared_cache is not None:
+            entry = await self.shared_cache.get(cache_name, key)
+            if entry is not None:
+                cached = cache.get_shared(key, entry)
+        if cached is not None:
+            return cached, None
         try:
-            async with self.session.get(url, headers=headers) as req:
-                content = await req.text()
-            soup = BeautifulSoup(content, 'lxml')
+            value = await fetch()
+        except Exception as err:
+            stale = cache.get_stale(key) if is_outage(err) else None
+            if stale is None:
+                raise
+            value, stored_at = stale
+            return value, time.time() - stored_at
+        cache.put(key, value)
+        self._share(cache_name, key)
+        return value, None
+
+    def _share(self, cache_name, key):
+        """Queue a cache entry to be written to the shared cache, if any."""
+        if self.shared_cache is not None:
+            self.shared_cache.put(cache_name, key,
+                                  *self.caches[cache_name].entry(key))
+
+    async def refresh(self, cache_name, key):
+        """
+        Fetch a cache entry again, fresh or not, and store it.
 
-            team_name_div = soup.findAll("div", {"class": "hero-title"})
-            team_name = extract_team_id(team_name_div)
+        If another process sharing the cache fetched it again meanwhile,
+        its entry is taken instead.
 
-            players = soup.findAll("span", {"class": "tool-tip"})
+        Parameters
+        ----------
+        cache_name: str
+            One of CACHE_TTLS
 
-            # Maps steam 32 id to names
-            player_dict = extract_id_user(players)
+        key: any
+            The entry's key in that cache
 
-            steam_ids = list(player_dict.keys())
+        """
+        cache = self.caches[cache_name]
+        if self.shared_cache is not None:
+            entry = await self.shared_cache.get(cache_name, key)
+            if entry is not None and entry[1] > time.time() and \
+                    cache.adopt(key, entry):
+                return
+        if cache_name == 'roster':
+            value = await self._fetch_roster(key)
+        elif cache_name == 'account':
+            value = await self._fetch_account_info(key)
+        else:
+            value = await self._fetch_hero_records(*key)
+        cache.put(key, value)
+        self._share(cache_name, key)
+
+    async def _get_roster(self, team_id):
+        """Get the team name and player dict of a CSL team, and its age."""
+        return await self._fetch_cached(
+            'roster', str(team_id), lambda: self._fetch_roster(team_id))
+
+    async def _fetch_roster(self, team_id):
+        content = await get_team_page_async(self.session, team_id)
+        # Parsing a full page takes long enough to hold up other commands
+        return await asyncio.get_running_loop().run_in_executor(
+            None, parse_roster, content)
+
+    async def _get_account_info(self, id_32):
+        """Get OpenDota account info, and its age if it is stale."""
+        return await self._fetch_cached(
+            'account', id_32, lambda: self._fetch_account_info(id_32))
+
+    async def _fetch_account_info(self, id_32):
+        resp = await deadlines.hedged(
+            "opendota_info",
+            lambda: get_account_info_async(self.session, id_32))
+        self._record_rank(id_32, resp['rank_tier'])
+        return resp
+
+    def _record_rank(self, id_32, rank_tier):
+        """Remember a player's rank, for the league statistics."""
+        if self.persist.profile_data.get(id_32, {}).get('rank_tier') != \
+                rank_tier:
+            self.persist.update('profile', id_32, 'rank_tier', rank_tier)
+        if self.league is not None:
+            self.league.record_rank(id_32, rank_tier)
+
+    def get_league(self):
+        """Get the league statistics, None until the hero table is loaded."""
+        if self.league is None and self.hero_info is not None:
+            self.league = LeagueStats(self.hero_info.hero_seq,
+                                      self.hero_info.seq_hero)
+        return self.league
+
+    async def _record_league(self, id_32, records, only_new=False):
+        """
+        Count a player's hero aggregate over LEAGUE_WINDOW in the league.
 
-            self.persist.update('session', username, 'last_players',
-                                steam_ids)
-
-            # Update CSL names
-            for steam_id, data in player_dict.items():
-                self.persist.update('profile', steam_id,
-                                    'csl_name', data['csl_name'])
-
-            tasks = (get_account_info_async(self.session, id) for id in
-                     steam_ids)
-
-            return_dict = dict(zip(steam_ids,
-                                   await asyncio.gather(*tasks)))
-
-            # Update steam names
-            for prof, res in return_dict.items():
-                try:
-                    self.persist.update('profile', prof, 'steam_name',
-                                        res['profile']['personaname'])
-                except KeyError:
-                    self.persist.update('profile', prof, 'steam_name',
-                                        'INVALID?')
-
-            # Merge in known profile information
-            merged_dict = {}
-            for key in player_dict:
-                merged_dict[key] = {**self.persist.profile_data[key],
-                                    **return_dict[key]}
+        With only_new, players already counted are left as they are.
+        """
+        await self._get_hero_info()
+        league = self.get_league()
+        if only_new and id_32 in league:
+            return
+        league.record_heroes(
+            id_32, records,
+            self.persist.profile_data.get(id_32, {}).get('rank_tier'))
+
+    async def _team_roster(self, team_id, username, slot="last"):
+        """
+        Get a team's name and players, remembering them for --last.
+
+        The players are remembered as the session's slot + '_players', so
+        slot "other" remembers them for --other instead.
+
+        Returns
+        -------
+        team_name: str
+            The university's name
 
-            return dict(team_name=team_name,
-                        players=merged_dict)
+        steam_ids: list of int
+            Steam 32 IDs of the team's players
+
+        roster_age: float or None
+            Seconds since the roster was fetched if it is stale
+
+        """
+        try:
+            (team_name, player_dict), roster_age = \
+                await self._get_roster(team_id)
         except HTTPError as err:
             raise TangyBotError("_lookup: " + err.msg)
+        except CircuitOpenError as err:
+            raise TangyBotError("_lookup: " + str(err))
+        except asyncio.TimeoutError:
+            raise TangyBotError("_lookup: CSL did not answer in time")
+
+        steam_ids = list(player_dict.keys())
+
+        self.persist.update('session', username, slot + '_players',
+                            steam_ids)
+
+        # Update CSL names
+        for steam_id, data in player_dict.items():
+            self.persist.update('profile', steam_id,
+                                'csl_name', data['csl_name'])
+        return team_name, steam_ids, roster_age
+
+    async def _lookup(self, team_id, username, slot="last"):
+        """Internal lookup implementation."""
+        team_name, steam_ids, roster_age = await self._team_roster(
+            team_id, username, slot)
+
+        return_dict, missing = await deadlines.gather_partial(
+            {id: self._get_account_info(id) for id in steam_ids})
+
+        # Update steam names
+        for prof, (res, _) in return_dict.items():
+            self.persist.update('profile', prof, 'steam_name',
+                                res['personaname'] or 'INVALID?')
+
+        # Merge in known profile information, marking who is missing
+        # and whose information is stale
+        merged_dict = {}
+        for key in steam_ids:
+            if key in return_dict:
+                res, age = return_dict[key]
+                merged_dict[key] = {**self.persist.profile_data[key], **res}
+                if age is not None:
+                    merged_dict[key]['stale_age'] = age
+            else:
+                merged_dict[key] = {**self.persist.profile_data[key],
+                                    'status': missing[key]}
+
+        data = dict(team_name=team_name, players=merged_dict)
+        if roster_age is not None:
+            data['roster_age'] = roster_age
+        return data
 
     async def profile(self, last, profiles, num_games, max_heroes,
-                      min_games, tourney_only, username="user", **_):
+                      min_games, tourney_only, other=False, windows=None,
+                      username="user", **_):
         """
         Perform a player profile based on passed in arguments.
 
@@ -427,6 +897,13 @@ class TangyBotBackend:
         tourney_only: bool
             Whether to filter to only tournament games
 
+        other: bool
+            Whether to use the players of the other team of the last versus
+
+        windows: list of ints or None
+            Numbers of games to look back, all computed from one fetch of
+            each player's matches, instead of num_games
+
         username: str or None
             The username to use a session
             If None, use the default session
@@ -446,63 +923,89 @@ class TangyBotBackend:
 
             players: dict, steam 32 id -> dict of values
                 Each dict contains csl_name and steam_name, as well as a
-                list of heroes in the OpenDota API heroes response format
+                list of heroes (see _get_account_heroes)
+                With windows, each has windows instead of heroes, a list of
+                dicts with num_games, games (the matches found in it) and
+                heroes, per window (see _get_window_heroes)
+                Players whose heroes could not be fetched in time have a
+                status of deadlines.PENDING or UNAVAILABLE instead of heroes
+                While OpenDota is down, players answered from stale data
+                have its age in seconds as stale_age
 
         """
         # Check args for validity first
-        if last and not profiles:
-            # Check for last team number
+        if (last or other) and not profiles:
+            # Check for last (or other) team number
+            slot = "other" if other else "last"
             try:
                 last_players = self.persist.session_data[username][
-                    'last_players']
+                    slot + '_players']
             except KeyError:
-                raise TangyBotError("Profile: user has no last players to use")
+                raise TangyBotError("Profile: user has no " + slot +
+                                    " players to use")
             except AttributeError:
-                raise TangyBotError("Profile: user has no last players to use")
+                raise TangyBotError("Profile: user has no " + slot +
+                                    " players to use")
+            if last_players is None:
+                raise TangyBotError("Profile: user has no " + slot +
+                                    " players to use")
             return await self._profile(last_players, num_games, max_heroes,
-                                       min_games, tourney_only)
+                                       min_games, tourney_only, windows)
         elif profiles and not last:
             self.persist.update('session', username, 'last_players',
                                 profiles)
             return await self._profile(profiles, num_games, max_heroes,
-                                       min_games, tourney_only)
+                                       min_games, tourney_only, windows)
         else:
             raise TangyBotError("Profile: must specify either last or "
                                 "profile list, but got neither!")
 
     async def _profile(self, profiles, num_games, max_heroes,
-                       min_games, tourney_only):
+                       min_games, tourney_only, windows=None):
         """Internal profile implementation."""
-        # Fill missing dict items if needed
-        await self._fill_missing_accounts([prof for prof in profiles if prof
-                                           not in self.persist.profile_data])
-
-        # Resume normal tasks
-        tasks = (self._get_account_heroes(profile, num_games, max_heroes,
-                                          min_games, tourney_only) for
-                 profile in profiles)
-        return_dict = dict(zip(profiles, await asyncio.gather(*tasks)))
-
-        # Merge in known profile information
+        if windows:
+            field = 'windows'
+            requests = {profile: self._get_window_heroes(profile, windows,
+                                                         max_heroes,
+                                                         min_games,
+                                                         tourney_only)
+                        for profile in profiles}
+        else:
+            field = 'heroes'
+            requests = {profile: self._get_account_heroes(profile, num_games,
+                                                          max_heroes,
+                                                          min_games,
+                                                          tourney_only)
+                        for profile in profiles}
+        # Fill missing dict items if needed, alongside the normal tasks
+        _, (return_dict, missing) = await asyncio.gather(
+            self._fill_missing_accounts([prof for prof in profiles if prof
+                                         not in self.persist.profile_data]),
+            deadlines.gather_partial(requests))
+
+        # Merge in known profile information, marking who is missing
         merged_dict = {}
-        for key in return_dict:
-            merged_dict[key] = {**self.persist.profile_data[key],
-                                'heroes': return_dict[key]}
+        for key in profiles:
+            if key in return_dict:
+                heroes, age = return_dict[key]
+                merged_dict[key] = {**self.persist.profile_data.get(key, {}),
+                                    field: heroes}
+                if age is not None:
+                    merged_dict[key]['stale_age'] = age
+            else:
+                merged_dict[key] = {**self.persist.profile_data.get(key, {}),
+                                    'status': missing[key]}
 
         return dict(players=merged_dict)
 
     async def _fill_missing_accounts(self, missing_profiles):
         """Fill in account information about missing profiles."""
-        tasks = (get_account_info_async(self.session, id) for
-                 id in missing_profiles)
-        results = await asyncio.gather(*tasks)
+        results, _ = await deadlines.gather_partial(
+            {id: self._get_account_info(id) for id in missing_profiles})
 
-        for prof, res in zip(missing_profiles, results):
-            try:
-                self.persist.update('profile', prof, 'steam_name',
-                                    res['profile']['personaname'])
-            except KeyError:
-                self.persist.update('profile', prof, 'steam_name', 'INVALID??')
+        for prof, (res, _) in results.items():
+            self.persist.update('profile', prof, 'steam_name',
+                                res['personaname'] or 'INVALID??')
 
     async def _get_account_heroes(self, id_32, num_games, max_heroes=5,
                                   min_games=0, tourney_only=False):
@@ -512,7 +1015,9 @@ class TangyBotBackend:
         For more information about the API endpoint used here, see the docs at:
         https://docs.opendota.com/#tag/players%2Fpaths%2F~1players~1%7Baccount_id%7D~1heroes%2Fget
 
-        Additionally, we add the following key-value pairs to the dictionary:
+        Only the heroes returned are turned into dicts, with the following
+        key-value pairs:
+            hero_id, games and win, as in the API response
             loc_name, containing the hero's English name
             winrate, containing the player's winrate with the hero
 
@@ -538,20 +1043,620 @@ class TangyBotBackend:
         played_heroes: list of dicts
             The list of num_heroes heroes that the player has played the most.
 
+        age: float or None
+            Seconds since the heroes were fetched if they are stale
+
         """
-        resp = await get_account_heroes_async(self.session, id_32,
-                                              num_games, tourney_only)
-        for hero_dict in resp:
-            hero_dict['loc_name'] = self.hero_info[hero_dict['hero_id']][
-                'loc_name']
+        records, age = await self._get_hero_records(id_32, num_games,
+                                                    tourney_only)
+        hero_info = await self._get_hero_info()
+        return top_heroes(records, hero_info, max_heroes, min_games), age
+
+    async def _get_window_heroes(self, id_32, windows, max_heroes=5,
+                                 min_games=0, tourney_only=False):
+        """
+        Process the account's most played heroes over several windows.
+
+        The player's matches are fetched once, for the largest window (see
+        _get_matches), and every window is counted from them.
+
+        Parameters
+        ----------
+        id_32: int
+            The Steam32 ID of a player
+
+        windows: list of ints
+            The numbers of recent matches to consider
+
+        max_heroes, min_games, tourney_only:
+            As for _get_account_heroes
+
+        Returns
+        -------
+        windows: list of dicts
+            num_games, the window, games, the number of matches found in
+            it, and heroes (see top_heroes), per window in order
+
+        age: float or None
+            Seconds since the matches were fetched if they are stale
+
+        """
+        matches, age = await self._get_matches(id_32, max(windows),
+                                               tourney_only)
+        hero_info = await self._get_hero_info()
+        league_games, league_tourney_only = LEAGUE_WINDOW
+        if age is None and tourney_only == league_tourney_only and \
+                max(windows) >= league_games:
+            await self._record_league(
+                id_32, hero_records(matches[:league_games]))
+        return [dict(num_games=window, games=len(matches[:window]),
+                     heroes=top_heroes(hero_records(matches[:window]),
+                                       hero_info, max_heroes, min_games))
+                for window in windows], age
+
+    async def _get_hero_records(self, id_32, num_games, tourney_only):
+        """Get a player's OpenDota hero records, and their age if stale."""
+        records, age = await self._fetch_cached(
+            'heroes', (id_32, num_games, tourney_only),
+            lambda: self._fetch_hero_records(id_32, num_games, tourney_only))
+        if self.shared_cache is not None and age is None and \
+                (num_games, tourney_only) == LEAGUE_WINDOW:
+            # Another process may have fetched them, leaving us uncounted
+            await self._record_league(id_32, records, only_new=True)
+        return records, age
+
+    async def _fetch_hero_records(self, id_32, num_games, tourney_only):
+        records = await deadlines.hedged(
+            "opendota_heroes",
+            lambda: get_account_heroes_async(self.session, id_32, num_games,
+                                             tourney_only))
+        if (num_games, tourney_only) == LEAGUE_WINDOW:
+            await self._record_league(id_32, records)
+        return records
+
+    async def _get_matches(self, id_32, num_games, tourney_only=False):
+        """
+        Get a player's last num_games matches, and their age if stale.
+
+        Only the matches played since they were last fetched are fetched
+        (see stacks.MatchHistory), and while OpenDota is down the matches
+        stored are used however old they are.
+        """
+        history = self.match_history
+        key = (id_32, tourney_only)
+        request = history.plan(key, num_games)
+        if request is not None:
             try:
-                hero_dict['winrate'] = hero_dict['win'] / hero_dict['games']
-            except ZeroDivisionError:
-                # This will definitely happen for unplayed heroes
-                hero_dict['winrate'] = 0.0
-        return sorted([item for item in resp if item['games'] >= min_games],
-                      key=lambda item: item['games'],
+                matches = await deadlines.hedged(
+                    "opendota_matches",
+                    lambda: get_account_matches_async(
+                        self.session, id_32, lobby_only=tourney_only,
+                        **request))
+            except Exception as err:
+                matches, fetched_at = history.recent(key, num_games)
+                if matches is None or not is_outage(err):
+                    raise
+                return matches, time.time() - fetched_at
+            history.merge(key, matches, **request)
+        return history.recent(key, num_games)[0], None
+
+    async def draft(self, last, team_number, num_games, max_heroes, max_bans,
+                    min_games, tourney_only, other=False, username="user",
+                    **_):
+        """
+        Summarize a team's combined hero pool for drafting against them.
+
+        Uses the same hero data as profile, so drafting a team costs no
+        more upstream requests than profiling its players.
+
+        Parameters
+        ----------
+        last: bool
+            Whether to use the last team looked up
+
+        team_number: int or str
+            Team number or URL to draft against
+
+        num_games: int
+            Number of games to look back per player
+
+        max_heroes: int
+            Maximum number of shared heroes to report
+
+        max_bans: int
+            Maximum number of likely bans to report
+
+        min_games: int
+            Minimum number of combined games on a hero to report it
+
+        tourney_only: bool
+            Whether to filter to only tournament games
+
+        other: bool
+            Whether to use the other team of the last versus
+
+        username: str or None
+            The username to use a session
+            If None, use the default session
+
+        kwargs: dict
+            kwargs so they get ignored
+
+        Raises
+        ------
+        TangyBotError
+            On a lookup error, i.e. team was not found
+
+        Returns
+        -------
+        data: dict
+            Dictionary with draft results. The specific format is:
+
+            team_name: str, the university's name
+
+            games: int, games played by all players together
+
+            players: dict, steam 32 id -> dict of values
+                Each dict contains csl_name and steam_name if known, games
+                played and share of the team's games
+                Players whose heroes could not be fetched in time have a
+                status of deadlines.PENDING or UNAVAILABLE instead
+                While OpenDota is down, players answered from stale data
+                have its age in seconds as stale_age
+
+            pool: list of dicts, heroes played by more than one player,
+                most shared first, with hero_id, loc_name, games, win,
+                winrate and the players playing them
+
+            bans: list of dicts, the team's strongest heroes by ban_score,
+                with the same keys as pool
+
+            roster_age: float, only if the roster is stale because CSL is
+                down, seconds since it was fetched
+
+        """
+        team_id = self._resolve_team("Draft", last, team_number, username,
+                                     other)
+        team_name, steam_ids, roster_age = await self._team_roster(
+            team_id, username, "other" if other else "last")
+
+        return_dict, missing = await deadlines.gather_partial(
+            {id: self._get_hero_records(id, num_games, tourney_only)
+             for id in steam_ids})
+        hero_info = await self._get_hero_info()
+
+        player_games, heroes = aggregate_hero_pool(
+            {key: records for key, (records, _) in return_dict.items()})
+        team_games = sum(player_games.values())
+
+        players = {}
+        for key in steam_ids:
+            players[key] = dict(self.persist.profile_data.get(key, {}))
+            if key in return_dict:
+                players[key]['games'] = player_games[key]
+                # A team without games has no shares to speak of
+                players[key]['share'] = (player_games[key] / team_games
+                                         if team_games else 0.0)
+                age = return_dict[key][1]
+                if age is not None:
+                    players[key]['stale_age'] = age
+            else:
+                players[key]['status'] = missing[key]
+
+        def hero_summary(hero_id):
+            games, win, hero_players = heroes[hero_id]
+            return dict(hero_id=hero_id, games=games, win=win,
+                        loc_name=hero_info[hero_id]['loc_name'],
+                        winrate=win / games, players=hero_players)
+
+        eligible = [hero_id for hero_id, (games, _, _) in heroes.items()
+                    if games >= min_games]
+        pool = sorted((hero_id for hero_id in eligible
+                       if len(heroes[hero_id][2]) > 1),
+                      key=lambda hero_id: (len(heroes[hero_id][2]),
+                                           heroes[hero_id][0]),
                       reverse=True)[:max_heroes]
+        bans = sorted(eligible,
+                      key=lambda hero_id: ban_score(*heroes[hero_id][:2]),
+                      reverse=True)[:max_bans]
+
+        data = dict(team_name=team_name, games=team_games, players=players,
+                    pool=[hero_summary(hero_id) for hero_id in pool],
+                    bans=[hero_summary(hero_id) for hero_id in bans])
+        if roster_age is not None:
+            data['roster_age'] = roster_age
+        return data
+
+    async def versus(self, teams, num_games, max_heroes, min_games,
+                     tourney_only, username="user", **_):
+        """
+        Compare two teams side by side before a match.
+
+        Both rosters are fetched at once, then the account information and
+        hero records of every player of both teams in one fan-out of at
+        most VERSUS_FANOUT requests at a time. The first team is
+        remembered for --last and the second one for --other.
+
+        Parameters
+        ----------
+        teams: list
+            The two team numbers or URLs to compare
+
+        num_games: int
+            Number of games to look back per player
+
+        max_heroes: int
+            Maximum number of shared heroes to report
+
+        min_games: int
+            Minimum number of games each team has on a shared hero
+
+        tourney_only: bool
+            Whether to filter to only tournament games
+
+        username: str or None
+            The username to use a session
+            If None, use the default session
+
+        kwargs: dict
+            kwargs so they get ignored
+
+        Raises
+        ------
+        TangyBotError
+            On a lookup error, i.e. a team was not found
+
+        Returns
+        -------
+        data: dict
+            Dictionary with versus results. The specific format is:
+
+            teams: list of two dicts, one per team, with
+                team_number and team_name
+                players: dict, steam 32 id -> dict of values, as in lookup
+                    plus the games they played
+                games: int, games played by all players together
+                ranked: int, number of players with a rank
+                rank_tier: int or None, rank tier of the average rank
+                mmr_estimate: int or None, average MMR estimate
+                roster_age: float, only if the roster is stale
+
+            shared: list of dicts, heroes both teams play, most played
+                first, with hero_id, loc_name and sides, a dict per team
+                with its games, win, winrate and the players playing it
+
+        """
+        slots = ("last", "other")
+        for slot, team_id in zip(slots, teams):
+            self.persist.update('session', username, slot + '_team',
+                                team_id)
+        rosters = await asyncio.gather(
+            *(self._team_roster(team_id, username, slot)
+              for slot, team_id in zip(slots, teams)))
+
+        requests = {}
+        for _, steam_ids, _ in rosters:
+            for id in steam_ids:
+                requests['account', id] = self._get_account_info(id)
+                requests['heroes', id] = self._get_hero_records(
+                    id, num_games, tourney_only)
+        results, missing = await deadlines.gather_partial(
+            requests, limit=VERSUS_FANOUT)
+        hero_info = await self._get_hero_info()
+
+        sides = []
+        pools = []
+        for team_id, (team_name, steam_ids, roster_age) in zip(teams,
+                                                                rosters):
+            players = {}
+            for key in steam_ids:
+                if ('account', key) in results:
+                    res, age = results['account', key]
+                    self.persist.update('profile', key, 'steam_name',
+                                        res['personaname'] or 'INVALID?')
+                    players[key] = {**self.persist.profile_data[key], **res}
+                    if age is not None:
+                        players[key]['stale_age'] = age
+                else:
+                    players[key] = {**self.persist.profile_data[key],
+                                    'status': missing['account', key]}
+                if ('heroes', key) not in results:
+                    players[key].setdefault('status',
+                                            missing['heroes', key])
+
+            player_games, heroes = aggregate_hero_pool(
+                {key: results['heroes', key][0] for key in steam_ids
+                 if ('heroes', key) in results})
+            for key, games in player_games.items():
+                players[key]['games'] = games
+
+            rank_tiers = [player['rank_tier'] for player in players.values()
+                          if player.get('rank_tier')]
+            estimates = [player['mmr_estimate'] for player in
+                         players.values() if player.get('mmr_estimate')]
+            side = dict(team_number=team_id, team_name=team_name,
+                        players=players, games=sum(player_games.values()),
+                        ranked=len(rank_tiers),
+                        rank_tier=mean_rank_tier(rank_tiers),
+                        mmr_estimate=(round(sum(estimates) / len(estimates))
+                                      if estimates else None))
+            if roster_age is not None:
+                side['roster_age'] = roster_age
+            sides.append(side)
+            pools.append(heroes)
+
+        shared = sorted((hero_id for hero_id in pools[0].keys() &
+                         pools[1].keys()
+                         if min(pool[hero_id][0] for pool in pools) >=
+                         min_games),
+                        key=lambda hero_id: sum(pool[hero_id][0]
+                                                for pool in pools),
+                        reverse=True)[:max_heroes]
+        return dict(teams=sides, shared=[
+            dict(hero_id=hero_id, loc_name=hero_info[hero_id]['loc_name'],
+                 sides=[dict(games=games, win=win, winrate=win / games,
+                             players=hero_players)
+                        for games, win, hero_players in
+                        (pool[hero_id] for pool in pools)])
+            for hero_id in shared])
+
+    async def stacks(self, last, team_number, num_games, min_games,
+                     max_stacks, other=False, username="user", **_):
+        """
+        Find the players of a team who queue together.
+
+        Fetches every player's recent matches, at most STACKS_FANOUT at a
+        time and only those played since the last stacks of them (see
+        stacks.MatchHistory), and groups the players by the matches they
+        played on the same side (see stacks.find_stacks).
+
+        Parameters
+        ----------
+        last: bool
+            Whether to use the last team looked up
+
+        team_number: int or str
+            Team number or URL to look for stacks in
+
+        num_games: int
+            Number of matches to look back per player
+
+        min_games: int
+            Minimum number of matches together to report a stack
+
+        max_stacks: int
+            Maximum number of pairs, and of bigger groups, to report
+
+        other: bool
+            Whether to use the other team of the last versus
+
+        username: str or None
+            The username to use a session
+            If None, use the default session
+
+        kwargs: dict
+            kwargs so they get ignored
+
+        Raises
+        ------
+        TangyBotError
+            On a lookup error, i.e. team was not found
+
+        Returns
+        -------
+        data: dict
+            Dictionary with stacks results. The specific format is:
+
+            team_name: str, the university's name
+
+            num_games: int, matches looked back per player
+
+            players: dict, steam 32 id -> dict of values
+                Each dict contains csl_name and steam_name if known, and
+                games, the number of matches fetched
+                Players whose matches could not be fetched in time have a
+                status of deadlines.PENDING or UNAVAILABLE instead
+                While OpenDota is down, players answered from stale data
+                have its age in seconds as stale_age
+
+            pairs: list of dicts, pairs of players most often together
+                first, with players (their steam 32 ids), games, win and
+                winrate
+
+            groups: list of dicts, the same for groups of three or more
+
+            roster_age: float, only if the roster is stale because CSL is
+                down, seconds since it was fetched
+
+        """
+        team_id = self._resolve_team("Stacks", last, team_number, username,
+                                     other)
+        team_name, steam_ids, roster_age = await self._team_roster(
+            team_id, username, "other" if other else "last")
+
+        results, missing = await deadlines.gather_partial(
+            {id: self._get_matches(id, num_games) for id in steam_ids},
+            limit=STACKS_FANOUT)
+
+        players = {}
+        for key in steam_ids:
+            players[key] = dict(self.persist.profile_data.get(key, {}))
+            if key in results:
+                matches, age = results[key]
+                players[key]['games'] = len(matches)
+                if age is not None:
+                    players[key]['stale_age'] = age
+            else:
+                players[key]['status'] = missing[key]
+
+        pairs, groups = find_stacks(
+            {key: matches for key, (matches, _) in results.items()},
+            min_games)
+        for stack in pairs + groups:
+            stack['winrate'] = stack['win'] / stack['games']
+        data = dict(team_name=team_name, num_games=num_games,
+                    players=players, pairs=pairs[:max_stacks],
+                    groups=groups[:max_stacks])
+        if roster_age is not None:
+            data['roster_age'] = roster_age
+        return data
+
+    async def meta(self, rank, sort, max_heroes, min_players,
+                   username="user", **_):
+        """
+        Summarize the heroes played across the league.
+
+        Reads the league statistics built from every hero aggregate fetched
+        so far (see league_stats.py), so it makes no upstream requests
+        besides the hero table.
+
+        Parameters
+        ----------
+        rank: str
+            Rank badge to limit the players to, one of league_stats.BUCKETS
+
+        sort: str
+            What to sort the heroes by, one of league_stats.SORT_KEYS
+
+        max_heroes: int
+            Maximum number of heroes to report
+
+        min_players: int
+            Minimum number of players of a hero to report it
+
+        username: str or None
+            The username to use a session
+            If None, use the default session
+
+        kwargs: dict
+            kwargs so they get ignored
+
+        Returns
+        -------
+        data: dict
+            Dictionary with league statistics. The specific format is:
+
+            rank: str, the rank badge summarized
+
+            players: int, players counted
+
+            games: int, games played by those players
+
+            heroes: list of dicts, with hero_id, loc_name, games, win,
+                winrate, players and pick_rate, the share of all games
+                played on the hero
+
+        """
+        hero_info = await self._get_hero_info()
+        data = self.get_league().summary(rank, sort, max_heroes,
+                                         min_players)
+        for hero in data['heroes']:
+            hero['loc_name'] = hero_info[hero['hero_id']]['loc_name']
+        return dict(rank=rank, **data)
+
+    async def whoplays(self, hero, team_number="", last=False, other=False,
+                       min_games=1, max_players=10, username="user", **_):
+        """
+        Find who plays a hero, on a team or in the whole league.
+
+        Answers from the league statistics' index of every hero aggregate
+        fetched so far (see league_stats.py) and the team's roster, so it
+        makes no upstream requests besides the hero table and the roster,
+        if that is not cached. Players are counted with the last hero
+        aggregate fetched for them. Like lookup, a team is remembered with
+        its players for --last.
+
+        Parameters
+        ----------
+        hero: list of str
+            Words of the hero's name, or part of it (see
+            HeroData.find_heroes)
+
+        team_number: int or str
+            Team number or URL to limit the players to, if any
+
+        last: bool
+            Whether to limit the players to the last team looked up
+
+        other: bool
+            Whether to use the other team of the last versus
+
+        min_games: int
+            Minimum number of games on the hero to report a player
+
+        max_players: int
+            Maximum number of players to report
+
+        username: str or None
+            The username to use a session
+            If None, use the default session
+
+        kwargs: dict
+            kwargs so they get ignored
+
+        Raises
+        ------
+        TangyBotError
+            If no hero or several heroes match, or the team was not found
+
+        Returns
+        -------
+        data: dict
+            Dictionary with who plays the hero. The specific format is:
+
+            hero_id: int, the hero found
+
+            loc_name: str, its localized name
+
+            team_name: str or None, the team searched, None for the league
+
+            players: dict, steam 32 id -> dict of values, most games first
+                The dict of values holds games, win and winrate on the hero,
+                as well as the stored profile information (i.e. csl_name)
+
+            unknown: dict, steam 32 id -> stored profile information, of
+                the team's players whose heroes were never fetched
+
+            roster_age: float, only if the roster is stale because CSL is
+                down, seconds since it was fetched
+
+        """
+        hero_info = await self._get_hero_info()
+        query = " ".join(hero)
+        hero_ids = hero_info.find_heroes(query)
+        if not hero_ids:
+            raise TangyBotError("Whoplays: no hero is called " + query)
+        if len(hero_ids) > 1:
+            raise TangyBotError(
+                "Whoplays: " + query + " could be " +
+                ", ".join(hero_info[hero_id]['loc_name']
+                          for hero_id in hero_ids))
+        hero_id = hero_ids[0]
+
+        team_name = None
+        team_players = None
+        roster_age = None
+        if team_number or last or other:
+            team_id = self._resolve_team("Whoplays", last, team_number,
+                                         username, other)
+            team_name, team_players, roster_age = await self._team_roster(
+                team_id, username, "other" if other else "last")
+
+        league = self.get_league()
+        players = {}
+        for player, games, win in league.players_of(
+                hero_id, team_players, min_games)[:max_players]:
+            players[player] = {**self.persist.profile_data.get(player, {}),
+                               'games': games, 'win': win,
+                               'winrate': win / games}
+        data = dict(hero_id=hero_id, loc_name=hero_info[hero_id]['loc_name'],
+                    team_name=team_name, players=players,
+                    unknown={player: self.persist.profile_data.get(player, {})
+                             for player in team_players or ()
+                             if player not in league})
+        if roster_age is not None:
+            data['roster_age'] = roster_age
+        return data
 
     async def stalk(self, users, username="user", **_):
         """
@@ -596,12 +1701,59 @@ class TangyBotBackend:
             raise TangyBotError("Session data not found for user " +
                                 str(err.args[0]))
 
+    async def metrics(self, username="user", **_):
+        """
+        Summarize the latency and cache metrics. Admins only.
+
+        Parameters
+        ----------
+        username: str or None
+            The username to use a session
+            Must be listed in the TANGYBOT_ADMINS environment variable
+
+        Raises
+        ------
+        TangyBotError
+            If username is not an admin
+
+        Returns
+        -------
+        data: dict
+            Dictionary with metric summaries. Specifically, the format is:
+
+            commands: dict, command -> summary of backend time
+            upstreams: dict, upstream -> summary of request time
+            persist: dict, resource -> summary of write time
+            caches: dict, cache name -> hit ratio
+            shared: dict, cache name -> ratio of lookups answered by the
+                shared cache, only with TANGYBOT_SHARED_CACHE set
+
+            Each summary is a dict with count, mean, p50 and p95 seconds.
+
+        """
+        if username not in ADMIN_USERS:
+            raise TangyBotError("Metrics: " + username + " is not an admin")
+
+        def summaries(histogram, label):
+            return {value: histogram.summary(**{label: value})
+                    for value in histogram.label_values(label)}
+
+        return dict(commands=summaries(COMMAND_LATENCY, 'command'),
+                    upstreams=summaries(UPSTREAM_LATENCY, 'upstream'),
+                    persist=summaries(PERSIST_WRITE_LATENCY, 'resource'),
+                    caches=cache_hit_ratios(),
+                    shared=(cache_hit_ratios(results=("shared",))
+                            if self.shared_cache is not None else {}))
+
 
 async def main(team):
     """Main CLI for testing."""
     async with aiohttp.ClientSession() as session:
         the_tangy = TangyBotBackend(session=session)
-        return await the_tangy.lookup(False, team)
+        try:
+            return await the_tangy.lookup(False, team)
+        finally:
+            await the_tangy.persist.flush()
 
 
 if __name__ == "__main__":
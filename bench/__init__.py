@@ -0,0 +1,5 @@
+"""
+Benchmarks and load generators for TangyBot.
+
+Run them from the repository root as modules, i.e. python -m bench.rest_load
+"""
@@ -0,0 +1,61 @@
+"""Shared helpers for the TangyBot benchmarks."""
+
+import math
+import time
+
+
+def percentile(samples, perc):
+    """Get the perc-th percentile of samples by nearest rank."""
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    rank = max(0, math.ceil(perc / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def latency_summary(samples):
+    """Format p50/p95/p99/max of latencies in seconds as milliseconds."""
+    return "p50 {:8.2f}ms  p95 {:8.2f}ms  p99 {:8.2f}ms  max {:8.2f}ms".format(
+        *(1000 * percentile(samples, perc) for perc in (50, 95, 99, 100)))
+
+
+def expect(condition, message):
+    """Fail a check with message unless condition holds."""
+    if not condition:
+        raise AssertionError(message)
+
+
+def expire_caches(the_tangy):
+    """Backdate every cached entry so the next lookup of it misses."""
+    for cache in the_tangy.caches.values():
+        for key, stored_at, value in list(cache.items()):
+            cache.put(key, value, stored_at=stored_at - cache.ttl)
+
+
+class BackendRun:
+    """Backend, stub and command helpers shared by the checks of a bench."""
+
+    def __init__(self, the_tangy, stub, opts, username):
+        from cli import TangyBotArgParse
+
+        self.the_tangy = the_tangy
+        self.stub = stub
+        self.opts = opts
+        self.username = username
+        self.arg_parse = TangyBotArgParse()
+
+    async def command(self, *argv):
+        """Dispatch a command, returning its response and seconds taken."""
+        args = self.arg_parse.parse_args(list(argv))
+        start = time.perf_counter()
+        resp = await self.the_tangy.dispatch(args, self.username)
+        return resp, time.perf_counter() - start
+
+    async def scout(self, team):
+        """Look up team and profile its players, returning both responses."""
+        lookup, _ = await self.command("lookup", str(team))
+        profile, _ = await self.command("profile", "--last", "-n", "20")
+        return lookup, profile
+
+    def stub_requests(self):
+        return sum(self.stub.counts.values())
@@ -0,0 +1,271 @@
+"""
+Synthetic multi-user load on TangyBotClient.on_message.
+
+Simulated users in a handful of channels tag TangyBot with a realistic mix of
+commands. Messages go through the real on_message (tagging, shlex, argparse,
+backend dispatch against bench.stub_upstream, formatting) but replies land
+in a fake sink instead of Discord. The sink imitates Discord's round trip
+and per-channel rate limit, so send-side effects show up in the numbers.
+
+Reports message-to-first-reply and message-to-last-reply latencies per
+command, the number of messages each command sent and the total time spent
+sending them.
+
+    python -m bench.discord_load --users 40 --channels 4 --messages 10
+    python -m bench.discord_load --mix lookup=3,last=1,profile=4,stalk=1
+"""
+
+import argparse
+import asyncio
+import contextvars
+import os
+import random
+import tempfile
+import time
+
+import aiohttp
+
+from bench.common import latency_summary
+from bench.stub_upstream import StubUpstreams
+
+# Command templates by mix name, {team} is filled in per message
+COMMANDS = dict(lookup="lookup {team}",
+                last="lookup --last",
+                profile="profile --last -n 20",
+                stalk="stalk")
+
+DEFAULT_MIX = "lookup=3,last=1,profile=4,stalk=1"
+
+# Message being handled by the current on_message task
+_current = contextvars.ContextVar("current_message", default=None)
+
+
+class FakeUser:
+    """Stand-in for discord.User, only what on_message touches."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeChannel:
+    """Stand-in for discord.Channel, only what on_message touches."""
+
+    def __init__(self, channel_id):
+        self.id = str(channel_id)
+        self.name = "channel" + str(channel_id)
+
+
+class FakeMessage:
+    """Stand-in for discord.Message with the time it was 'received'."""
+
+    def __init__(self, content, author, channel, kind):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.kind = kind
+        self.received = None
+        # Deliveries of the replies sent through the send pipeline
+        self.replies = []
+
+
+class ReplySink:
+    """
+    Records replies and imitates Discord's send latency and rate limits.
+
+    Attributes
+    ----------
+    send_latency: float
+        Seconds per send_message round trip
+
+    channel_rate: float
+        Messages per second each channel accepts, 0 for unlimited
+
+    messages: list of FakeMessage
+        Every message that was handled
+
+    sent: int
+        Number of Discord messages sent
+
+    """
+
+    def __init__(self, send_latency, channel_rate):
+        self.send_latency = send_latency
+        self.channel_rate = channel_rate
+        self.messages = []
+        self.sent = 0
+        self.typing = 0
+        self._next_slot = {}
+
+    async def send(self, channel, content):
+        """Deliver content to channel, after any rate limit wait."""
+        if self.channel_rate:
+            now = time.perf_counter()
+            slot = max(now, self._next_slot.get(channel.id, now))
+            self._next_slot[channel.id] = slot + 1 / self.channel_rate
+            await asyncio.sleep(slot - now)
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+
+    async def send_typing(self, _):
+        self.typing += 1
+        await asyncio.sleep(self.send_latency)
+
+
+def make_client(the_tangy, sink):
+    """Build a TangyBotClient whose Discord side is the sink."""
+    from cli import TangyBotArgParse
+    from discord_bot import TangyBotClient
+    from frontend import FrontendFormatter
+    from send_pipeline import SendPipeline
+
+    class RecordingPipeline(SendPipeline):
+        """Send pipeline noting deliveries on the message being handled."""
+
+        async def send(self, channel, strings, command="reply", author=None):
+            delivery = await super().send(channel, strings, command, author)
+            message = _current.get()
+            if message is not None and delivery is not None:
+                message.replies.append(delivery)
+            return delivery
+
+    class LoadTestClient(TangyBotClient):
+        # Shadow discord.Client.user, we are never logged in
+        user = None
+
+        def __init__(self):
+            # Skip discord.Client.__init__, which wants a real connection
+            self.the_tangy = the_tangy
+            self.arg_parse = TangyBotArgParse()
+            self.frontend_format = FrontendFormatter(
+                buffer=False, profiler=the_tangy.profiler)
+            self.send_pipeline = RecordingPipeline(self.send_packed)
+
+        async def send_packed(self, destination, content, embed_text=None):
+            await sink.send(destination, content)
+
+        async def send_typing(self, destination):
+            await sink.send_typing(destination)
+
+    return LoadTestClient()
+
+
+def parse_mix(mix):
+    """Parse lookup=3,profile=4 into (kinds, weights)."""
+    pairs = [item.split("=") for item in mix.split(",")]
+    return [kind for kind, _ in pairs], [float(weight) for _, weight in pairs]
+
+
+async def _handle(client, message):
+    _current.set(message)
+    await client.on_message(message)
+
+
+async def simulate_user(client, sink, client_id, user, channel, messages,
+                        rate, kinds, weights, teams):
+    """Send messages from one user with exponential think times."""
+    for index in range(messages):
+        # Nobody can use --last before their first lookup
+        kind = "lookup" if index == 0 else random.choices(kinds, weights)[0]
+        command = COMMANDS[kind].format(team=random.choice(teams))
+        message = FakeMessage("<@!" + client_id + "> " + command, user,
+                              channel, kind)
+        await asyncio.sleep(random.expovariate(rate))
+
+        # Users don't wait for the bot before typing their next command
+        message.received = time.perf_counter()
+        sink.messages.append(message)
+        asyncio.ensure_future(_handle(client, message))
+
+
+async def run(opts):
+    """Run the load and print a report."""
+    stub = StubUpstreams(latency=opts.latency, jitter=opts.latency / 3,
+                         seed=opts.seed)
+    stub.start_in_thread()
+    stub.patch_urls()
+
+    import discord_bot
+    from backend import TangyBotBackend
+
+    discord_bot.CLIENT_ID = "570570570"
+    random.seed(opts.seed)
+    kinds, weights = parse_mix(opts.mix)
+    teams = list(range(839, 839 + opts.teams))
+    sink = ReplySink(opts.send_latency, opts.channel_rate)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            client = make_client(TangyBotBackend(session=session), sink)
+            channels = [FakeChannel(index) for index in range(opts.channels)]
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                simulate_user(client, sink, discord_bot.CLIENT_ID,
+                              FakeUser("user" + str(index)),
+                              channels[index % len(channels)], opts.messages,
+                              opts.rate, kinds, weights, teams)
+                for index in range(opts.users)))
+            # Wait for the stragglers still being answered
+            pending = [task for task in asyncio.all_tasks()
+                       if task is not asyncio.current_task()]
+            await asyncio.gather(*pending, return_exceptions=True)
+            elapsed = time.perf_counter() - start
+    finally:
+        stub.stop()
+
+    report(sink, elapsed)
+
+
+def report(sink, elapsed):
+    """Print latency distributions and message counts per command kind."""
+    print("messages {}  elapsed {:.2f}s  sent {}  typing {}".format(
+        len(sink.messages), elapsed, sink.sent, sink.typing))
+    for kind in sorted({message.kind for message in sink.messages}):
+        handled = [message for message in sink.messages
+                   if message.kind == kind and message.replies]
+        if not handled:
+            continue
+        first = [message.replies[0].first_sent - message.received
+                 for message in handled]
+        last = [message.replies[-1].last_sent - message.received
+                for message in handled]
+        sent = sum(delivery.messages for message in handled
+                   for delivery in message.replies)
+        sending = sum(delivery.last_sent - delivery.queued
+                      for message in handled for delivery in message.replies)
+        print("{:8s} {:5d} msgs  {:.2f} sent/msg  {:.2f}s total send "
+              "time".format(kind, len(handled), sent / len(handled),
+                            sending))
+        print("    first reply", latency_summary(first))
+        print("    last reply ", latency_summary(last))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=5,
+                        help="Messages sent by each user")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="Messages per second per user")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="Command mix weights, kinds are " +
+                             ", ".join(COMMANDS))
+    parser.add_argument("--teams", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Mean stub upstream latency in seconds")
+    parser.add_argument("--send_latency", type=float, default=0.05,
+                        help="Seconds per Discord send round trip")
+    parser.add_argument("--channel_rate", type=float, default=5.0,
+                        help="Messages per second a channel accepts")
+    parser.add_argument("--seed", type=int, default=570)
+    opts = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="tangybot-bench-"))
+    asyncio.run(run(opts))
+
+
+if __name__ == "__main__":
+    main()
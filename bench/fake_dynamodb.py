@@ -0,0 +1,132 @@
+"""
+In-memory stand-in for boto3's DynamoDB Table resource.
+
+Implements the part of the Table API storage.DynamoStorage uses (put_item,
+get_item, paginated scan and batch_writer) with DynamoDB's quirks that bite
+TangyBot: numbers come back as Decimal, floats are refused, and a scan
+returns one page at a time. Requests can be given a latency to imitate the
+round trip to aws, and are counted per operation.
+
+    tables = {resource: FakeDynamoTable(key_name) for resource, key_name in
+              storage.RESOURCE_KEY_NAMES.items()}
+    the_storage = storage.DynamoStorage(tables=tables)
+"""
+
+import collections
+import copy
+import decimal
+import time
+
+# Items per batch_write_item request, DynamoDB's limit
+BATCH_SIZE = 25
+
+
+def to_dynamodb(value):
+    """Convert a value the way boto3 serializes it, refusing floats."""
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return decimal.Decimal(value)
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types "
+                        "instead.")
+    if isinstance(value, dict):
+        return {key: to_dynamodb(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamodb(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return {to_dynamodb(item) for item in value}
+    if isinstance(value, (decimal.Decimal, bytes)):
+        return value
+    raise TypeError("Unsupported type " + type(value).__name__)
+
+
+class FakeDynamoTable:
+    """
+    A DynamoDB table with a single hash key, kept in memory.
+
+    Attributes
+    ----------
+    key_name: str
+        Name of the hash key attribute
+
+    latency: float
+        Seconds every request takes
+
+    page_size: int
+        Items per scan page, standing in for DynamoDB's 1MB pages
+
+    requests: Counter
+        Number of requests made per operation
+
+    """
+
+    def __init__(self, key_name, latency=0.0, page_size=100):
+        self.key_name = key_name
+        self.latency = latency
+        self.page_size = page_size
+        self.requests = collections.Counter()
+        self._items = {}
+
+    def _request(self, operation):
+        self.requests[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _store(self, item):
+        if self.key_name not in item:
+            raise ValueError("Item is missing its key " + self.key_name)
+        item = to_dynamodb(item)
+        self._items[item[self.key_name]] = item
+
+    def put_item(self, Item):
+        self._request("put_item")
+        self._store(Item)
+        return {}
+
+    def get_item(self, Key):
+        self._request("get_item")
+        item = self._items.get(to_dynamodb(Key[self.key_name]))
+        return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def scan(self, ExclusiveStartKey=None):
+        self._request("scan")
+        keys = list(self._items)
+        start = 0
+        if ExclusiveStartKey is not None:
+            start = keys.index(ExclusiveStartKey[self.key_name]) + 1
+        page = keys[start:start + self.page_size]
+        resp = dict(Items=[copy.deepcopy(self._items[key]) for key in page],
+                    Count=len(page))
+        if start + self.page_size < len(keys):
+            resp['LastEvaluatedKey'] = {self.key_name: page[-1]}
+        return resp
+
+    def batch_writer(self):
+        return _FakeBatchWriter(self)
+
+
+class _FakeBatchWriter:
+    """Buffers put_item calls into batch_write_item requests."""
+
+    def __init__(self, table):
+        self.table = table
+        self._buffer = []
+
+    def put_item(self, Item):
+        self._buffer.append(Item)
+        if len(self._buffer) >= BATCH_SIZE:
+            self._send()
+
+    def _send(self):
+        self.table._request("batch_write_item")
+        for item in self._buffer:
+            self.table._store(item)
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._buffer:
+            self._send()
@@ -0,0 +1,105 @@
+"""
+Micro-benchmarks of FrontendFormatter rendering.
+
+Renders a 10 player lookup and a 10 player x 20 hero profile built from the
+recorded fixtures, reporting time per render and peak memory allocated per
+render (traced by tracemalloc), with the render cache disabled, for fresh
+responses (render cache misses) and for repeats of the same response
+(render cache hits).
+
+    python -m bench.formatter_bench --repeat 2000
+"""
+
+import argparse
+import copy
+import json
+import time
+import tracemalloc
+
+from api_dispatch import project_account_heroes, project_account_info
+from bench.stub_upstream import load_fixture
+from frontend import FrontendFormatter
+
+PLAYERS = 10
+HEROES = 20
+
+
+def lookup_response():
+    """A lookup response for a full roster."""
+    player = project_account_info(
+        json.loads(load_fixture("opendota_player.json")))
+    players = {}
+    for index in range(PLAYERS):
+        steam_id = 103801408 + index
+        players[steam_id] = dict(copy.deepcopy(player),
+                                 csl_name="player" + str(index),
+                                 steam_name="steam" + str(index))
+    return dict(team_name="University of Michigan", players=players)
+
+
+def profile_response():
+    """A profile response for a full roster with HEROES heroes each."""
+    steam_heroes = json.loads(load_fixture("steam_get_heroes.json"))
+    names = {hero["id"]: hero["localized_name"] for hero in
+             steam_heroes["result"]["heroes"]}
+    records = project_account_heroes(
+        json.loads(load_fixture("opendota_heroes.json")))[:HEROES]
+    heroes = [dict(record._asdict(), loc_name=names[record.hero_id],
+                   winrate=record.win / record.games if record.games else 0)
+              for record in records]
+    players = {}
+    for index in range(PLAYERS):
+        players[103801408 + index] = dict(csl_name="player" + str(index),
+                                          steam_name="steam" + str(index),
+                                          heroes=copy.deepcopy(heroes))
+    return dict(players=players)
+
+
+def measure(render, responses):
+    """Time and trace allocations of render over responses."""
+    start = time.perf_counter()
+    for response in responses:
+        render(response)
+    elapsed = (time.perf_counter() - start) / len(responses)
+
+    tracemalloc.start()
+    peaks = []
+    for response in responses[:200]:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        render(response)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return elapsed, sum(peaks) / len(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=1000)
+    opts = parser.parse_args()
+
+    for command, make in (("lookup", lookup_response),
+                          ("profile", profile_response)):
+        template = make()
+        # Distinct responses, so every render misses the cache
+        fresh = []
+        for index in range(opts.repeat):
+            response = copy.deepcopy(template)
+            next(iter(response["players"].values()))["csl_name"] = \
+                "player" + str(index)
+            fresh.append(response)
+        repeated = [template] * opts.repeat
+
+        cached = FrontendFormatter()
+        for label, formatter, responses in (
+                ("nocache", FrontendFormatter(render_cache_size=0), fresh),
+                ("miss", cached, fresh), ("hit", cached, repeated)):
+            elapsed, peak = measure(
+                lambda resp: formatter.dispatch(command, resp), responses)
+            print("{:8s} {:7s} {:9.1f}us/render  {:9.0f} peak bytes "
+                  "allocated/render".format(command, label, 1e6 * elapsed,
+                                            peak))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""
+Outage checks of the upstream circuit breakers and stale-data fallback.
+
+Drives the real backend against bench.stub_upstream while taking CSL and
+OpenDota down: once the caches are warm and then expired, lookups and
+profiles must keep being answered from the stale entries (marked with their
+age), the breakers must open after their failure threshold so commands
+answer in milliseconds without touching the upstreams, a hanging upstream
+must not hold commands past their deadline, and the breakers must close
+again once the upstreams come back. A versus of players OpenDota cannot
+answer for must still format. Finally the upstreams flap up and down
+while commands keep coming, reporting breaker transitions and the requests
+the stub saw. Exits with status 1 if any check fails.
+
+    python -m bench.outage
+    python -m bench.outage --flap_period 0.2 --flap_seconds 5
+
+Persistent data is written to a temporary directory, never the working one.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+import aiohttp
+
+from bench.common import BackendRun, expect, expire_caches
+from bench.stub_upstream import StubUpstreams
+
+# Services the stub takes down, named as their breakers in api_dispatch
+SERVICES = ("csl", "opendota")
+
+
+def reset_breakers(opts):
+    """Give every upstream a fresh breaker with the configured limits."""
+    import api_dispatch
+    from circuit_breaker import CircuitBreaker
+
+    for service in SERVICES:
+        api_dispatch.BREAKERS[service] = CircuitBreaker(
+            service, failure_threshold=opts.threshold,
+            reset_timeout=opts.reset_timeout)
+
+
+def breaker_states():
+    import api_dispatch
+
+    return {service: api_dispatch.BREAKERS[service].state
+            for service in SERVICES}
+
+
+async def check_warm(run):
+    lookup, profile = await run.scout(run.opts.team)
+    for resp in (lookup, profile):
+        expect(all('stale_age' not in player and 'status' not in player
+                   for player in resp['players'].values()),
+               "players are stale or missing with every upstream up")
+    expect('roster_age' not in lookup, "roster is stale with CSL up")
+
+
+async def check_error_outage(run):
+    expire_caches(run.the_tangy)
+    run.stub.outages = dict.fromkeys(SERVICES, "error")
+    # Enough failed commands to open every breaker
+    for _ in range(run.opts.threshold):
+        lookup, profile = await run.scout(run.opts.team)
+        expect('roster_age' in lookup, "lookup is missing its roster age")
+        for resp in (lookup, profile):
+            expect(all('stale_age' in player
+                       for player in resp['players'].values()),
+                   "players are not answered from stale data")
+    expect(set(breaker_states().values()) == {"open"},
+           "breakers are not open: " + str(breaker_states()))
+
+    requests = run.stub_requests()
+    resp, elapsed = await run.command("lookup", str(run.opts.team))
+    print("    fail fast lookup {:.2f}ms, roster {:.0f}s old".format(
+        1000 * elapsed, resp['roster_age']))
+    expect(elapsed < run.opts.fail_fast_ms / 1000,
+           "lookup took {:.2f}ms with open breakers".format(1000 * elapsed))
+    expect(run.stub_requests() == requests,
+           "open breakers let requests through")
+
+
+async def check_uncached_outage(run):
+    # Nothing stale to fall back on, the error must say what is down
+    try:
+        await run.command("lookup", str(run.opts.team + 1))
+    except Exception as err:
+        expect("csl is unavailable" in str(err),
+               "unexpected error without stale data: " + repr(err))
+    else:
+        expect(False, "lookup of an uncached team succeeded during outage")
+
+
+async def check_recovery(run):
+    run.stub.outages = {}
+    await asyncio.sleep(run.opts.reset_timeout)
+    # The first command only probes, the next one gets everything fresh
+    await run.scout(run.opts.team)
+    expect(set(breaker_states().values()) == {"closed"},
+           "breakers did not close: " + str(breaker_states()))
+    lookup, profile = await run.scout(run.opts.team)
+    expect('roster_age' not in lookup, "roster still stale after recovery")
+    for resp in (lookup, profile):
+        expect(all('stale_age' not in player
+                   for player in resp['players'].values()),
+               "players still stale after recovery")
+
+
+async def check_versus_unavailable(run):
+    from frontend import FrontendFormatter
+
+    # Players known from earlier lookups, with nothing stale to fall back on
+    for cache_name in ("account", "heroes"):
+        run.the_tangy.caches[cache_name].clear()
+    run.stub.outages = {"opendota": "error"}
+    try:
+        resp, _ = await run.command("versus", str(run.opts.team),
+                                    str(run.opts.team + 1))
+        expect(all('status' in player for team in resp['teams']
+                   for player in team['players'].values()),
+               "players are not marked missing with OpenDota down")
+        expect(any('rank_tier' in player
+                   for player in resp['teams'][0]['players'].values()),
+               "no missing player has a remembered rank")
+        FrontendFormatter().dispatch("versus", resp)
+    finally:
+        run.stub.outages = {}
+    reset_breakers(run.opts)
+    await run.scout(run.opts.team)
+
+
+async def check_hang_outage(run):
+    expire_caches(run.the_tangy)
+    run.stub.outages = dict.fromkeys(SERVICES, "hang")
+    deadline = run.opts.deadline_ms / 1000
+    run.the_tangy.deadline = deadline
+    try:
+        elapsed = []
+        for _ in range(run.opts.threshold + 1):
+            lookup, took = await run.command("lookup", str(run.opts.team))
+            elapsed.append(took)
+            expect('roster_age' in lookup, "hung CSL gave no stale roster")
+        print("    lookups " + " ".join("{:.0f}ms".format(1000 * took)
+                                        for took in elapsed))
+        expect(max(elapsed) < deadline + 0.25,
+               "a lookup overran its deadline by more than 250ms")
+        expect(breaker_states()['csl'] == "open",
+               "hung CSL did not open its breaker")
+        expect(elapsed[-1] < run.opts.fail_fast_ms / 1000,
+               "lookup still waits on a hung CSL with its breaker open")
+    finally:
+        run.stub.outages = {}
+        run.the_tangy.deadline = run.opts.deadline_ms / 1000 * 10
+    # Failed probes have kept the breakers open longer, start over
+    reset_breakers(run.opts)
+    await run.scout(run.opts.team)
+
+
+async def check_flapping(run):
+    import api_dispatch
+    from metrics import CIRCUIT_REJECTIONS, CIRCUIT_TRANSITIONS
+
+    teams = [run.opts.team + offset for offset in range(run.opts.teams)]
+    for team in teams:
+        await run.scout(team)
+    transitions = dict(CIRCUIT_TRANSITIONS.samples())
+    rejections = dict(CIRCUIT_REJECTIONS.samples())
+    run.stub.reset_counts()
+
+    async def flap():
+        down = False
+        while True:
+            await asyncio.sleep(run.opts.flap_period)
+            down = not down
+            run.stub.outages = (dict.fromkeys(SERVICES, "error") if down
+                                else {})
+
+    answered = failed = stale = 0
+    flapper = asyncio.ensure_future(flap())
+    end = time.perf_counter() + run.opts.flap_seconds
+    try:
+        while time.perf_counter() < end:
+            for team in teams:
+                expire_caches(run.the_tangy)
+                try:
+                    responses = await run.scout(team)
+                except Exception as err:
+                    failed += 1
+                    print("    command failed:", repr(err))
+                    continue
+                answered += 1
+                stale += sum('stale_age' in player for resp in responses
+                             for player in resp['players'].values())
+    finally:
+        flapper.cancel()
+        run.stub.outages = {}
+
+    print("    {} scouts answered, {} failed, {} stale players".format(
+        answered, failed, stale))
+    for service in SERVICES:
+        moves = {state: count - transitions.get((service, state), 0)
+                 for (name, state), count in CIRCUIT_TRANSITIONS.samples()
+                 if name == service}
+        print("    {:9s} transitions {}  rejected {}  now {}".format(
+            service, moves,
+            dict(CIRCUIT_REJECTIONS.samples()).get((service,), 0) -
+            rejections.get((service,), 0),
+            api_dispatch.BREAKERS[service].state))
+    print("    stub requests", run.stub.counts, " errors", run.stub.errors)
+    expect(failed == 0, "commands failed while the upstreams flapped")
+
+
+CHECKS = (check_warm, check_error_outage, check_uncached_outage,
+          check_recovery, check_versus_unavailable, check_hang_outage,
+          check_flapping)
+
+
+async def run_checks(opts):
+    """Run every check in order, returning the failed ones."""
+    stub = StubUpstreams(latency=opts.latency, seed=opts.seed)
+    stub.start_in_thread()
+    stub.patch_urls()
+    reset_breakers(opts)
+
+    from backend import TangyBotBackend
+
+    failed = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            the_tangy = TangyBotBackend(backend="file", session=session)
+            the_tangy.deadline = opts.deadline_ms / 1000 * 10
+            run = BackendRun(the_tangy, stub, opts, "outage")
+            for check in CHECKS:
+                try:
+                    await check(run)
+                except Exception:
+                    failed.append(check.__name__)
+                    print("  FAIL", check.__name__)
+                    traceback.print_exc(file=sys.stdout)
+                    # Later checks expect the upstreams up and breakers
+                    # closed
+                    stub.outages = {}
+                    reset_breakers(opts)
+                else:
+                    print("  ok  ", check.__name__)
+            await the_tangy.close()
+    finally:
+        stub.outages = {}
+        stub.stop()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--team", type=int, default=839)
+    parser.add_argument("--teams", type=int, default=4,
+                        help="Number of distinct teams scouted while "
+                             "flapping")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="Mean stub latency in seconds")
+    parser.add_argument("--threshold", type=int, default=5,
+                        help="Outages in a row that open a breaker")
+    parser.add_argument("--reset_timeout", type=float, default=0.5,
+                        help="Seconds a breaker stays open before probing")
+    parser.add_argument("--deadline_ms", type=float, default=500,
+                        help="Deadline per command while an upstream hangs")
+    parser.add_argument("--fail_fast_ms", type=float, default=50,
+                        help="Longest a command may take with open breakers")
+    parser.add_argument("--flap_period", type=float, default=0.3,
+                        help="Seconds the upstreams stay up or down")
+    parser.add_argument("--flap_seconds", type=float, default=3,
+                        help="Seconds to keep the upstreams flapping")
+    parser.add_argument("--seed", type=int, default=570)
+    opts = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="tangybot-outage-"))
+    failed = asyncio.run(run_checks(opts))
+    if failed:
+        print("Outage checks failed:", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
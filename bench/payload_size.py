@@ -0,0 +1,79 @@
+"""
+Bytes retained per player for raw and projected OpenDota payloads.
+
+Parses the recorded /players/{id} and /players/{id}/heroes fixtures for
+--players players, once keeping the responses as OpenDota sends them and
+once projecting them the way api_dispatch does, and reports per player the
+memory the kept objects take (traced by tracemalloc), their pickled size
+(what snapshots and the render cache fingerprint pay for) and the time to
+deep copy them.
+
+    python -m bench.payload_size --players 500
+"""
+
+import argparse
+import copy
+import gc
+import json
+import pickle
+import time
+import tracemalloc
+
+from api_dispatch import project_account_heroes, project_account_info
+from bench.stub_upstream import load_fixture
+
+
+def retained(parse, count):
+    """
+    Parse count payloads, keeping the results.
+
+    Returns
+    -------
+    kept: list
+        The parsed payloads
+
+    per_item: float
+        Bytes of memory still allocated per payload once parsing is done
+
+    """
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    kept = [parse() for _ in range(count)]
+    gc.collect()
+    per_item = (tracemalloc.get_traced_memory()[0] - base) / count
+    tracemalloc.stop()
+    return kept, per_item
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--players", type=int, default=500)
+    opts = parser.parse_args()
+
+    payloads = dict(account=load_fixture("opendota_player.json"),
+                    heroes=load_fixture("opendota_heroes.json"))
+    projections = dict(account=project_account_info,
+                       heroes=project_account_heroes)
+
+    print("{:8s} {:10s} {:>12s} {:>12s} {:>12s}".format(
+        "payload", "form", "memory B", "pickle B", "deepcopy us"))
+    for name, payload in payloads.items():
+        project = projections[name]
+        for form, parse in (("raw", lambda: json.loads(payload)),
+                            ("projected",
+                             lambda: project(json.loads(payload)))):
+            kept, memory = retained(parse, opts.players)
+            # One by one: pickling the list would memoize the keys projected
+            # payloads have in common, which raw ones each parse anew
+            pickled = sum(len(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+                          for item in kept)
+            start = time.perf_counter()
+            copy.deepcopy(kept)
+            copy_time = (time.perf_counter() - start) / opts.players
+            print("{:8s} {:10s} {:12.0f} {:12.0f} {:12.1f}".format(
+                name, form, memory, pickled / opts.players, 1e6 * copy_time))
+
+
+if __name__ == "__main__":
+    main()
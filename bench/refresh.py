@@ -0,0 +1,176 @@
+"""
+Checks of the background refresher (see refresh.py).
+
+Drives the real backend against bench.stub_upstream with short cache TTLs:
+a team scouted once must still be answered entirely from cache, without a
+single upstream request, after its entries would have expired; the
+refresher must stay quiet while commands keep coming, even with entries
+due; once idle it must not go over its request budget; and entries nobody
+asked for within the window must be forgotten. Exits with status 1 if any
+check fails.
+
+    python -m bench.refresh
+    python -m bench.refresh --ttl 4 --lead 3 --budget 1200
+
+Persistent data is written to a temporary directory, never the working one.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+import aiohttp
+
+from bench.common import BackendRun, expect, expire_caches
+from bench.stub_upstream import StubUpstreams
+
+
+class RefreshRun(BackendRun):
+    """BackendRun that also keeps the backend's refresher at hand."""
+
+    def __init__(self, the_tangy, stub, opts):
+        super(RefreshRun, self).__init__(the_tangy, stub, opts, "refresh")
+        self.refresher = the_tangy.refresher
+
+
+async def check_ahead_of_expiry(run):
+    team = run.opts.team
+    await run.scout(team)
+    tracked = len(run.refresher)
+    await asyncio.sleep(run.opts.ttl + 0.5)
+
+    requests = run.stub_requests()
+    start = time.perf_counter()
+    lookup, profile = await run.scout(team)
+    elapsed = time.perf_counter() - start
+    print("    {} entries tracked, {} refreshed, scout after the TTL "
+          "{:.1f}ms".format(tracked, run.refresher.refreshed,
+                            1000 * elapsed))
+    expect(run.refresher.refreshed >= tracked,
+           "not every tracked entry was refreshed")
+    expect(run.stub_requests() == requests,
+           "scouting after the TTL made {} upstream requests".format(
+               run.stub_requests() - requests))
+    expect('roster_age' not in lookup, "roster is stale")
+
+
+async def check_quiet_while_busy(run):
+    # A second team whose entries are all due while the first one is busy
+    await run.scout(run.opts.team + 1)
+    expire_caches(run.the_tangy)
+    await run.scout(run.opts.team)
+    refreshed = run.refresher.refreshed
+    commands = 0
+    end = time.perf_counter() + run.opts.busy_seconds
+    while time.perf_counter() < end:
+        await run.command("lookup", str(run.opts.team))
+        commands += 1
+    print("    {} commands in {:.1f}s, {} refreshes meanwhile".format(
+        commands, run.opts.busy_seconds, run.refresher.refreshed - refreshed))
+    expect(run.refresher.refreshed == refreshed,
+           "the refresher ran while commands kept coming")
+
+
+async def check_budget(run):
+    from refresh import QUIET_PERIOD
+
+    # The second team's entries are still due from the last check, but
+    # TangyBot only counts as idle once the last command is long enough ago
+    await asyncio.sleep(QUIET_PERIOD)
+    run.stub.reset_counts()
+    refreshed = run.refresher.refreshed
+    start = time.perf_counter()
+    await asyncio.sleep(run.opts.budget_seconds)
+    elapsed = time.perf_counter() - start
+    allowed = run.opts.budget * elapsed / 60 + 1
+    done = run.refresher.refreshed - refreshed
+    print("    {} refreshes and {} upstream requests in {:.1f}s, "
+          "budget {:.0f}".format(done, run.stub_requests(), elapsed,
+                                 allowed))
+    expect(done > 0, "nothing was refreshed once idle")
+    expect(run.stub_requests() <= allowed,
+           "the refresher went over its request budget")
+
+
+async def check_window(run):
+    run.refresher.window = run.opts.window
+    await asyncio.sleep(run.opts.window + 60 / run.opts.budget)
+    refreshed = run.refresher.refreshed
+    await asyncio.sleep(run.opts.ttl)
+    print("    {} entries tracked after the window".format(len(run.refresher)))
+    expect(len(run.refresher) == 0, "entries outlived the window")
+    expect(run.refresher.refreshed == refreshed,
+           "entries were refreshed after the window")
+
+
+CHECKS = (check_ahead_of_expiry, check_quiet_while_busy, check_budget,
+          check_window)
+
+
+async def run_checks(opts):
+    """Run every check in order, returning the failed ones."""
+    stub = StubUpstreams(latency=opts.latency, seed=opts.seed)
+    stub.start_in_thread()
+    stub.patch_urls()
+
+    from backend import TangyBotBackend
+    from refresh import Refresher
+
+    failed = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            the_tangy = TangyBotBackend(backend="file", session=session)
+            for cache in the_tangy.caches.values():
+                cache.ttl = opts.ttl
+            the_tangy.refresher = Refresher(the_tangy, budget=opts.budget,
+                                            lead=opts.lead)
+            the_tangy.start_refresher()
+            run = RefreshRun(the_tangy, stub, opts)
+            for check in CHECKS:
+                try:
+                    await check(run)
+                except Exception:
+                    failed.append(check.__name__)
+                    print("  FAIL", check.__name__)
+                    traceback.print_exc(file=sys.stdout)
+                else:
+                    print("  ok  ", check.__name__)
+            await the_tangy.close()
+    finally:
+        stub.stop()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--team", type=int, default=839)
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="Mean stub latency in seconds")
+    parser.add_argument("--ttl", type=float, default=4,
+                        help="Seconds every cache entry stays fresh")
+    parser.add_argument("--lead", type=float, default=3,
+                        help="Seconds before expiry entries are refreshed")
+    parser.add_argument("--budget", type=float, default=1200,
+                        help="Most refresh requests per minute")
+    parser.add_argument("--busy_seconds", type=float, default=2,
+                        help="Seconds to keep commands coming")
+    parser.add_argument("--budget_seconds", type=float, default=1,
+                        help="Seconds to count refresh requests over")
+    parser.add_argument("--window", type=float, default=1,
+                        help="Refresh window of the last check, in seconds")
+    parser.add_argument("--seed", type=int, default=570)
+    opts = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="tangybot-refresh-"))
+    failed = asyncio.run(run_checks(opts))
+    if failed:
+        print("Refresh checks failed:", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
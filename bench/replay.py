@@ -0,0 +1,232 @@
+"""
+Offline replay benchmark of TangyBotBackend.dispatch against stub upstreams.
+
+Every simulated user replays a scouting session (lookup <team>, profile
+--last, stalk) through the real backend, whose upstream URLs point at the
+local stub in bench.stub_upstream. Sessions are run at each requested
+concurrency level, reporting throughput, latency percentiles per command and
+the number of upstream requests made, as well as the longest the event loop
+was blocked (with a stack for every stall, see loop_watchdog.py), players
+left out of responses by the deadline and hedged requests sent.
+
+    python -m bench.replay --concurrency 1,8,32 --sessions 64 --latency 0.05
+    python -m bench.replay --save new.json --baseline old.json
+    python -m bench.replay --slow_rate 0.02 --deadline_ms 2000
+
+Persistent data is written to a temporary directory, never the working one.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from urllib.error import HTTPError
+
+import aiohttp
+
+from bench.common import latency_summary, percentile
+from bench.stub_upstream import StubUpstreams
+
+# Commands of a single scouting session, {team} is filled in per session
+SESSION_COMMANDS = (["lookup", "{team}"],
+                    ["profile", "--last", "-n", "20"],
+                    ["stalk"])
+
+
+async def _run_session(the_tangy, arg_parse, username, team, latencies,
+                       errors, partial):
+    from backend import TangyBotError
+
+    for argv in SESSION_COMMANDS:
+        args = arg_parse.parse_args([arg.format(team=team) for arg in argv])
+        start = time.perf_counter()
+        try:
+            resp = await the_tangy.dispatch(args, username)
+            for player in resp.get('players', {}).values():
+                if 'status' in player:
+                    partial[player['status']] = \
+                        partial.get(player['status'], 0) + 1
+        except (TangyBotError, HTTPError, aiohttp.ClientError):
+            errors[args.command] = errors.get(args.command, 0) + 1
+            # Later commands of the session depend on this one
+            return
+        finally:
+            latencies.setdefault(args.command, []).append(
+                time.perf_counter() - start)
+
+
+def _hedge_count():
+    from metrics import UPSTREAM_HEDGES
+
+    return sum(count for _, count in UPSTREAM_HEDGES.samples())
+
+
+async def run_level(the_tangy, stub, watchdog, concurrency, sessions, teams,
+                    warm):
+    """
+    Replay sessions with at most concurrency sessions running at once.
+
+    Returns
+    -------
+    result: dict
+        Throughput, latencies and upstream counts of this level
+
+    """
+    from cli import TangyBotArgParse
+
+    if not warm:
+        for cache in the_tangy.caches.values():
+            cache.clear()
+    stub.reset_counts()
+    watchdog.reset()
+
+    arg_parse = TangyBotArgParse()
+    queue = asyncio.Queue()
+    for session in range(sessions):
+        queue.put_nowait(session)
+
+    latencies = {}
+    errors = {}
+    partial = {}
+    hedges = _hedge_count()
+
+    async def worker():
+        while not queue.empty():
+            session = queue.get_nowait()
+            await _run_session(the_tangy, arg_parse, "user" + str(session),
+                               teams[session % len(teams)], latencies, errors,
+                               partial)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    commands = sum(len(samples) for samples in latencies.values())
+    return dict(
+        concurrency=concurrency, sessions=sessions, elapsed=elapsed,
+        throughput=commands / elapsed,
+        latency={command: dict(p50=percentile(samples, 50),
+                               p95=percentile(samples, 95),
+                               p99=percentile(samples, 99),
+                               count=len(samples))
+                 for command, samples in latencies.items()},
+        samples=latencies, errors=errors, upstream=dict(stub.counts),
+        partial=partial, hedges=_hedge_count() - hedges,
+        max_loop_lag=watchdog.max_lag, loop_stalls=watchdog.stalls)
+
+
+def print_level(result, baseline=None):
+    """Print the result of one level, with deltas against baseline."""
+    print("concurrency {concurrency:4d}  sessions {sessions}  "
+          "elapsed {elapsed:.2f}s  throughput {throughput:.1f} cmd/s".format(
+              **result))
+    if baseline:
+        change = result["throughput"] / baseline["throughput"] - 1
+        print("    throughput vs baseline {:+.1%}".format(change))
+    for command, samples in sorted(result["samples"].items()):
+        line = "    {:8s} {}".format(command, latency_summary(samples))
+        if baseline and command in baseline["latency"]:
+            old = baseline["latency"][command]["p95"]
+            new = result["latency"][command]["p95"]
+            line += "  p95 vs baseline {:+.1%}".format(new / old - 1)
+        print(line)
+    print("    upstream requests", dict(sorted(result["upstream"].items())))
+    print("    max loop lag {:.1f}ms  stalls {}".format(
+        1000 * result["max_loop_lag"], result["loop_stalls"]))
+    if result["errors"]:
+        print("    errors", result["errors"])
+    if result.get("partial") or result.get("hedges"):
+        print("    players left out", result["partial"], " hedged requests",
+              result["hedges"])
+
+
+async def run(opts):
+    """Run the benchmark at every concurrency level."""
+    stub = StubUpstreams(latency=opts.latency, jitter=opts.jitter,
+                         error_rate=opts.error_rate, seed=opts.seed,
+                         slow_rate=opts.slow_rate,
+                         slow_latency=opts.slow_latency)
+    stub.start_in_thread()
+    stub.patch_urls()
+
+    from backend import TangyBotBackend
+    from loop_watchdog import LoopWatchdog
+
+    watchdog = LoopWatchdog(opts.stall_ms / 1000)
+    watchdog.start()
+    results = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            the_tangy = TangyBotBackend(backend="file", session=session)
+            if opts.deadline_ms is not None:
+                the_tangy.deadline = opts.deadline_ms / 1000 or None
+            teams = list(range(opts.first_team,
+                               opts.first_team + opts.teams))
+            for concurrency in opts.concurrency:
+                results.append(await run_level(the_tangy, stub, watchdog,
+                                               concurrency, opts.sessions,
+                                               teams, opts.warm))
+            await the_tangy.persist.flush()
+    finally:
+        watchdog.stop()
+        stub.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", default="1,8,32",
+                        type=lambda val: [int(x) for x in val.split(",")],
+                        help="Comma separated concurrency levels")
+    parser.add_argument("--sessions", type=int, default=32,
+                        help="Scouting sessions replayed per level")
+    parser.add_argument("--teams", type=int, default=8,
+                        help="Number of distinct teams looked up")
+    parser.add_argument("--first_team", type=int, default=839)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Mean stub latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02,
+                        help="Standard deviation of stub latency in seconds")
+    parser.add_argument("--error_rate", type=float, default=0.0,
+                        help="Probability of a stub request failing")
+    parser.add_argument("--slow_rate", type=float, default=0.0,
+                        help="Probability of a stub request being slow")
+    parser.add_argument("--slow_latency", type=float, default=5.0,
+                        help="Extra seconds a slow stub request takes")
+    parser.add_argument("--deadline_ms", type=float,
+                        help="Deadline per command, 0 for none, default "
+                             "TANGYBOT_DEADLINE_MS")
+    parser.add_argument("--seed", type=int, default=570)
+    parser.add_argument("--warm", action="store_true",
+                        help="Keep backend caches between levels")
+    parser.add_argument("--stall_ms", type=float, default=20,
+                        help="Report event loop stalls longer than this")
+    parser.add_argument("--save", help="Write results as json to this path")
+    parser.add_argument("--baseline",
+                        help="Compare against results saved by --save")
+    opts = parser.parse_args()
+
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline) as baseline_file:
+            baseline = {level["concurrency"]: level for level in
+                        json.load(baseline_file)}
+
+    save_path = opts.save and os.path.abspath(opts.save)
+    os.chdir(tempfile.mkdtemp(prefix="tangybot-bench-"))
+    results = asyncio.run(run(opts))
+
+    for result in results:
+        print_level(result, baseline.get(result["concurrency"]))
+
+    if save_path:
+        for result in results:
+            del result["samples"]
+        with open(save_path, "w") as out:
+            json.dump(results, out, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Load test for the REST frontend against a local stub backend.
+
+The stub backend answers every command after a random delay, with canned
+responses of realistic size, so the numbers measure the REST layer itself:
+argument parsing, concurrency limiting, json encoding, ETags and gzip.
+
+    python -m bench.rest_load --clients 64 --duration 10 --max_concurrency 8
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+
+from bench.common import latency_summary
+from cache import TTLCache
+from rest_api import TangyBotRestServer
+
+
+def _fake_player(steam_id):
+    return dict(csl_name="player" + str(steam_id),
+                steam_name="steam" + str(steam_id),
+                personaname="steam" + str(steam_id),
+                solo_competitive_rank=None, rank_tier=54,
+                leaderboard_rank=None, mmr_estimate=3500)
+
+
+class StubBackend:
+    """Stand-in for TangyBotBackend with a fixed latency distribution."""
+
+    def __init__(self, latency, jitter):
+        self.latency = latency
+        self.jitter = jitter
+        self.roster_cache = TTLCache("roster", 60)
+        self.dispatched = 0
+
+    async def dispatch(self, args, username="user"):
+        self.dispatched += 1
+        cached = self.roster_cache.get(args.command)
+        await asyncio.sleep(max(0.0, random.gauss(self.latency,
+                                                  self.jitter)))
+        if cached is None:
+            self.roster_cache.put(args.command, True)
+        players = {steam_id: _fake_player(steam_id)
+                   for steam_id in range(100, 110)}
+        if args.command == "lookup":
+            return dict(team_name="Stub University", players=players)
+        elif args.command == "profile":
+            heroes = [dict(hero_id=i, loc_name="Hero " + str(i), games=20 - i,
+                           win=10, winrate=10 / (20 - i)) for i in range(5)]
+            return dict(players={steam_id: {**player, "heroes": heroes}
+                                 for steam_id, player in players.items()})
+        return dict(users={username: dict(last_team=839, last_players=None)})
+
+
+async def _client(session, base_url, deadline, latencies, statuses):
+    paths = ["/lookup?team_number=839", "/profile?last=1",
+             "/profile?profiles=100,101&num_games=20", "/stalk"]
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        async with session.get(base_url + random.choice(paths),
+                               headers={"Accept-Encoding": "gzip"}) as resp:
+            await resp.read()
+        latencies.append(time.perf_counter() - start)
+        statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+
+async def run(clients, duration, max_concurrency, latency, jitter, port):
+    """Run the load test and print a report."""
+    backend = StubBackend(latency, jitter)
+    server = TangyBotRestServer(backend, max_concurrency=max_concurrency,
+                                max_waiting=4 * clients)
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    latencies = []
+    statuses = {}
+    connector = aiohttp.TCPConnector(limit=clients)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            start = time.perf_counter()
+            deadline = start + duration
+            await asyncio.gather(*(_client(session,
+                                           "http://127.0.0.1:" + str(port),
+                                           deadline, latencies, statuses)
+                                   for _ in range(clients)))
+            elapsed = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+
+    print("clients {}  max_concurrency {}  duration {:.1f}s".format(
+        clients, max_concurrency, elapsed))
+    print("requests {}  throughput {:.1f} req/s".format(
+        len(latencies), len(latencies) / elapsed))
+    print("latency", latency_summary(latencies))
+    print("statuses", dict(sorted(statuses.items())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--max_concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Mean stub backend latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.005,
+                        help="Standard deviation of stub latency in seconds")
+    parser.add_argument("--port", type=int, default=8089)
+    opts = parser.parse_args()
+    asyncio.run(run(opts.clients, opts.duration, opts.max_concurrency,
+                    opts.latency, opts.jitter, opts.port))
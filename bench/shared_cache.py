@@ -0,0 +1,203 @@
+"""
+Checks of the cache tier shared between processes (see shared_cache.py).
+
+Runs the real backend in separate worker processes, all pointed at
+bench.stub_upstream and one shared cache file: a team scouted by one
+process must be scouted by the next without a single upstream request,
+and answered from the shared tier; processes scouting the same teams at
+once must all succeed and leave the database intact; and an entry must
+never be replaced by one fetched earlier. Exits with status 1 if any check
+fails.
+
+    python -m bench.shared_cache
+    python -m bench.shared_cache --workers 8 --teams 839 840 841
+
+Each worker keeps its persistent data in its own temporary directory, never
+the working one.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import traceback
+
+from bench.common import expect
+from bench.stub_upstream import StubUpstreams, patch_urls
+
+
+class SharedRun:
+    """Stub, shared cache file and worker helpers shared by the checks."""
+
+    def __init__(self, stub, opts):
+        self.stub = stub
+        self.opts = opts
+        self.directory = tempfile.mkdtemp(prefix="tangybot-shared-")
+        self.path = os.path.join(self.directory, "shared.sqlite")
+        self.started = 0
+
+    def spawn(self, teams):
+        """Start a worker process scouting teams."""
+        self.started += 1
+        cwd = os.path.join(self.directory, "worker{}".format(self.started))
+        os.mkdir(cwd)
+        env = dict(os.environ, TANGYBOT_SHARED_CACHE=self.path,
+                   PYTHONPATH=os.pathsep.join(filter(None, (
+                       os.getcwd(), os.environ.get("PYTHONPATH")))))
+        return subprocess.Popen(
+            [sys.executable, "-m", "bench.shared_cache", "--worker",
+             "--base_url", self.stub.base_url, "--teams"] +
+            [str(team) for team in teams],
+            cwd=cwd, env=env, stdout=subprocess.PIPE, text=True)
+
+    @staticmethod
+    def result(worker):
+        """Wait for a worker, returning the summary it printed last."""
+        output, _ = worker.communicate()
+        expect(worker.returncode == 0,
+               "worker exited with {}".format(worker.returncode))
+        return json.loads(output.strip().splitlines()[-1])
+
+    def scout(self, teams):
+        return self.result(self.spawn(teams))
+
+    def stub_requests(self):
+        return sum(self.stub.counts.values())
+
+
+def check_second_process_hits(run):
+    team = run.opts.teams[0]
+    first = run.scout([team])
+    requests = run.stub_requests()
+    second = run.scout([team])
+    print("    first process {} upstream requests, lookups {}".format(
+        requests, first['lookups']))
+    print("    second process {} upstream requests, lookups {}".format(
+        run.stub_requests() - requests, second['lookups']))
+    expect(not first['failed'] and not second['failed'], "a command failed")
+    expect(run.stub_requests() == requests,
+           "the second process made {} upstream requests".format(
+               run.stub_requests() - requests))
+    expect(second['lookups'].get('shared', 0) > 0,
+           "the second process had no shared hits")
+
+
+def check_concurrent_writers(run):
+    run.stub.reset_counts()
+    workers = [run.spawn(run.opts.teams) for _ in range(run.opts.workers)]
+    results = [run.result(worker) for worker in workers]
+    failed = sum(result['failed'] for result in results)
+    with sqlite3.connect(run.path) as db:
+        integrity = db.execute("PRAGMA integrity_check").fetchone()[0]
+        entries = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+    print("    {} workers, {} failed commands, {} upstream requests, {} "
+          "entries, integrity {}".format(run.opts.workers, failed,
+                                         run.stub_requests(), entries,
+                                         integrity))
+    expect(failed == 0, "commands failed with concurrent writers")
+    expect(integrity == "ok", "the shared cache is corrupt")
+
+
+def check_newer_wins(run):
+    from shared_cache import SharedCache
+
+    async def write_both():
+        shared = SharedCache(run.path)
+        try:
+            shared.put('account', -1, 200.0, 800.0, "newer")
+            shared.put('account', -1, 100.0, 700.0, "older")
+            return await shared.get('account', -1)
+        finally:
+            await shared.close()
+
+    entry = asyncio.run(write_both())
+    print("    entry after a late write of an older fetch:", entry)
+    expect(entry == (200.0, 800.0, "newer"),
+           "an older fetch replaced a newer one")
+
+
+CHECKS = (check_second_process_hits, check_concurrent_writers,
+          check_newer_wins)
+
+
+def run_checks(opts):
+    """Run every check in order, returning the failed ones."""
+    stub = StubUpstreams(latency=opts.latency, seed=opts.seed)
+    stub.start_in_thread()
+
+    failed = []
+    try:
+        run = SharedRun(stub, opts)
+        for check in CHECKS:
+            try:
+                check(run)
+            except Exception:
+                failed.append(check.__name__)
+                print("  FAIL", check.__name__)
+                traceback.print_exc(file=sys.stdout)
+            else:
+                print("  ok  ", check.__name__)
+    finally:
+        stub.stop()
+    return failed
+
+
+async def scout_teams(opts):
+    """Worker process: look up and profile teams, printing a summary."""
+    import aiohttp
+
+    from backend import TangyBotBackend
+    from cli import TangyBotArgParse
+    from metrics import CACHE_LOOKUPS
+
+    patch_urls(opts.base_url)
+    arg_parse = TangyBotArgParse()
+    failed = 0
+    async with aiohttp.ClientSession() as session:
+        the_tangy = TangyBotBackend(backend="file", session=session)
+        for team in opts.teams:
+            for argv in (["lookup", str(team)],
+                         ["profile", "--last", "-n", "20"]):
+                try:
+                    await the_tangy.dispatch(arg_parse.parse_args(argv),
+                                             "shared")
+                except Exception:
+                    failed += 1
+                    traceback.print_exc()
+        await the_tangy.close()
+    lookups = collections.Counter()
+    for (_, result), count in CACHE_LOOKUPS.samples():
+        lookups[result] += count
+    print(json.dumps(dict(failed=failed, lookups=lookups)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--teams", type=int, nargs="+",
+                        default=[839, 840, 841])
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Processes scouting at once")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="Mean stub latency in seconds")
+    parser.add_argument("--seed", type=int, default=570)
+    parser.add_argument("--worker", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--base_url", help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.worker:
+        asyncio.run(scout_teams(opts))
+        return
+    failed = run_checks(opts)
+    if failed:
+        print("Shared cache checks failed:", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
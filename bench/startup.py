@@ -0,0 +1,140 @@
+"""
+Startup time budget of TangyBot's entry points.
+
+Imports each entry point module in fresh interpreters under -X importtime,
+and reports its cumulative import time (best of --repeat runs) with the
+slowest of the imports it makes itself. Exits with status 1 if an entry
+point goes over its budget, or imports one of the dependencies that should
+only be imported on first use (LAZY_MODULES).
+
+    python -m bench.startup
+    python -m bench.startup --entry cli --budget cli=0.05 --top 15
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+# Seconds of import time each entry point may take, about twice what they
+# took when these were set (cli and daemon ~40ms, backend and the frontends
+# ~150ms besides discord itself)
+BUDGETS = dict(cli=0.1, daemon=0.1, backend=0.3, discord_bot=0.5,
+               slack_bot=0.3, rest_api=0.3)
+
+# Dependencies that entry points must not import at startup
+LAZY_MODULES = ("boto3", "botocore", "bs4", "lxml", "requests")
+
+
+def parse_importtime(output):
+    """
+    Parse -X importtime output into trees of imports.
+
+    Returns
+    -------
+    roots: list of dict
+        Top level imports with name, self and cumulative (in seconds) and
+        children, the imports they made
+
+    """
+    # Imports are printed after their children, which are one level deeper
+    pending = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        pending.setdefault(depth, []).append(dict(
+            name=name.strip(), self=int(self_us) / 1e6,
+            cumulative=int(cumulative_us) / 1e6,
+            children=pending.pop(depth + 1, [])))
+    return pending.get(0, [])
+
+
+def _walk(nodes):
+    for node in nodes:
+        yield node
+        yield from _walk(node['children'])
+
+
+def measure(module):
+    """
+    Import module in a fresh interpreter.
+
+    Returns
+    -------
+    wall: float
+        Seconds the interpreter ran for
+
+    node: dict or None
+        The import tree of module, None if importing it failed
+
+    error: str
+        What the interpreter printed besides import times
+
+    """
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                           "import " + module],
+                          capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    roots = parse_importtime(proc.stderr)
+    node = next((root for root in roots if root['name'] == module), None)
+    error = "\n".join(line for line in proc.stderr.splitlines()
+                      if not line.startswith("import time:"))
+    return wall, node if proc.returncode == 0 else None, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--entry", action="append",
+                        help="Entry point module to measure, default all of "
+                             + ", ".join(BUDGETS))
+    parser.add_argument("--budget", action="append", default=[],
+                        help="Override a budget, i.e. cli=0.05 (seconds)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8,
+                        help="Number of slowest direct imports to list")
+    opts = parser.parse_args()
+
+    budgets = dict(BUDGETS)
+    for item in opts.budget:
+        name, seconds = item.split("=")
+        budgets[name] = float(seconds)
+
+    baseline = min(measure("sys")[0] for _ in range(opts.repeat))
+    print("interpreter startup {:.1f}ms".format(1000 * baseline))
+
+    failed = []
+    for module in opts.entry or list(BUDGETS):
+        runs = [measure(module) for _ in range(opts.repeat)]
+        if any(node is None for _, node, _ in runs):
+            error = next(error for _, node, error in runs if node is None)
+            print("{:12s} FAILED to import\n{}".format(module, error))
+            failed.append(module)
+            continue
+        wall, node, _ = min(runs, key=lambda run: run[1]['cumulative'])
+        budget = budgets.get(module)
+        over = budget is not None and node['cumulative'] > budget
+        eager = sorted({imported['name'].split(".")[0] for imported in
+                        _walk(node['children'])}.intersection(LAZY_MODULES))
+        print("{:12s} imports {:7.1f}ms  process {:7.1f}ms  budget {}{}"
+              .format(module, 1000 * node['cumulative'], 1000 * wall,
+                      "{:.0f}ms".format(1000 * budget) if budget else "-",
+                      "  OVER BUDGET" if over else ""))
+        for child in sorted(node['children'],
+                            key=lambda child: -child['cumulative'])[:opts.top]:
+            print("    {:7.1f}ms  {}".format(1000 * child['cumulative'],
+                                           child['name']))
+        if eager:
+            print("    imports lazy dependencies eagerly:", ", ".join(eager))
+        if over or eager:
+            failed.append(module)
+
+    if failed:
+        print("Startup budget failed for", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
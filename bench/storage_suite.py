@@ -0,0 +1,243 @@
+"""
+Conformance tests and benchmarks every storage backend must pass.
+
+Runs the same checks against each backend in storage.STORAGE_BACKENDS (aws
+against bench.fake_dynamodb, never the real tables): items round trip
+through put, batch_put and load, survive reopening the backend, keep their
+key types working after DynamoDB's Decimal conversion, and PersistentData
+reads back what it wrote. It then reports operations per second for single
+field updates through PersistentData, raw puts and bulk loads. Exits with
+status 1 if any check fails.
+
+    python -m bench.storage_suite
+    python -m bench.storage_suite --backend aws --aws_latency 0.01
+
+Files are written to a temporary directory, never the working one.
+"""
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+import traceback
+
+import storage
+from backend import PersistentData
+from bench.common import expect
+from bench.fake_dynamodb import FakeDynamoTable
+
+
+def file_storage_factory(opts):
+    """Make FileStorage instances sharing one fresh directory."""
+    directory = tempfile.mkdtemp(prefix="tangybot-storage-")
+    return lambda: storage.FileStorage(directory)
+
+
+def aws_storage_factory(opts):
+    """Make DynamoStorage instances sharing fresh fake tables."""
+    tables = {resource: FakeDynamoTable(key_name, latency=opts.aws_latency)
+              for resource, key_name in storage.RESOURCE_KEY_NAMES.items()}
+    return lambda: storage.DynamoStorage(tables=tables)
+
+
+# Backend name -> function making a factory of backends over fresh storage
+STORAGE_FACTORIES = dict(file=file_storage_factory, aws=aws_storage_factory)
+
+
+def profile_item(steam_id):
+    """An item like the ones TangyBot keeps per player."""
+    return dict(steam_name="player " + str(steam_id),
+                heroes=[steam_id % 120, 1, 2], games=steam_id % 1000)
+
+
+def check_empty(make):
+    the_storage = make()
+    for resource in storage.RESOURCES:
+        expect(the_storage.load(resource) == {},
+               resource + " is not empty at first")
+        expect(the_storage.get(resource, "nobody") is None,
+               "get of a missing item is not None")
+
+
+def check_put_get(make):
+    the_storage = make()
+    the_storage.put("session", "alice", dict(last_team=839, stale=True))
+    the_storage.put("session", "alice", dict(last_team=840))
+    the_storage.flush()
+    expect(the_storage.get("session", "alice") == dict(last_team=840),
+           "put does not replace the whole item")
+    the_storage.close()
+    expect(make().get("session", "alice") == dict(last_team=840),
+           "put item is gone after reopening")
+
+
+def check_batch_put_load(make, count=260):
+    the_storage = make()
+    items = {steam_id: profile_item(steam_id) for steam_id in range(count)}
+    the_storage.batch_put("profile", items)
+    the_storage.close()
+    loaded = make().load("profile")
+    expect(loaded == items, "load does not return every batch_put item")
+    # DynamoDB hands back Decimal keys, they must still find int keys
+    expect(all(steam_id in loaded for steam_id in range(count)),
+           "int keys do not find loaded items")
+
+
+def check_resources_independent(make):
+    the_storage = make()
+    the_storage.put("profile", 7, dict(steam_name="seven"))
+    the_storage.put("session", 7, dict(last_team=7))
+    the_storage.close()
+    reopened = make()
+    expect(reopened.get("profile", 7) == dict(steam_name="seven") and
+           reopened.get("session", 7) == dict(last_team=7),
+           "resources share items")
+
+
+def check_load_copies(make):
+    the_storage = make()
+    the_storage.put("session", "bob", dict(last_team=1))
+    loaded = the_storage.load("session")
+    loaded["bob"]["last_team"] = 2
+    the_storage.flush()
+    expect(make().get("session", "bob") == dict(last_team=1),
+           "changing loaded items changes stored ones")
+
+
+def check_persistent_data(make):
+    async def update_async():
+        persist = PersistentData(make())
+        persist.update("session", "carol", "last_team", 839)
+        persist.update("session", "carol", "last_players", [1, 2])
+        persist.update("profile", 123, "steam_name", "carol")
+        await persist.close()
+
+    asyncio.run(update_async())
+    # Without a running loop, update writes right away
+    persist = PersistentData(make())
+    persist.update("profile", 124, "steam_name", "dave")
+    persist = PersistentData(make())
+    expect(persist.session_data.get("carol") ==
+           dict(last_team=839, last_players=[1, 2]),
+           "PersistentData does not read back its session updates")
+    expect(persist.profile_data.get(123) == dict(steam_name="carol") and
+           persist.profile_data.get(124) == dict(steam_name="dave"),
+           "PersistentData does not read back its profile updates")
+
+
+CHECKS = (check_empty, check_put_get, check_batch_put_load,
+          check_resources_independent, check_load_copies,
+          check_persistent_data)
+
+
+def run_checks(factory, opts):
+    """Run every check on fresh storage, returning the failed ones."""
+    failed = []
+    for check in CHECKS:
+        try:
+            check(factory(opts))
+        except Exception:
+            failed.append(check.__name__)
+            print("  FAIL", check.__name__)
+            traceback.print_exc(file=sys.stdout)
+        else:
+            print("  ok  ", check.__name__)
+    return failed
+
+
+def bench_updates(make, updates):
+    """
+    Single field updates per second through PersistentData.
+
+    Returns
+    -------
+    each: float
+        Updates per second, waiting for each to be written
+    coalesced: float
+        Updates per second, updating different keys in one go
+
+    """
+    async def run():
+        persist = PersistentData(make())
+        start = time.perf_counter()
+        for i in range(updates):
+            persist.update("session", "user" + str(i % 10), "last_team", i)
+            await persist.flush()
+        each = updates / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(updates):
+            persist.update("profile", i, "steam_name", "player " + str(i))
+        await persist.flush()
+        coalesced = updates / (time.perf_counter() - start)
+        await persist.close()
+        return each, coalesced
+
+    return asyncio.run(run())
+
+
+def bench_puts(make, count):
+    """Puts per second straight to the backend, flushing every put."""
+    the_storage = make()
+    start = time.perf_counter()
+    for steam_id in range(count):
+        the_storage.put("profile", steam_id, profile_item(steam_id))
+        the_storage.flush()
+    elapsed = time.perf_counter() - start
+    the_storage.close()
+    return count / elapsed
+
+
+def bench_load(make, count):
+    """Items loaded per second from a backend holding count items."""
+    the_storage = make()
+    the_storage.batch_put("profile", {steam_id: profile_item(steam_id) for
+                                      steam_id in range(count)})
+    the_storage.close()
+    start = time.perf_counter()
+    loaded = make().load("profile")
+    elapsed = time.perf_counter() - start
+    expect(len(loaded) == count, "bulk load lost items")
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--backend", action="append",
+                        choices=list(STORAGE_FACTORIES),
+                        help="Backend to run, default all of " +
+                             ", ".join(STORAGE_FACTORIES))
+    parser.add_argument("--updates", type=int, default=200,
+                        help="Single field updates to time")
+    parser.add_argument("--puts", type=int, default=200,
+                        help="Raw puts to time")
+    parser.add_argument("--items", type=int, default=5000,
+                        help="Items to bulk load")
+    parser.add_argument("--aws_latency", type=float, default=0.0,
+                        help="Seconds each fake DynamoDB request takes")
+    opts = parser.parse_args()
+
+    failed = []
+    for name in opts.backend or list(STORAGE_FACTORIES):
+        factory = STORAGE_FACTORIES[name]
+        print(name)
+        failures = run_checks(factory, opts)
+        failed.extend(name + "." + check for check in failures)
+        if failures:
+            continue
+        each, coalesced = bench_updates(factory(opts), opts.updates)
+        print("  updates {:9.0f}/s each written  {:9.0f}/s coalesced".format(
+            each, coalesced))
+        print("  puts    {:9.0f}/s".format(
+            bench_puts(factory(opts), opts.puts)))
+        print("  load    {:9.0f} items/s".format(
+            bench_load(factory(opts), opts.items)))
+
+    if failed:
+        print("Storage conformance failed:", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Local stand-ins for the CSL, OpenDota and Steam upstreams.
+
+The stub serves the recorded fixtures in bench/fixtures with configurable
+latency, jitter and error injection, can take whole services down, and
+counts the requests it gets per upstream. It runs its own event loop in a
+background thread, so it keeps answering while the code under test blocks
+its loop (i.e. HeroData's synchronous GetHeroes call).
+
+    stub = StubUpstreams(latency=0.05, jitter=0.02, error_rate=0.01)
+    stub.start_in_thread()
+    stub.patch_urls()
+    ...
+    stub.stop()
+"""
+
+import asyncio
+import copy
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from aiohttp import web
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "fixtures")
+
+# Team number of the recorded CSL page; other teams are derived from it
+RECORDED_TEAM = 839
+
+STEAM_ID_RE = re.compile(r"STEAM_0:(\d):(\d+)")
+
+# Players with the same account ID modulo this queue together, see matches
+STACK_GROUPS = 3
+
+# Of every this many matches of a player, the first are with their stack
+STACK_CYCLE = 5
+STACKED_MATCHES = 3
+
+# Seconds between the synthetic matches of a player
+MATCH_INTERVAL = 3600
+
+# Heroes of the synthetic matches, from the recorded aggregate, and the
+# number of them players pick from, the first ones most often
+MATCH_HEROES = 13
+
+
+def load_fixture(name):
+    """Read a fixture file as text."""
+    with open(os.path.join(FIXTURE_DIR, name), encoding="utf-8") as fixture:
+        return fixture.read()
+
+
+class StubUpstreams:
+    """
+    aiohttp application imitating every upstream TangyBot talks to.
+
+    Attributes
+    ----------
+    latency: float
+        Mean seconds to wait before answering
+
+    jitter: float
+        Standard deviation of the wait in seconds
+
+    error_rate: float
+        Probability of answering with a 500 instead
+
+    slow_rate: float
+        Probability of a request taking slow_latency seconds longer, the
+        tail a hung or overloaded upstream produces
+
+    slow_latency: float
+        Extra seconds a slow request takes
+
+    outages: dict, str -> str
+        Services that are down (csl, opendota or steam), mapped to how:
+        "error" answers every request with a 503 right away, "hang" never
+        answers until the service is back up
+
+    counts: dict, str -> int
+        Number of requests received per upstream, named as in the metrics
+
+    errors: dict, str -> int
+        Number of injected errors per upstream
+
+    base_url: str or None
+        URL of the running stub
+
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None,
+                 slow_rate=0.0, slow_latency=5.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.outages = {}
+        self.counts = {}
+        self.errors = {}
+        self.base_url = None
+        self._random = random.Random(seed)
+
+        self._team_html = load_fixture("csl_team.html")
+        self._player = json.loads(load_fixture("opendota_player.json"))
+        self._heroes_body = load_fixture("opendota_heroes.json")
+        self._match_heroes = [int(hero['hero_id']) for hero in
+                              json.loads(self._heroes_body)[:MATCH_HEROES]]
+        self._steam_heroes_body = load_fixture("steam_get_heroes.json")
+
+        self.app = web.Application()
+        self.app.router.add_get("/dota2/teams/{team_id}", self.team_page)
+        self.app.router.add_get("/api/players/{account_id}", self.player)
+        self.app.router.add_get("/api/players/{account_id}/heroes",
+                                self.player_heroes)
+        self.app.router.add_get("/api/players/{account_id}/matches",
+                                self.player_matches)
+        self.app.router.add_get("/IEconDOTA2_570/GetHeroes/v1",
+                                self.get_heroes)
+
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def reset_counts(self):
+        """Forget the request and error counts."""
+        self.counts = {}
+        self.errors = {}
+
+    async def _delay(self, upstream):
+        """Count the request, wait, and maybe fail it. True means fail."""
+        self.counts[upstream] = self.counts.get(upstream, 0) + 1
+        service = upstream.split("_")[0]
+        while self.outages.get(service) == "hang":
+            await asyncio.sleep(0.05)
+        if self.outages.get(service) == "error":
+            self.errors[upstream] = self.errors.get(upstream, 0) + 1
+            return True
+        wait = self._random.gauss(self.latency, self.jitter)
+        if self._random.random() < self.slow_rate:
+            wait += self.slow_latency
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if self._random.random() < self.error_rate:
+            self.errors[upstream] = self.errors.get(upstream, 0) + 1
+            return True
+        return False
+
+    async def team_page(self, request):
+        """CSL team page, with account numbers shifted per team."""
+        if await self._delay("csl"):
+            return web.Response(status=500, text="Internal Server Error")
+        team_id = int(request.match_info["team_id"])
+        html = self._team_html
+        if team_id != RECORDED_TEAM:
+            offset = 100000 * team_id
+            html = STEAM_ID_RE.sub(
+                lambda match: "STEAM_0:" + match.group(1) + ":" +
+                              str(int(match.group(2)) + offset), html)
+            html = html.replace("University of Michigan",
+                                "Stub University " + str(team_id))
+        return web.Response(text=html, content_type="text/html")
+
+    async def player(self, request):
+        """OpenDota player info, personalized with the account ID."""
+        if await self._delay("opendota_info"):
+            return web.json_response(dict(error="Internal Server Error"),
+                                     status=500)
+        account_id = int(request.match_info["account_id"])
+        player = copy.deepcopy(self._player)
+        player["profile"]["account_id"] = account_id
+        player["profile"]["personaname"] = "stub" + str(account_id)
+        player["rank_tier"] = 11 + 10 * (account_id % 7) + account_id % 5
+        return web.json_response(player)
+
+    async def player_heroes(self, _):
+        """OpenDota hero aggregates, the same for every player."""
+        if await self._delay("opendota_heroes"):
+            return web.json_response(dict(error="Internal Server Error"),
+                                     status=500)
+        return web.Response(text=self._heroes_body,
+                            content_type="application/json")
+
+    async def player_matches(self, request):
+        """
+        OpenDota recent matches, one every MATCH_INTERVAL seconds.
+
+        Players whose account IDs are equal modulo STACK_GROUPS play
+        STACKED_MATCHES of every STACK_CYCLE matches together, on the same
+        side; the others are their own. The first of every STACK_CYCLE is
+        a lobby match. Honors limit, date and lobby_type.
+        """
+        if await self._delay("opendota_matches"):
+            return web.json_response(dict(error="Internal Server Error"),
+                                     status=500)
+        account_id = int(request.match_info["account_id"])
+        limit = int(request.query.get("limit", 100))
+        oldest = 0
+        if "date" in request.query:
+            oldest = time.time() - 86400 * int(request.query["date"])
+        lobby_only = request.query.get("lobby_type") == "1"
+        # Aligned to the interval, so the same match keeps its start time
+        newest = int(time.time()) // MATCH_INTERVAL * MATCH_INTERVAL
+        matches = []
+        slot = newest // MATCH_INTERVAL + 1
+        while len(matches) < limit:
+            slot -= 1
+            start_time = slot * MATCH_INTERVAL
+            if start_time < oldest:
+                break
+            if lobby_only and slot % STACK_CYCLE:
+                continue
+            if slot % STACK_CYCLE < STACKED_MATCHES:
+                match_id = slot * 100 + account_id % STACK_GROUPS
+            else:
+                match_id = slot * 100 + 10 + account_id % 89
+            radiant = slot % 2 == 0
+            # Skewed towards the first heroes, like a real hero pool
+            hero = min((slot * 7 + account_id) % MATCH_HEROES,
+                       (slot * 3 + account_id) % MATCH_HEROES)
+            matches.append(dict(match_id=match_id, start_time=start_time,
+                                player_slot=0 if radiant else 128,
+                                radiant_win=(match_id // 7) % 3 != 0,
+                                hero_id=self._match_heroes[hero]))
+        return web.json_response(matches)
+
+    async def get_heroes(self, _):
+        """Steam GetHeroes."""
+        if await self._delay("steam_heroes"):
+            return web.json_response(dict(error="Internal Server Error"),
+                                     status=500)
+        return web.Response(text=self._steam_heroes_body,
+                            content_type="application/json")
+
+    async def _start(self, host, port):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        bound_host, bound_port = self._runner.addresses[0][:2]
+        self.base_url = "http://" + bound_host + ":" + str(bound_port)
+
+    def start_in_thread(self, host="127.0.0.1", port=0):
+        """Start serving on a background thread, returns the base URL."""
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start(host, port))
+            ready.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="stub-upstreams",
+                                        daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.base_url
+
+    def stop(self):
+        """Stop serving and join the background thread."""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def patch_urls(self):
+        """Point TangyBot's upstream URLs at this stub."""
+        patch_urls(self.base_url)
+
+
+def patch_urls(base_url):
+    """Point TangyBot's upstream URLs at a stub, i.e. from another process."""
+    import api_dispatch
+    import hero_data
+
+    api_dispatch.CSL_TEAMS_URL = base_url + "/dota2/teams/"
+    api_dispatch.OPENDOTA_PLAYERS_API = base_url + "/api/players/"
+    hero_data.HERO_DATA_ENDPOINT = base_url + "/IEconDOTA2_570/GetHeroes/v1"
@@ -0,0 +1,224 @@
+"""In-memory response caches for TangyBot."""
+
+import contextlib
+import contextvars
+import time
+
+from metrics import CACHE_LOOKUPS
+
+# Freshness tracker of the command currently running, if anyone asked for one
+_freshness = contextvars.ContextVar("tangybot_freshness", default=None)
+
+
+class Freshness:
+    """
+    Freshness of the cache entries touched while serving a command.
+
+    Attributes
+    ----------
+    stored_at: float or None
+        Timestamp of the oldest entry that was read or written
+
+    expires_at: float or None
+        Timestamp of the earliest expiry among those entries
+
+    """
+
+    def __init__(self):
+        self.stored_at = None
+        self.expires_at = None
+
+    def note(self, stored_at, expires_at):
+        """Record that an entry with the given timestamps was used."""
+        if self.stored_at is None or stored_at < self.stored_at:
+            self.stored_at = stored_at
+        if self.expires_at is None or expires_at < self.expires_at:
+            self.expires_at = expires_at
+
+    def max_age(self, now=None):
+        """Seconds until the first entry used goes stale, 0 if none used."""
+        if self.expires_at is None:
+            return 0
+        now = time.time() if now is None else now
+        return max(0, int(self.expires_at - now))
+
+
+@contextlib.contextmanager
+def track_freshness():
+    """Track cache freshness for every cache access in this context."""
+    fresh = Freshness()
+    token = _freshness.set(fresh)
+    try:
+        yield fresh
+    finally:
+        _freshness.reset(token)
+
+
+class TTLCache:
+    """
+    Mapping whose entries expire a fixed time after they are stored.
+
+    Entries are evicted in insertion order once max_size is reached, which
+    is close enough to LRU for the lookup patterns TangyBot sees.
+
+    Entries other processes stored in the shared cache tier (see
+    shared_cache.py) are taken in with adopt, and answer lookups that
+    missed here through get_shared. Talking to that tier is up to the
+    backend, this class never leaves memory.
+
+    Attributes
+    ----------
+    name: str
+        Name of the cache, used for reporting
+
+    ttl: float
+        Seconds an entry stays fresh
+
+    max_size: int
+        Maximum number of entries to hold
+
+    hits: int
+        Number of successful lookups
+
+    misses: int
+        Number of failed or expired lookups
+
+    shared_hits: int
+        Number of those misses answered by get_shared instead
+
+    """
+
+    def __init__(self, name, ttl, max_size=4096):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        # key -> (stored_at, expires_at, value)
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and entry[1] > time.time()
+
+    def get(self, key, default=None):
+        """Get a fresh value for key, or default on a miss."""
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            self.misses += 1
+            CACHE_LOOKUPS.inc(cache=self.name, result="miss")
+            return default
+        self.hits += 1
+        CACHE_LOOKUPS.inc(cache=self.name, result="hit")
+        self._note(entry)
+        return entry[2]
+
+    def get_shared(self, key, entry, default=None):
+        """
+        Answer a lookup that missed with an entry another process stored.
+
+        The entry is adopted even if it has expired, as a stale fallback,
+        but only a fresh one counts as a shared hit (the miss before it was
+        already counted).
+
+        Parameters
+        ----------
+        entry: tuple
+            (stored_at, expires_at, value), see SharedCache.get
+
+        """
+        self.adopt(key, entry)
+        entry = self._entries[key]
+        if entry[1] <= time.time():
+            return default
+        self.shared_hits += 1
+        CACHE_LOOKUPS.inc(cache=self.name, result="shared")
+        self._note(entry)
+        return entry[2]
+
+    def adopt(self, key, entry):
+        """
+        Store an entry another process stored, unless ours is as new.
+
+        Returns
+        -------
+        adopted: bool
+            Whether entry replaced ours
+
+        """
+        ours = self._entries.get(key)
+        if ours is not None and ours[0] >= entry[0]:
+            return False
+        self._store(key, entry)
+        return True
+
+    def _store(self, key, entry):
+        if key not in self._entries and len(self._entries) >= self.max_size:
+            del self._entries[next(iter(self._entries))]
+        self._entries[key] = entry
+
+    def get_stale(self, key):
+        """
+        Get the value for key even if it has expired.
+
+        For when fetching a fresh one failed, stale entries stay around
+        until they are replaced or evicted.
+
+        Returns
+        -------
+        entry: tuple or None
+            (value, stored_at), None if key was never cached
+
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        CACHE_LOOKUPS.inc(cache=self.name, result="stale")
+        return entry[2], entry[0]
+
+    def put(self, key, value, stored_at=None):
+        """Store value under key, optionally backdated to stored_at."""
+        stored_at = time.time() if stored_at is None else stored_at
+        entry = (stored_at, stored_at + self.ttl, value)
+        self._store(key, entry)
+        self._note(entry)
+
+    def entry(self, key):
+        """Get (stored_at, expires_at, value) of key, None if not cached."""
+        return self._entries.get(key)
+
+    def peek(self, key, default=None):
+        """Get the value for key, fresh or not, without counting a lookup."""
+        entry = self._entries.get(key)
+        return default if entry is None else entry[2]
+
+    def clear(self):
+        """Drop every entry."""
+        self._entries.clear()
+
+    def expires_at(self, key):
+        """Get the expiry timestamp of key, or None if it is not cached."""
+        entry = self._entries.get(key)
+        return None if entry is None else entry[1]
+
+    def items(self):
+        """Iterate over (key, stored_at, value) of all fresh entries."""
+        now = time.time()
+        for key, (stored_at, expires_at, value) in list(self._entries.items()):
+            if expires_at > now:
+                yield key, stored_at, value
+
+    def hit_ratio(self):
+        """Fraction of lookups that were hits, here or shared."""
+        total = self.hits + self.misses
+        return (self.hits + self.shared_hits) / total if total else 0.0
+
+    @staticmethod
+    def _note(entry):
+        fresh = _freshness.get()
+        if fresh is not None:
+            fresh.note(entry[0], entry[1])
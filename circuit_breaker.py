@@ -0,0 +1,171 @@
+"""
+Circuit breakers for TangyBot's upstreams.
+
+Each upstream service (CSL, OpenDota) gets a breaker in api_dispatch. After
+FAILURE_THRESHOLD outages in a row (5xx responses, timeouts, connection
+errors, calls still waiting when their command's deadline passed) the
+breaker opens, and calls fail right away with CircuitOpenError
+instead of waiting on a service that is down. After reset_timeout seconds
+it lets a single probe call through (half open): if that succeeds the
+breaker closes again, otherwise it stays open for twice as long, up to
+MAX_RESET_TIMEOUT, so a flapping service isn't hammered either.
+
+The backend answers from stale cached data while a breaker is open, see
+TangyBotBackend._fetch_cached.
+"""
+
+import asyncio
+import contextlib
+import time
+from urllib.error import HTTPError
+
+import aiohttp
+
+import deadlines
+from metrics import CIRCUIT_REJECTIONS, CIRCUIT_TRANSITIONS
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Outages in a row that open a breaker
+FAILURE_THRESHOLD = 5
+
+# Seconds a breaker stays open before the first probe, and at most
+RESET_TIMEOUT = 30.0
+MAX_RESET_TIMEOUT = 300.0
+
+
+class CircuitOpenError(Exception):
+    """A call was refused because its upstream is considered down."""
+
+    def __init__(self, upstream, retry_in):
+        super(CircuitOpenError, self).__init__(
+            "{} is unavailable, trying again in {:.0f}s".format(upstream,
+                                                                retry_in))
+        self.upstream = upstream
+        self.retry_in = retry_in
+
+
+def is_outage(err):
+    """Whether an exception means the upstream is down, not just unhappy."""
+    if isinstance(err, CircuitOpenError):
+        return True
+    if isinstance(err, HTTPError):
+        return err.code >= 500 or err.code == 429
+    return isinstance(err, (asyncio.TimeoutError, aiohttp.ClientError))
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half open circuit breaker of one upstream.
+
+    Attributes
+    ----------
+    upstream: str
+        Name of the upstream, for errors and metrics
+
+    failure_threshold: int
+        Outages in a row that open the breaker
+
+    reset_timeout: float
+        Seconds the breaker first stays open for
+
+    state: str
+        CLOSED, OPEN or HALF_OPEN
+
+    """
+
+    def __init__(self, upstream, failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT, clock=time.monotonic):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._clock = clock
+        self._failures = 0
+        self._open_for = reset_timeout
+        self._opened_at = None
+        self._probing = False
+
+    @contextlib.contextmanager
+    def guard(self):
+        """
+        Guard one call to the upstream in the with block.
+
+        Raises
+        ------
+        CircuitOpenError
+            If the breaker is open, without running the block
+
+        """
+        probe = self._admit()
+        try:
+            yield
+        except asyncio.CancelledError:
+            # Cut off by the command's deadline, which is as good as a
+            # timeout, rather than by a hedge that won
+            if deadlines.remaining() == 0:
+                self._record_failure()
+            raise
+        except Exception as err:
+            if is_outage(err):
+                self._record_failure()
+            else:
+                # A 404 and the like still means the upstream is up
+                self._record_success()
+            raise
+        else:
+            self._record_success()
+        finally:
+            if probe:
+                self._probing = False
+
+    def reset(self):
+        """Close the breaker and forget past failures."""
+        self._failures = 0
+        self._open_for = self.reset_timeout
+        self._probing = False
+        self._transition(CLOSED)
+
+    def _admit(self):
+        """Let a call through or refuse it, True if it is the probe."""
+        if self.state == OPEN:
+            retry_in = self._opened_at + self._open_for - self._clock()
+            if retry_in > 0:
+                CIRCUIT_REJECTIONS.inc(upstream=self.upstream)
+                raise CircuitOpenError(self.upstream, retry_in)
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probing:
+                CIRCUIT_REJECTIONS.inc(upstream=self.upstream)
+                raise CircuitOpenError(self.upstream, 0)
+            self._probing = True
+            return True
+        return False
+
+    def _record_success(self):
+        self._failures = 0
+        if self.state != CLOSED:
+            self._open_for = self.reset_timeout
+            self._transition(CLOSED)
+
+    def _record_failure(self):
+        self._failures += 1
+        if self.state == HALF_OPEN:
+            # Still down, wait longer before probing again
+            self._open_for = min(2 * self._open_for, MAX_RESET_TIMEOUT)
+            self._open()
+        elif self.state == CLOSED and \
+                self._failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self._opened_at = self._clock()
+        self._transition(OPEN)
+
+    def _transition(self, state):
+        if state != self.state:
+            print("Circuit breaker of", self.upstream, "is now", state)
+            self.state = state
+            CIRCUIT_TRANSITIONS.inc(upstream=self.upstream, state=state)
@@ -5,15 +5,17 @@ Commands are invoked in CLI in the classic $ python3 cli.py etc.
 
 Supported Subcommands
 ---------------------
-lookup ([--last] | <team_number>)
+lookup ([--last] | [--other] | <team_number>)
     Look up a team based on CSL team number, or redo the previous lookup.
     Team Number can optionally also be a URL.
 
     This command gives a short summary of the players in the team,
     and also stores them so a call with --last will work also.
+    --other looks up the second team of the last versus instead.
 
 profile ([--last] | [user_1, user_2, ...]) [--num_games (100)]
-        [--max_heroes (5)] [--min_games (5)] [--tourney_only]
+        [--windows <n_1,n_2,...>] [--max_heroes (5)] [--min_games (5)]
+        [--tourney_only]
     Generates a more detailed profile for the listed players.
     If the last option is specified, profiles are created for all
     players that were in the command; user_i will be considered an error.
@@ -21,6 +23,9 @@ profile ([--last] | [user_1, user_2, ...]) [--num_games (100)]
 
     The num_games parameter is the max number of games they've recently
     played to look back at. The default is 100.
+    The windows parameter replaces it with several numbers of games, i.e.
+    20,50,100, reported side by side from a single fetch of each player's
+    matches.
 
     The min_games parameter is the minimum number of games on a hero
     required to be returned.
@@ -29,19 +34,68 @@ profile ([--last] | [user_1, user_2, ...]) [--num_games (100)]
 
     The tourney only flag limits the results to tournament lobbies only.
 
+draft ([--last] | [--other] | <team_number>) [--num_games (100)]
+      [--max_heroes (10)] [--max_bans (5)] [--min_games (5)]
+      [--tourney_only]
+    Summarizes the combined hero pool of a team: each player's share of
+    the team's games, the heroes several players play and the likely bans.
+
+stacks ([--last] | [--other] | <team_number>) [--num_games (100)]
+       [--min_games (3)] [--max_stacks (5)]
+    Finds the players of a team who queue together: the pairs and bigger
+    groups most often on the same side of a match, with their winrate.
+
+versus <team_a> <team_b> [--num_games (100)] [--max_heroes (10)]
+       [--min_games (5)] [--tourney_only]
+    Compares two teams side by side: average rank and MMR, players and the
+    heroes both play. team_a is stored for --last, team_b for --other.
+
+meta [--rank (all)] [--sort (games)] [--max_heroes (15)]
+     [--min_players (3)]
+    Reports the heroes played across the league, by every player whose
+    heroes TangyBot has fetched, optionally only those of one rank badge.
+
+whoplays <hero> [--team <team_number> | --last | --other]
+         [--min_games (1)] [--max_players (10)]
+    Reports who plays a hero, among every player whose heroes TangyBot has
+    fetched or only those of a team that was looked up. The hero can be
+    part of its name, its initials or a misspelling, i.e. "invo", "qop".
+
 stalk [user_1, user_2, ...]
     Reports the current session variables for given users.
     If no usernames are given, return those of the caller.
 
+metrics
+    Reports latency percentiles per command and upstream, persistence write
+    times and cache hit ratios. Only usernames listed in the
+    TANGYBOT_ADMINS environment variable may use it.
+
+If a daemon (see daemon.py) is running, commands are forwarded to it, which
+skips the backend's startup cost.
+
+Batch Mode
+----------
+$ python3 cli.py batch [file (stdin)] [--parallel (8)] [--user (cli)]
+                       [--backend (file)]
+    Runs every line of file as a command, i.e. "lookup 839", concurrently
+    on one backend, and writes the results to stdout as JSON Lines in the
+    order they complete. Blank lines and lines starting with # are skipped.
+    See run_batch for the output format. Since commands run concurrently,
+    prefer explicit arguments over --last.
+
 """
 
 import argparse
 import asyncio
+import contextlib
 import io
+import shlex
+import sys
+import time
 
-import aiohttp
-
-from backend import TangyBotBackend
+import daemon
+import util
+from league_stats import BUCKETS, SORT_KEYS
 
 
 class ArgumentParserError(Exception):
@@ -49,6 +103,17 @@ class ArgumentParserError(Exception):
     pass
 
 
+def window_list(text):
+    """Parse a comma separated list of game windows, i.e. "20,50,100"."""
+    try:
+        windows = sorted({int(window) for window in text.split(",")})
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid window list: " + text)
+    if windows[0] < 1:
+        raise argparse.ArgumentTypeError("windows must be positive: " + text)
+    return windows
+
+
 class BufferThrowingArgParser(argparse.ArgumentParser):
     """
     ArgParser implementation that throws and prints to buffer.
@@ -139,6 +204,9 @@ class TangyBotArgParse:
         self.lookup_group.add_argument("-l", "--last", action="store_true",
                                        help="Use the last team that was "
                                             "looked up by you")
+        self.lookup_group.add_argument("-o", "--other", action="store_true",
+                                       help="Use the other team of your "
+                                            "last versus")
 
         self.profile_parser = self.subparsers.add_parser("profile",
                                                          help="Get detailed "
@@ -151,6 +219,9 @@ class TangyBotArgParse:
         self.profile_group.add_argument("-l", "--last", action="store_true",
                                         help="Use the last players that were "
                                              "looked up by you")
+        self.profile_group.add_argument("-o", "--other", action="store_true",
+                                        help="Use the players of the other "
+                                             "team of your last versus")
         self.profile_group.add_argument("profiles", nargs="*", default=[],
                                         type=int,
                                         help="List of Steam32IDs of players")
@@ -174,6 +245,12 @@ class TangyBotArgParse:
                                          default=100,
                                          help="The previous number of games "
                                               "to consider.")
+        self.profile_filter.add_argument("-w", "--windows", type=window_list,
+                                         default=None,
+                                         help="Comma separated numbers of "
+                                              "previous games to report side "
+                                              "by side, instead of "
+                                              "num_games.")
 
         # Lobby only
         self.profile_parser.add_argument("-t", "--tourney_only",
@@ -181,6 +258,154 @@ class TangyBotArgParse:
                                          help="Set if only lobby games are "
                                               "desired")
 
+        # Team hero pool for drafting
+        self.draft_parser = self.subparsers.add_parser("draft",
+                                                       help="Summarize a "
+                                                            "team's hero "
+                                                            "pool")
+        self.draft_parser.set_defaults(command='draft')
+        self.draft_group = self.draft_parser.add_mutually_exclusive_group(
+            required=True)
+        self.draft_group.add_argument('team_number', nargs="?", default="",
+                                      help="The CSL team number or url to "
+                                           "draft against")
+        self.draft_group.add_argument("-l", "--last", action="store_true",
+                                      help="Use the last team that was "
+                                           "looked up by you")
+        self.draft_group.add_argument("-o", "--other", action="store_true",
+                                      help="Use the other team of your "
+                                           "last versus")
+
+        self.draft_parser.add_argument("-m", "--max_heroes", type=int,
+                                       default=10,
+                                       help="Report at most the top n "
+                                            "shared heroes")
+        self.draft_parser.add_argument("-b", "--max_bans", type=int,
+                                       default=5,
+                                       help="Report at most n likely bans")
+        self.draft_parser.add_argument("-g", "--min_games", type=int,
+                                       default=5,
+                                       help="Report heroes with at least "
+                                            "this many games played by the "
+                                            "team.")
+        self.draft_parser.add_argument("-n", "--num_games", type=int,
+                                       default=100,
+                                       help="The previous number of games "
+                                            "to consider per player.")
+        self.draft_parser.add_argument("-t", "--tourney_only",
+                                       action='store_true',
+                                       help="Set if only lobby games are "
+                                            "desired")
+
+        # Players of a team who queue together
+        self.stacks_parser = self.subparsers.add_parser("stacks",
+                                                        help="Find who "
+                                                             "queues "
+                                                             "together")
+        self.stacks_parser.set_defaults(command='stacks')
+        self.stacks_group = self.stacks_parser.add_mutually_exclusive_group(
+            required=True)
+        self.stacks_group.add_argument('team_number', nargs="?", default="",
+                                       help="The CSL team number or url to "
+                                            "find stacks in")
+        self.stacks_group.add_argument("-l", "--last", action="store_true",
+                                       help="Use the last team that was "
+                                            "looked up by you")
+        self.stacks_group.add_argument("-o", "--other", action="store_true",
+                                       help="Use the other team of your "
+                                            "last versus")
+        self.stacks_parser.add_argument("-n", "--num_games", type=int,
+                                        default=100,
+                                        help="The previous number of games "
+                                             "to consider per player.")
+        self.stacks_parser.add_argument("-g", "--min_games", type=int,
+                                        default=3,
+                                        help="Report players together in at "
+                                             "least this many games.")
+        self.stacks_parser.add_argument("-m", "--max_stacks", type=int,
+                                        default=5,
+                                        help="Report at most the top n "
+                                             "pairs and groups")
+
+        # Two teams side by side
+        self.versus_parser = self.subparsers.add_parser("versus",
+                                                        help="Compare two "
+                                                             "teams")
+        self.versus_parser.set_defaults(command='versus')
+        self.versus_parser.add_argument("teams", nargs=2,
+                                        help="The CSL team numbers or urls "
+                                             "to compare")
+        self.versus_parser.add_argument("-m", "--max_heroes", type=int,
+                                        default=10,
+                                        help="Report at most the top n "
+                                             "heroes both teams play")
+        self.versus_parser.add_argument("-g", "--min_games", type=int,
+                                        default=5,
+                                        help="Report heroes with at least "
+                                             "this many games played by "
+                                             "each team.")
+        self.versus_parser.add_argument("-n", "--num_games", type=int,
+                                        default=100,
+                                        help="The previous number of games "
+                                             "to consider per player.")
+        self.versus_parser.add_argument("-t", "--tourney_only",
+                                        action='store_true',
+                                        help="Set if only lobby games are "
+                                             "desired")
+
+        # League-wide hero statistics
+        self.meta_parser = self.subparsers.add_parser("meta",
+                                                      help="Heroes played "
+                                                           "across the "
+                                                           "league")
+        self.meta_parser.set_defaults(command='meta')
+        self.meta_parser.add_argument("-r", "--rank", default="all",
+                                      choices=BUCKETS,
+                                      help="Only count players of this "
+                                           "rank")
+        self.meta_parser.add_argument("-s", "--sort", default="games",
+                                      choices=SORT_KEYS,
+                                      help="What to sort heroes by")
+        self.meta_parser.add_argument("-m", "--max_heroes", type=int,
+                                      default=15,
+                                      help="Report at most the top n "
+                                           "heroes")
+        self.meta_parser.add_argument("-p", "--min_players", type=int,
+                                      default=3,
+                                      help="Report heroes played by at "
+                                           "least this many players")
+
+        # Who plays a hero
+        self.whoplays_parser = self.subparsers.add_parser("whoplays",
+                                                          help="Find who "
+                                                               "plays a "
+                                                               "hero")
+        self.whoplays_parser.set_defaults(command='whoplays')
+        self.whoplays_parser.add_argument("hero", nargs="+",
+                                          help="The hero's name, or part "
+                                               "of it")
+        self.whoplays_group = \
+            self.whoplays_parser.add_mutually_exclusive_group()
+        self.whoplays_group.add_argument("--team", dest="team_number",
+                                         default="",
+                                         help="Only search this CSL team "
+                                              "number or url")
+        self.whoplays_group.add_argument("-l", "--last", action="store_true",
+                                         help="Only search the last team "
+                                              "that was looked up by you")
+        self.whoplays_group.add_argument("-o", "--other",
+                                         action="store_true",
+                                         help="Only search the other team "
+                                              "of your last versus")
+        self.whoplays_parser.add_argument("-g", "--min_games", type=int,
+                                          default=1,
+                                          help="Report players with at least "
+                                               "this many games on the hero")
+        self.whoplays_parser.add_argument("-m", "--max_players", type=int,
+                                          default=10,
+                                          help="Report at most the top n "
+                                               "players")
+
         # Session information
         self.stalk_parser = self.subparsers.add_parser("stalk",
                                                        help="Access "
@@ -192,8 +417,17 @@ class TangyBotArgParse:
                                        help="User names to get session "
                                             "information of")
 
+        # Admin only metrics
+        self.metrics_parser = self.subparsers.add_parser("metrics",
+                                                         help="Latency and "
+                                                              "cache metrics")
+        self.metrics_parser.set_defaults(command="metrics")
+
         self.parser_list = [self.arg_parser, self.lookup_parser,
-                            self.profile_parser, self.stalk_parser]
+                            self.profile_parser, self.draft_parser,
+                            self.stacks_parser, self.versus_parser,
+                            self.meta_parser, self.whoplays_parser,
+                            self.stalk_parser, self.metrics_parser]
 
     def parse_args(self, args=None, namespace=None):
         """Parse arguments using argparse."""
@@ -221,19 +455,166 @@ arg_parse = TangyBotArgParse()
 
 async def main(args):
     """Main CLI for testing."""
+    # Imported here so forwarding to the daemon doesn't pay for them
+    import aiohttp
+    from backend import TangyBotBackend
+
     async with aiohttp.ClientSession() as session:
         the_tangy = TangyBotBackend(session=session)
-        return await the_tangy.dispatch(args)
+        try:
+            return await the_tangy.dispatch(args)
+        finally:
+            await the_tangy.close()
+
+
+async def _read_lines(stream):
+    """Read lines from stream without blocking running commands."""
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await loop.run_in_executor(None, stream.readline)
+        if not line:
+            return
+        yield line
+
+
+async def _run_line(the_tangy, line_number, line, username):
+    """Run one command of a batch, returning its output record."""
+    record = dict(line=line_number, command=line)
+    start = time.perf_counter()
+    try:
+        args = arg_parse.parse_args(shlex.split(line))
+        result = await the_tangy.dispatch(args, username)
+        record.update(ok=True, result=result)
+    except ArgumentParserError as err:
+        record.update(ok=False, error_type="ArgumentParserError",
+                      error=(str(err) + "\n" +
+                             arg_parse.get_strings()).strip())
+    except Exception as err:
+        # One bad command shouldn't stop the batch
+        record.update(ok=False, error_type=type(err).__name__,
+                      error=str(err) or repr(err))
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+async def run_batch(stream, out, parallel=8, username="cli",
+                    backend="file"):
+    """
+    Run the commands in stream concurrently, writing JSON Lines to out.
+
+    Every output line is a json object with the following keys:
+
+    line: int, line number of the command in stream
+    command: str, the command as given
+    ok: bool, whether the command succeeded
+    result: dict, the backend response if ok
+    error_type: str, the kind of error if not ok
+    error: str, the error message (or usage) if not ok
+    seconds: float, time spent running the command
+
+    Parameters
+    ----------
+    stream: file
+        Commands, one per line
+
+    out: file
+        Where to write the results
+
+    parallel: int
+        Maximum number of commands running at once
+
+    username: str
+        The username to run the commands as
+
+    backend: str
+        The backend to use for persistent storage
+
+    Returns
+    -------
+    failed: int
+        Number of commands that failed
+
+    """
+    import aiohttp
+    from backend import TangyBotBackend
+
+    queue = asyncio.Queue(parallel)
+    failed = 0
+
+    async with aiohttp.ClientSession() as session:
+        the_tangy = TangyBotBackend(backend=backend, session=session)
+
+        async def worker():
+            nonlocal failed
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                record = await _run_line(the_tangy, *item, username)
+                failed += not record['ok']
+                out.write(util.to_json(record) + "\n")
+                out.flush()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(parallel)]
+        try:
+            line_number = 0
+            async for line in _read_lines(stream):
+                line_number += 1
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    await queue.put((line_number, line))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await the_tangy.close()
+    return failed
+
+
+def batch_main(argv):
+    """Run batch mode with command line arguments argv."""
+    parser = argparse.ArgumentParser(prog="cli.py batch",
+                                     description="Run TangyBot commands in "
+                                                 "bulk, printing JSON Lines")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="File with one command per line, - for stdin")
+    parser.add_argument("-j", "--parallel", type=int, default=8,
+                        help="Maximum number of commands running at once")
+    parser.add_argument("-u", "--user", default="cli",
+                        help="Username to run the commands as")
+    parser.add_argument("-b", "--backend", default="file",
+                        choices=("file", "aws"))
+    opts = parser.parse_args(argv)
+
+    out = sys.stdout
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        stream = (sys.stdin if opts.input == "-" else
+                  stack.enter_context(open(opts.input)))
+        # Keep stdout for the results, log messages go to stderr
+        stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        failed = asyncio.run(run_batch(stream, out, max(1, opts.parallel),
+                                       opts.user, opts.backend))
+    print("Batch done in {:.2f}s, {} failed".format(
+        time.perf_counter() - start, failed), file=sys.stderr)
+    return 1 if failed else 0
 
 
 # Debugging main; enter your args however you want :^)
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["batch"]:
+        sys.exit(batch_main(sys.argv[2:]))
     try:
         res = arg_parse.parse_args()
         print(res)
         print(res.command)
-        loop = asyncio.get_event_loop()
-        tangy_res = loop.run_until_complete(main(res))
+        try:
+            tangy_res = daemon.forward(res)
+        except daemon.DaemonUnavailable:
+            loop = asyncio.get_event_loop()
+            tangy_res = loop.run_until_complete(main(res))
         print(tangy_res)
     except ArgumentParserError:
         print("oops")
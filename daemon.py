@@ -0,0 +1,229 @@
+"""
+Local TangyBot daemon, keeping a backend warm for cli.py.
+
+Every cli.py invocation otherwise pays for importing the backend's
+dependencies, fetching hero data and loading the persistent data before it
+does any work. The daemon holds one backend (with its caches and connection
+pool) and serves commands over a Unix socket, which cli.py forwards to when
+the daemon is running:
+
+    $ python3 daemon.py [backend (file)]
+    $ python3 cli.py lookup 839
+
+The socket is $TANGYBOT_SOCKET, or tangybot-<uid>.sock in $XDG_RUNTIME_DIR
+(or the temp directory) by default. Set TANGYBOT_SOCKET to an empty string
+to keep cli.py from forwarding. With TANGYBOT_SNAPSHOT set, the daemon
+saves a snapshot there when it stops, which the next one starts from (see
+snapshot.py).
+
+The protocol is one json object per line each way. Requests hold the args
+namespace and username to dispatch; responses hold ok and either result or
+error_type and error. Results go through util.to_json, so dict keys come
+back as strings.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+
+import util
+
+# Seconds to wait for the daemon to accept a connection
+CONNECT_TIMEOUT = 1.0
+
+
+def default_socket_path():
+    """Get the socket path from the environment, None if disabled."""
+    path = os.environ.get("TANGYBOT_SOCKET")
+    if path is not None:
+        return path or None
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(directory, "tangybot-" + str(os.getuid()) + ".sock")
+
+
+class DaemonUnavailable(Exception):
+    """No daemon is listening on the socket."""
+    pass
+
+
+class DaemonCommandError(Exception):
+    """A command forwarded to the daemon failed there."""
+
+    def __init__(self, error_type, error):
+        super(DaemonCommandError, self).__init__(error_type + ": " + error)
+        self.error_type = error_type
+        self.error = error
+
+
+def forward(args, username="user", path=None):
+    """
+    Run a parsed command on the daemon.
+
+    Parameters
+    ----------
+    args: Namespace
+        Arguments from TangyBotArgParse
+
+    username: str
+        The username to use a session
+
+    path: str or None
+        The daemon's socket, None for default_socket_path()
+
+    Raises
+    ------
+    DaemonUnavailable
+        If no daemon is running, run the command in process instead
+
+    DaemonCommandError
+        If the command failed on the daemon
+
+    Returns
+    -------
+    data: dict
+        The backend's response, as json
+
+    """
+    path = path or default_socket_path()
+    if path is None or not hasattr(socket, "AF_UNIX"):
+        raise DaemonUnavailable(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError, socket.timeout):
+            raise DaemonUnavailable(path)
+        sock.settimeout(None)
+        sock.sendall((util.to_json(dict(args=vars(args),
+                                        username=username)) +
+                      "\n").encode())
+        with sock.makefile("rb") as responses:
+            line = responses.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise DaemonCommandError("ConnectionError",
+                                 "daemon closed the connection")
+    resp = json.loads(line)
+    if not resp['ok']:
+        raise DaemonCommandError(resp['error_type'], resp['error'])
+    return resp['result']
+
+
+class TangyBotDaemon:
+    """
+    Unix socket server running commands on a shared backend.
+
+    Attributes
+    ----------
+    the_tangy: TangyBotBackend
+        The backend to run commands on
+
+    path: str
+        The socket to listen on
+
+    """
+
+    def __init__(self, the_tangy, path):
+        self.the_tangy = the_tangy
+        self.path = path
+        self.server = None
+
+    async def start(self):
+        """Start listening, replacing the socket of a dead daemon."""
+        if os.path.exists(self.path):
+            try:
+                with socket.socket(socket.AF_UNIX) as probe:
+                    probe.connect(self.path)
+            except ConnectionRefusedError:
+                os.remove(self.path)
+            else:
+                raise RuntimeError("A daemon is already listening on " +
+                                   self.path)
+        self.server = await asyncio.start_unix_server(self._serve, self.path)
+        # Only our user gets to run commands as us
+        os.chmod(self.path, 0o600)
+
+    async def close(self):
+        """Stop listening and remove the socket."""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def _serve(self, reader, writer):
+        """Answer the requests of one connection in order."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                resp = await self._run(line)
+                writer.write((util.to_json(resp) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _run(self, line):
+        """Run one request, returning its response."""
+        try:
+            req = json.loads(line)
+            result = await self.the_tangy.dispatch(
+                argparse.Namespace(**req['args']), req['username'])
+            return dict(ok=True, result=result)
+        except Exception as err:
+            # The daemon outlives any one bad command
+            return dict(ok=False, error_type=type(err).__name__,
+                        error=str(err) or repr(err))
+
+
+async def main(backend, path):
+    """Run the daemon until interrupted."""
+    # Imported here so cli.py can forward without paying for these
+    import aiohttp
+
+    import loop_watchdog
+    import metrics
+    from backend import TangyBotBackend
+
+    async with aiohttp.ClientSession() as session:
+        the_tangy = TangyBotBackend(backend=backend, session=session)
+        await the_tangy.warm_up()
+        daemon = TangyBotDaemon(the_tangy, path)
+        await daemon.start()
+        await metrics.start_exporters()
+        loop_watchdog.start_from_env()
+        the_tangy.start_refresher()
+
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+        print("TangyBot daemon listening on", path)
+        try:
+            await stop.wait()
+        finally:
+            await daemon.close()
+            if os.environ.get("TANGYBOT_SNAPSHOT"):
+                # Start the next daemon as warm as this one
+                import snapshot
+                snapshot.export_snapshot(the_tangy,
+                                         os.environ["TANGYBOT_SNAPSHOT"])
+            # Writes still queued are finished before the storage closes
+            await the_tangy.close()
+
+
+if __name__ == "__main__":
+    socket_path = default_socket_path()
+    if socket_path is None:
+        sys.exit("TANGYBOT_SOCKET is empty, nowhere to listen")
+    asyncio.run(main(sys.argv[1] if len(sys.argv) == 2 else "file",
+                     socket_path))
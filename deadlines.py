@@ -0,0 +1,218 @@
+"""
+Per-command deadlines and hedged upstream requests for TangyBot.
+
+TangyBotBackend.dispatch gives each command a deadline (TANGYBOT_DEADLINE_MS,
+default 8000, 0 for none), which every upstream call made while serving it
+inherits through a context variable: api_dispatch limits its requests to
+the time remaining, and the backend stops waiting for players once the
+deadline passes, answering with the players it has and a status marker
+(PENDING or UNAVAILABLE) for the rest.
+
+Upstream calls that take longer than the upstream's observed p95 latency
+are hedged: a duplicate request is sent, and whichever answers first wins.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import os
+
+import aiohttp
+
+from metrics import PARTIAL_PLAYERS, UPSTREAM_HEDGES, UPSTREAM_LATENCY
+
+DEFAULT_DEADLINE_MS = 8000
+
+# Successful requests to an upstream needed before its p95 is trusted
+MIN_HEDGE_SAMPLES = 20
+
+# Markers for players missing from a partial result
+PENDING = "pending"
+UNAVAILABLE = "unavailable"
+
+# Loop time the command currently running must finish by, None if no limit
+_deadline = contextvars.ContextVar("tangybot_deadline", default=None)
+
+
+def budget_from_env():
+    """Get the deadline budget in seconds from the environment, or None."""
+    budget_ms = float(os.environ.get("TANGYBOT_DEADLINE_MS",
+                                     DEFAULT_DEADLINE_MS))
+    return budget_ms / 1000 if budget_ms > 0 else None
+
+
+@contextlib.contextmanager
+def deadline(budget):
+    """Give everything in this context budget seconds, None for no limit."""
+    if budget is None:
+        yield
+        return
+    due = asyncio.get_running_loop().time() + budget
+    # Nested deadlines never extend the one outside
+    outer = _deadline.get()
+    token = _deadline.set(due if outer is None else min(outer, due))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left until the current deadline, None if there is none."""
+    due = _deadline.get()
+    if due is None:
+        return None
+    return max(0.0, due - asyncio.get_running_loop().time())
+
+
+def timeout_kwargs():
+    """Keyword arguments limiting an aiohttp request to the time left."""
+    left = remaining()
+    if left is None:
+        return {}
+    # aiohttp takes a total of 0 to mean no limit at all
+    return dict(timeout=aiohttp.ClientTimeout(total=max(left, 0.001)))
+
+
+def hedge_delay(upstream):
+    """Seconds to wait before hedging a request, None to never hedge."""
+    summary = UPSTREAM_LATENCY.summary(upstream=upstream, status=200)
+    if summary is None or summary['count'] < MIN_HEDGE_SAMPLES:
+        return None
+    return summary['p95']
+
+
+async def hedged(upstream, call):
+    """
+    Await call(), racing a duplicate if it is slower than upstream's p95.
+
+    Parameters
+    ----------
+    upstream: str
+        The upstream called, named as in UPSTREAM_LATENCY
+
+    call: callable
+        Makes the request, returning an awaitable of its result
+
+    Returns
+    -------
+    result: any
+        The result of the first request to succeed
+
+    Raises
+    ------
+    Exception
+        What the first request raised, if every request failed
+
+    """
+    delay = hedge_delay(upstream)
+    left = remaining()
+    if delay is None or (left is not None and left <= delay):
+        return await call()
+
+    requests = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(requests, timeout=delay)
+        if not done:
+            UPSTREAM_HEDGES.inc(upstream=upstream)
+            requests.append(asyncio.ensure_future(call()))
+        racing = set(requests)
+        while racing:
+            done, racing = await asyncio.wait(
+                racing, return_when=asyncio.FIRST_COMPLETED)
+            for request in done:
+                if request.exception() is None:
+                    return request.result()
+        # Every request failed, report the first one's error
+        return requests[0].result()
+    finally:
+        for request in requests:
+            if not request.done():
+                request.cancel()
+                request.add_done_callback(_discard_result)
+
+
+def _discard_result(task):
+    """Retrieve the outcome of a task nobody waits for anymore."""
+    if not task.cancelled():
+        task.exception()
+
+
+async def _limited(slots, coro):
+    """Await coro once one of the slots is free."""
+    try:
+        async with slots:
+            return await coro
+    finally:
+        # Cut short while waiting for a slot, it never started
+        coro.close()
+
+
+async def gather_partial(coros_by_key, limit=None):
+    """
+    Run coroutines concurrently until they finish or the deadline passes.
+
+    Parameters
+    ----------
+    coros_by_key: dict
+        Key -> coroutine to run
+
+    limit: int or None
+        Most coroutines to run at once, None for no limit
+
+    Returns
+    -------
+    results: dict
+        Key -> result of the coroutines that succeeded
+
+    missing: dict
+        Key -> PENDING if its coroutine was still running (or waiting for
+        its turn) at the deadline, or UNAVAILABLE if it failed because its
+        upstream is down (see circuit_breaker.is_outage)
+
+    Raises
+    ------
+    Exception
+        What the first coroutine to fail for any other reason raised
+
+    """
+    # circuit_breaker imports this module
+    from circuit_breaker import is_outage
+
+    if limit is not None:
+        slots = asyncio.Semaphore(limit)
+        coros_by_key = {key: _limited(slots, coro) for key, coro in
+                        coros_by_key.items()}
+    tasks = {key: asyncio.ensure_future(coro) for key, coro in
+             coros_by_key.items()}
+    try:
+        if tasks:
+            await asyncio.wait(tasks.values(), timeout=remaining())
+    finally:
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+                # It may still end in its own request's timeout instead
+                task.add_done_callback(_discard_result)
+    results = {}
+    missing = {}
+    errors = []
+    for key, task in tasks.items():
+        if not task.done() or task.cancelled() or \
+                isinstance(task.exception(), asyncio.TimeoutError):
+            # Cut short by the deadline, here or in its own request
+            missing[key] = PENDING
+        elif task.exception() is None:
+            results[key] = task.result()
+        elif is_outage(task.exception()):
+            print("Upstream call for", key, "failed:",
+                  repr(task.exception()))
+            missing[key] = UNAVAILABLE
+        else:
+            # Bad input or a bug, not something to wait out
+            errors.append(task.exception())
+        if key in missing:
+            PARTIAL_PLAYERS.inc(status=missing[key])
+    if errors:
+        raise errors[0]
+    return results, missing
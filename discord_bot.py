@@ -1,14 +1,19 @@
 """Discord bindings for TangyBot."""
 
+import asyncio
 import os
 import shlex
 import sys
 
 import discord
 
+import loop_watchdog
+import metrics
 from backend import TangyBotBackend, TangyBotError
 from cli import TangyBotArgParse, ArgumentParserError
 from frontend import FrontendFormatter
+from send_pipeline import EMBED_LIMIT, SendPipeline
+from slack_bot import TangyBotSlackClient
 
 CLIENT_ID = ""
 
@@ -28,6 +33,7 @@ class TangyBotClient(discord.Client):
     ----------
     the_tangy: TangyBotBackend
         The actual backend for the discord bot
+        None until the client logs in, since it needs the event loop
 
     arg_parse: TangyBotArgParse
         Argument parsing for the bot
@@ -35,23 +41,54 @@ class TangyBotClient(discord.Client):
     frontend_format: FrontendFormatter
         The formatter to use to make the response pretty
 
+    send_pipeline: SendPipeline
+        Packs responses into few messages and sends them in order per channel
+        Set TANGYBOT_DISCORD_EMBEDS=1 to also pack into embed descriptions,
+        which halves the messages but renders code blocks narrower
+
     """
 
-    def __init__(self, backend="file"):
-        super(TangyBotClient, self).__init__()
+    def __init__(self, backend="file", slack_token=None):
+        intents = discord.Intents.default()
+        # Commands are read from the text of messages
+        intents.message_content = True
+        super(TangyBotClient, self).__init__(intents=intents)
         print("Launching with backend", backend)
-        self.the_tangy = TangyBotBackend(backend=backend,
-                                         session=self.http.session)
+        self.backend = backend
+        self.slack_token = slack_token
+        self.the_tangy = None
         self.arg_parse = TangyBotArgParse()
-        self.frontend_format = FrontendFormatter()
+        self.frontend_format = None
+        use_embeds = os.environ.get("TANGYBOT_DISCORD_EMBEDS") == "1"
+        self.send_pipeline = SendPipeline(
+            self.send_packed, embed_limit=EMBED_LIMIT if use_embeds else 0)
+        self._slack_task = None
+
+    async def setup_hook(self):
+        # discord.py keeps its session to itself, the backend opens its own
+        self.the_tangy = TangyBotBackend(backend=self.backend)
+        # The send pipeline does the buffering up to Discord's limits
+        self.frontend_format = FrontendFormatter(
+            buffer=False, profiler=self.the_tangy.profiler)
+        # Serve Slack from this process too, sharing the backend and caches
+        if self.slack_token:
+            self._slack_task = asyncio.ensure_future(TangyBotSlackClient(
+                self.slack_token, self.the_tangy).run())
 
     async def close(self):
-        super(TangyBotClient, self).close()
-        await self.the_tangy.close()
+        await super(TangyBotClient, self).close()
+        if self._slack_task is not None:
+            self._slack_task.cancel()
+        if self.the_tangy is not None:
+            await self.the_tangy.close()
 
     async def on_ready(self):
         print("Tangy Bot Start")
-        await self.change_presence(game=discord.Game(name="Secret Strats"))
+        await metrics.start_exporters()
+        loop_watchdog.start_from_env()
+        self.the_tangy.start_refresher()
+        await self.change_presence(
+            activity=discord.Game(name="Secret Strats"))
 
     async def on_message(self, message):
         print(message.content)
@@ -59,11 +96,16 @@ class TangyBotClient(discord.Client):
         if message.author == self.user:
             return
 
+        author = message.author
         if message.content == "TangyBot":
-            await self.send_message(message.channel, "Present")
+            await self.send_pipeline.send(message.channel, ["Present"],
+                                          author=author)
         elif message.content == "BoBot":
-            await self.send_message(message.channel, "NANI")
-        if message.content.startswith("<@!" + CLIENT_ID):
+            await self.send_pipeline.send(message.channel, ["NANI"],
+                                          author=author)
+        # Nickname mentions have the !, plain ones don't
+        if message.content.startswith(("<@!" + CLIENT_ID,
+                                       "<@" + CLIENT_ID)):
             print("tagged")
             start_location = message.content.find('>')
             read_message = message.content[start_location + 2:]
@@ -75,42 +117,49 @@ class TangyBotClient(discord.Client):
             try:
                 res = self.arg_parse.parse_args(read_command)
 
-                await self.send_message(message.channel, "Received command \""
-                                        + res.command + "\" with args " +
-                                        str(vars(res)))
-                await self.send_typing(message.channel)
-
-                api_resp = await self.the_tangy.dispatch(res,
-                                                         str(message.author))
-                strings = self.frontend_format.dispatch(res.command, api_resp)
-
-                # write_tasks = (self.send_message(message.channel, string)
-                #                for string in strings)
-                # await asyncio.gather(*write_tasks)
+                with metrics.FRONTEND_LATENCY.time(frontend="discord",
+                                                   command=res.command):
+                    api_resp = await self.the_tangy.dispatch(
+                        res, str(message.author))
+                    strings = self.frontend_format.dispatch(res.command,
+                                                            api_resp)
 
-                # Need to be written in order...
-                for string in strings:
-                    await self.send_message(message.channel, string)
+                    # Packed, and written in order per channel
+                    await self.send_pipeline.send(message.channel, strings,
+                                                  res.command, author)
 
             except ArgumentParserError:
-                await self.send_argparse_vals(message.channel)
+                await self.send_argparse_vals(message.channel, author)
             except TangyBotError as e:
-                await self.send_message(message.channel, "```\n" + str(e) +
-                                        "\n```")
+                await self.send_pipeline.send(message.channel,
+                                              ["```\n" + str(e) + "\n```"],
+                                              author=author)
 
-    async def send_argparse_vals(self, channel):
+    async def send_packed(self, channel, content, embed_text=None):
+        """Send one packed message, with its embed description if any."""
+        embed = (discord.Embed(description=embed_text) if embed_text
+                 else None)
+        await channel.send(content, embed=embed)
+
+    async def send_typing(self, channel):
+        """Show the bot typing in channel while a command runs."""
+        await channel.typing()
+
+    async def send_argparse_vals(self, channel, author=None):
         """Send the argparse helper vals to discord."""
         print("Argparse vals are:")
         print(self.arg_parse.get_strings())
-        await self.send_message(channel,
-                                "```\n" + self.arg_parse.get_strings() +
-                                "\n```")
+        await self.send_pipeline.send(channel,
+                                      ["```\n" +
+                                       self.arg_parse.get_strings() +
+                                       "\n```"], author=author)
 
 
 if __name__ == '__main__':
     # token from environment variables
 
-    client = TangyBotClient(sys.argv[1] if len(sys.argv) == 2 else "aws")
+    client = TangyBotClient(sys.argv[1] if len(sys.argv) == 2 else "aws",
+                            slack_token=os.environ.get("SLACK_BOT_TOKEN"))
 
     discord_token = os.environ.get("DISCORD_TOKEN")
     discord_client_id = os.environ.get("DISCORD_CLIENT_ID")
@@ -118,4 +167,5 @@ if __name__ == '__main__':
     print(discord_client_id)
 
     CLIENT_ID = discord_client_id
+
     client.run(discord_token)
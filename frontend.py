@@ -1,5 +1,13 @@
 """Basic frontend string parsing tasks."""
 
+import contextlib
+import functools
+import hashlib
+import itertools
+import pickle
+
+from cache import TTLCache
+
 # Divider string to break up sections, if needed
 DIVIDER_STR = "`" + "-" * 98 + "`"
 
@@ -7,51 +15,197 @@ DIVIDER_STR = "`" + "-" * 98 + "`"
 DOTABUFF_HEAD = "https://dotabuff.com/players/"
 OPENDOTA_HEAD = "https://www.opendota.com/players/"
 
+RANK_BADGES = ("Herald", "Guardian", "Crusader", "Archon", "Legend",
+               "Ancient", "Divine", "Immortal")
+
+# Per-player section of a lookup
+LOOKUP_TEMPLATE = (DIVIDER_STR + "\n"
+                   "CSL USERNAME:   {csl_name}\n"
+                   "STEAM USERNAME: {steam_name}\n"
+                   "SOLO MMR: {solo_mmr}\n"
+                   "MMR ESTIMATE: {mmr_estimate}\n"
+                   "RANK TIER: {rank}\n"
+                   "<" + DOTABUFF_HEAD + "{steam_id}>\n"
+                   "<" + OPENDOTA_HEAD + "{steam_id}>\n")
+
+# Per-player section of a lookup missing its OpenDota information
+LOOKUP_MISSING_TEMPLATE = (DIVIDER_STR + "\n"
+                           "CSL USERNAME:   {csl_name}\n"
+                           "STEAM USERNAME: {steam_name}\n"
+                           "{status}\n"
+                           "<" + DOTABUFF_HEAD + "{steam_id}>\n"
+                           "<" + OPENDOTA_HEAD + "{steam_id}>\n")
+
+# What to say about players left out of a response, by status
+STATUS_MESSAGES = dict(
+    pending="OpenDota is taking its time with this player, try again soon",
+    unavailable="OpenDota could not be reached for this player")
+
+# Note on data answered from cache while its upstream is down
+STALE_TEMPLATE = "(from {age} ago, {upstream} is down)"
+
+# Per-hero line of a profile
+HERO_TEMPLATE = "{sign}{loc_name:20s}{games:3d} games {bar} ({perc:6.2f}%) "
+
+# Header and per-hero cell of a profile's window column, see window_rows
+WINDOW_HEAD = "{label:>16s}"
+WINDOW_CELL = "{games:6d} ({perc:6.2f}%)"
+
+# Per-player line of a draft, with their share of the team's games
+SHARE_TEMPLATE = "{name:20s}{games:4d} games {bar} ({perc:6.2f}%)"
+
+# Per-hero line of a draft's shared heroes
+POOL_TEMPLATE = ("{sign}{loc_name:20s}{games:4d} games {bar} ({perc:6.2f}%) "
+                 "{names}")
+
+# Per-hero line of a draft's likely bans
+BAN_TEMPLATE = "{rank}. {loc_name:20s}{games:4d} games ({perc:6.2f}%) {names}"
+
+# Line of a pair or group of stacks
+STACK_TEMPLATE = "{sign}{games:4d} games {bar} ({perc:6.2f}%) {names}"
+
+# Row of a versus, one column per team
+VERSUS_ROW = "{label:16s}{first:28.28s}{second:28.28s}"
+
+# Per-hero line of the heroes both teams of a versus play
+SHARED_TEMPLATE = ("{sign}{loc_name:20s}{first_games:4d} games "
+                   "({first_perc:6.2f}%) vs {second_games:4d} games "
+                   "({second_perc:6.2f}%)")
+
+# Per-hero line of the league meta
+META_TEMPLATE = ("{sign}{loc_name:20s}{games:5d} games ({pick_rate:5.2f}% "
+                 "picks) {players:4d} players {bar} ({perc:6.2f}%)")
+
+# Per-player line of whoplays
+WHOPLAYS_TEMPLATE = "{sign}{name:20s}{games:4d} games {bar} ({perc:6.2f}%)"
+
+# Seconds a rendered response stays in the render cache
+RENDER_CACHE_TTL = 600
+
 
 def rank_string(player_resp):
     """Create rank string from player dictionary."""
     """Get rank (+ number) string from player dictionary."""
     rank_number = player_resp["rank_tier"]
-    leaderboard_rank = player_resp["leaderboard_rank"]
+    # Ranks remembered in the profile data come without the leaderboard
+    leaderboard_rank = player_resp.get("leaderboard_rank")
     if rank_number is None:
         return "Unranked"
     elif leaderboard_rank is not None:
         return "Immortal #" + str(leaderboard_rank)
-    badges = ["Herald", "Guardian", "Crusader", "Archon", "Legend",
-              "Ancient", "Divine", "Immortal"]
     trailing = " " + str(rank_number % 10) if rank_number < 80 else ""
-    return badges[(rank_number // 10) - 1] + trailing
+    return RANK_BADGES[(rank_number // 10) - 1] + trailing
+
+
+def winrate_sign(winrate):
+    """Diff highlighting sign of a winrate line, red or green if far off."""
+    if winrate <= 0.4:
+        return "- "
+    elif winrate >= 0.6:
+        return "+ "
+    return "  "
+
+
+def player_name(steam_id, player):
+    """Name a player by CSL name, then steam name, then steam ID."""
+    return player.get('csl_name') or player.get('steam_name') or \
+        str(steam_id)
+
+
+def status_message(status):
+    """Explain why a player is missing from a response."""
+    return STATUS_MESSAGES.get(status, "No data (" + str(status) + ")")
+
+
+def format_age(seconds):
+    """Format an age in seconds as a short string, like 5m or 3h."""
+    for unit, length in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= length:
+            return str(int(seconds // length)) + unit
+    return str(int(seconds)) + "s"
+
+
+def stale_note(age, upstream):
+    """Note that data is age seconds old because upstream is down."""
+    return STALE_TEMPLATE.format(age=format_age(age), upstream=upstream)
+
+
+def window_rows(windows):
+    """
+    Lines of a profile over several windows, one column per window.
+
+    Heroes are listed as they rank in the smallest window, then the heroes
+    only the bigger ones report, with the sign of the first window
+    reporting them.
+    """
+    parts = [" " * 22]
+    for window in windows:
+        parts.append(WINDOW_HEAD.format(
+            label="last {} ({})".format(window['num_games'],
+                                        window['games'])))
+    parts.append("\n")
+
+    hero_order = {}
+    for window in windows:
+        for hero in window['heroes']:
+            hero_order.setdefault(hero['hero_id'], hero)
+    cells = [{hero['hero_id']: hero for hero in window['heroes']}
+             for window in windows]
+    for hero_id, first in hero_order.items():
+        parts.append(winrate_sign(first['winrate']) +
+                     "{:20s}".format(first['loc_name']))
+        for window_heroes in cells:
+            hero = window_heroes.get(hero_id)
+            if hero is None:
+                parts.append(WINDOW_HEAD.format(label="-"))
+            else:
+                parts.append(WINDOW_CELL.format(
+                    games=hero['games'], perc=100 * hero['winrate']))
+        parts.append("\n")
+    if not hero_order:
+        parts.append("No heroes!\n")
+    return parts
 
 
 def buffer_strings(strings, length_limit=2000):
     """Buffer strings by writing up to the limit."""
+    results = []
     # Need to bootstrap first string
-    results = [strings[0]]
+    current = [strings[0]]
     current_len = len(strings[0])
     for string in strings[1:]:
         if current_len + len(string) + 1 >= length_limit:
             # We'd go over, so restart
-            results.append(string)
+            results.append("\n".join(current))
+            current = [string]
             current_len = len(string)
         else:
             # We can append here
-            results[-1] += "\n" + string
+            current.append(string)
             current_len += len(string) + 1
+    results.append("\n".join(current))
     return results
 
 
 def create_ascii_bar(perc, num_bars=20, midpoint=True):
     """Create an ascii bar representing the given percentage."""
-    return_string = "|"
-    rounded_bars = round(num_bars * perc)
+    return _ascii_bar(round(num_bars * perc), num_bars, midpoint)
+
+
+@functools.lru_cache(maxsize=256)
+def _ascii_bar(rounded_bars, num_bars, midpoint):
+    """Create an ascii bar with rounded_bars filled, there are few of them."""
     winrate_bar = "-" * rounded_bars + " " * (num_bars - rounded_bars)
     if midpoint:
         mid_ind = num_bars//2
-        return_string += winrate_bar[:mid_ind] + "|" + winrate_bar[mid_ind:]
-    else:
-        return_string += winrate_bar
-    return_string += "|"
-    return return_string
+        winrate_bar = winrate_bar[:mid_ind] + "|" + winrate_bar[mid_ind:]
+    return "|" + winrate_bar + "|"
+
+
+def fingerprint(api_response):
+    """Digest of a backend response, equal for equal responses."""
+    return hashlib.sha1(pickle.dumps(api_response,
+                                     pickle.HIGHEST_PROTOCOL)).digest()
 
 
 class FrontendFormatter:
@@ -62,10 +216,21 @@ class FrontendFormatter:
     ----------
     buffer: bool
         Whether to buffer the output up to discord's message length limits
+
+    profiler: CommandProfiler or None
+        Sampling profiler for formatting, None if disabled
+
+    render_cache: TTLCache or None
+        Rendered strings keyed by (command, response fingerprint, buffer),
+        so the same response viewed by many people is rendered once
     """
 
-    def __init__(self, buffer=True):
+    def __init__(self, buffer=True, profiler=None, render_cache_size=256):
         self.buffer = buffer
+        self.profiler = profiler
+        self.render_cache = (TTLCache("render", RENDER_CACHE_TTL,
+                                      render_cache_size)
+                             if render_cache_size else None)
 
     def dispatch(self, command, api_response):
         """
@@ -89,36 +254,48 @@ class FrontendFormatter:
         """
         # If we get a keyerror, oh well
         func_to_call = getattr(self, command)
-        # Splatter and pass username as kwargs
-        res = func_to_call(**api_response)
-        if self.buffer:
-            res = buffer_strings(res)
+        trace = (self.profiler.trace("format", command) if self.profiler
+                 else contextlib.nullcontext())
+        with trace:
+            key = None
+            if self.render_cache is not None:
+                key = (command, fingerprint(api_response), self.buffer)
+                cached = self.render_cache.get(key)
+                if cached is not None:
+                    return list(cached)
+
+            # Splatter and pass username as kwargs
+            res = func_to_call(**api_response)
+            if self.buffer:
+                res = buffer_strings(res)
+
+            if key is not None:
+                self.render_cache.put(key, tuple(res))
         return res
 
-    def lookup(self, team_name, players):
+    def lookup(self, team_name, players, roster_age=None):
         """Format lookup string."""
         return_strings = ["CSL Team: " + team_name]
+        if roster_age is not None:
+            return_strings[0] += " " + stale_note(roster_age, "CSL")
         for steam_id, player in players.items():
-            return_string = DIVIDER_STR + "\n"
-            return_string += "CSL USERNAME:   " + player['csl_name'] + "\n"
-            return_string += "STEAM USERNAME: " + player['steam_name'] + "\n"
-
-            return_string += "SOLO MMR: " + str(
-                player["solo_competitive_rank"] or "?") + "\n"
-
-            return_string += "MMR ESTIMATE: "
-            try:
-                return_string += str(player["mmr_estimate"]["estimate"])
-            except KeyError:
-                return_string += "?"
-            return_string += "\n"
-
-            return_string += "RANK TIER: " + rank_string(player) + "\n"
-
-            return_string += "<" + DOTABUFF_HEAD + str(steam_id) + ">\n"
-            return_string += "<" + OPENDOTA_HEAD + str(steam_id) + ">\n"
-
-            return_strings.append(return_string)
+            if 'status' in player:
+                return_strings.append(LOOKUP_MISSING_TEMPLATE.format(
+                    csl_name=player['csl_name'],
+                    steam_name=player.get('steam_name', "?"),
+                    status=status_message(player['status']),
+                    steam_id=steam_id))
+                continue
+            section = LOOKUP_TEMPLATE.format(
+                csl_name=player['csl_name'],
+                steam_name=player['steam_name'],
+                solo_mmr=player["solo_competitive_rank"] or "?",
+                mmr_estimate=player["mmr_estimate"] or "?",
+                rank=rank_string(player),
+                steam_id=steam_id)
+            if 'stale_age' in player:
+                section += stale_note(player['stale_age'], "OpenDota") + "\n"
+            return_strings.append(section)
         return_strings.append(DIVIDER_STR)
         return return_strings
 
@@ -135,48 +312,303 @@ class FrontendFormatter:
                 except KeyError:
                     pass
 
-            return_string = user_string + ":\n```diff\n"
+            if 'status' in player:
+                return_strings.append(user_string + ": " +
+                                      status_message(player['status']))
+                continue
 
-            for hero in player['heroes']:
-                # Diff color highlighting
-                if hero['winrate'] <= 0.4:
-                    return_string += "- "
-                elif hero['winrate'] >= 0.6:
-                    return_string += "+ "
-                else:
-                    return_string += "  "
+            if 'stale_age' in player:
+                user_string += " " + stale_note(player['stale_age'],
+                                                "OpenDota")
 
-                return_string += "{:20s}".format(hero['loc_name'])
-                return_string += f"{hero['games']:3d} games "
+            parts = [user_string, ":\n```diff\n"]
+            if 'windows' in player:
+                parts.extend(window_rows(player['windows']))
+                parts.append("```")
+                return_strings.append("".join(parts))
+                continue
 
-                # Winrate bar
-                return_string += create_ascii_bar(hero['winrate']) + " ("
-
-                return_string += f"{100 * hero['winrate']:6.2f}" + "%) "
+            for hero in player['heroes']:
+                winrate = hero['winrate']
+                parts.append(HERO_TEMPLATE.format(
+                    sign=winrate_sign(winrate), loc_name=hero['loc_name'],
+                    games=hero['games'], bar=create_ascii_bar(winrate),
+                    perc=100 * winrate))
 
                 # Flavor emoji
-                if hero['winrate'] <= 0.3:
-                    return_string += "\N{DOG FACE}"
-                elif hero['winrate'] >= 0.7:
-                    return_string += "\N{FROG FACE}"
-                if hero['winrate'] >= 0.6 and hero['games'] >= 10:
-                    return_string += "\N{FIRE}"
+                if winrate <= 0.3:
+                    parts.append("\N{DOG FACE}")
+                elif winrate >= 0.7:
+                    parts.append("\N{FROG FACE}")
+                if winrate >= 0.6 and hero['games'] >= 10:
+                    parts.append("\N{FIRE}")
 
-                return_string += "\n"
+                parts.append("\n")
 
             if not player['heroes']:
-                return_string += "No heroes!\n"
+                parts.append("No heroes!\n")
 
-            return_string += "```"
-            return_strings.append(return_string)
+            parts.append("```")
+            return_strings.append("".join(parts))
+        return return_strings
+
+    def draft(self, team_name, games, players, pool, bans, roster_age=None):
+        """Format draft string."""
+        title = "Draft summary: " + team_name + " (" + str(games) + " games)"
+        if roster_age is not None:
+            title += " " + stale_note(roster_age, "CSL")
+        return_strings = [title]
+
+        parts = ["Share of games:\n```\n"]
+        for steam_id, player in players.items():
+            name = player_name(steam_id, player)
+            if 'status' in player:
+                parts.append(name + ": " + status_message(player['status']))
+            else:
+                parts.append(SHARE_TEMPLATE.format(
+                    name=name, games=player['games'],
+                    bar=create_ascii_bar(player['share'], midpoint=False),
+                    perc=100 * player['share']))
+                if 'stale_age' in player:
+                    parts.append(" " + stale_note(player['stale_age'],
+                                                  "OpenDota"))
+            parts.append("\n")
+        parts.append("```")
+        return_strings.append("".join(parts))
+
+        playing = sum('games' in player for player in players.values())
+
+        def names(hero):
+            if len(hero['players']) == playing > 2:
+                return "everyone"
+            return ", ".join(player_name(steam_id, players[steam_id])
+                             for steam_id in hero['players'])
+
+        parts = ["Shared heroes:\n```diff\n"]
+        for hero in pool:
+            parts.append(POOL_TEMPLATE.format(
+                sign=winrate_sign(hero['winrate']), loc_name=hero['loc_name'],
+                games=hero['games'], bar=create_ascii_bar(hero['winrate']),
+                perc=100 * hero['winrate'], names=names(hero)))
+            parts.append("\n")
+        if not pool:
+            parts.append("No heroes shared!\n")
+        parts.append("```")
+        return_strings.append("".join(parts))
+
+        parts = ["Likely bans:\n```\n"]
+        for rank, hero in enumerate(bans, 1):
+            parts.append(BAN_TEMPLATE.format(
+                rank=rank, loc_name=hero['loc_name'], games=hero['games'],
+                perc=100 * hero['winrate'], names=names(hero)))
+            parts.append("\n")
+        if not bans:
+            parts.append("No heroes!\n")
+        parts.append("```")
+        return_strings.append("".join(parts))
+        return return_strings
+
+    def stacks(self, team_name, num_games, players, pairs, groups,
+               roster_age=None):
+        """Format stacks string."""
+        title = ("Stacks: " + team_name + " (last " + str(num_games) +
+                 " games per player)")
+        if roster_age is not None:
+            title += " " + stale_note(roster_age, "CSL")
+        return_strings = [title]
+
+        notes = []
+        for steam_id, player in players.items():
+            name = player_name(steam_id, player)
+            if 'status' in player:
+                notes.append(name + ": " + status_message(player['status']))
+            elif 'stale_age' in player:
+                notes.append(name + ": " + stale_note(player['stale_age'],
+                                                      "OpenDota"))
+        if notes:
+            return_strings.append("\n".join(notes))
+
+        for label, stacks in (("Pairs", pairs), ("Groups", groups)):
+            parts = [label, ":\n```diff\n"]
+            for stack in stacks:
+                parts.append(STACK_TEMPLATE.format(
+                    sign=winrate_sign(stack['winrate']),
+                    games=stack['games'],
+                    bar=create_ascii_bar(stack['winrate']),
+                    perc=100 * stack['winrate'],
+                    names=", ".join(player_name(steam_id, players[steam_id])
+                                    for steam_id in stack['players'])))
+                parts.append("\n")
+            if not stacks:
+                parts.append("Nobody queues together!\n")
+            parts.append("```")
+            return_strings.append("".join(parts))
+        return return_strings
+
+    def versus(self, teams, shared):
+        """Format versus string."""
+        first, second = teams
+        title = "Versus: " + first['team_name'] + " vs " + second['team_name']
+        for team in teams:
+            if 'roster_age' in team:
+                title += "\n" + team['team_name'] + " roster " + \
+                    stale_note(team['roster_age'], "CSL")
+        return_strings = [title]
+
+        def rank(team):
+            if team['rank_tier'] is None:
+                return "Unranked"
+            return rank_string(dict(rank_tier=team['rank_tier'],
+                                    leaderboard_rank=None))
+
+        def player_row(steam_id, player):
+            # Missing players may still have a rank remembered from before
+            if 'status' in player or 'rank_tier' not in player:
+                return player_name(steam_id, player) + " ?"
+            # Stale players are starred, see the note below
+            return (player_name(steam_id, player) +
+                    ("*" if 'stale_age' in player else "") + " " +
+                    rank_string(player))
+
+        rows = [("Team", first['team_name'], second['team_name']),
+                ("Average rank", rank(first), rank(second)),
+                ("Average MMR", str(first['mmr_estimate'] or "?"),
+                 str(second['mmr_estimate'] or "?")),
+                ("Ranked players",
+                 "{}/{}".format(first['ranked'], len(first['players'])),
+                 "{}/{}".format(second['ranked'], len(second['players']))),
+                ("Games", str(first['games']), str(second['games']))]
+        players = [[player_row(*item) for item in team['players'].items()]
+                   for team in teams]
+        for index, pair in enumerate(itertools.zip_longest(*players,
+                                                           fillvalue="")):
+            rows.append(("Players" if index == 0 else "",) + pair)
+        parts = ["```\n"]
+        for label, first_col, second_col in rows:
+            parts.append(VERSUS_ROW.format(label=label, first=first_col,
+                                           second=second_col).rstrip())
+            parts.append("\n")
+        stale_ages = [player['stale_age'] for team in teams
+                      for player in team['players'].values()
+                      if 'stale_age' in player]
+        if stale_ages:
+            parts.append("* " + stale_note(max(stale_ages), "OpenDota") +
+                         "\n")
+        parts.append("```")
+        return_strings.append("".join(parts))
+
+        parts = ["Heroes both teams play:\n```diff\n"]
+        for hero in shared:
+            first_side, second_side = hero['sides']
+            # Highlight heroes the first team does much better or worse on
+            difference = first_side['winrate'] - second_side['winrate']
+            parts.append(SHARED_TEMPLATE.format(
+                sign=("+ " if difference >= 0.1 else
+                      "- " if difference <= -0.1 else "  "),
+                loc_name=hero['loc_name'],
+                first_games=first_side['games'],
+                first_perc=100 * first_side['winrate'],
+                second_games=second_side['games'],
+                second_perc=100 * second_side['winrate']))
+            parts.append("\n")
+        if not shared:
+            parts.append("No heroes in common!\n")
+        parts.append("```")
+        return_strings.append("".join(parts))
+        return return_strings
+
+    def meta(self, rank, players, games, heroes):
+        """Format meta string."""
+        return_strings = ["League meta ({}): {} players, {} games".format(
+            rank, players, games)]
+        parts = ["```diff\n"]
+        for hero in heroes:
+            parts.append(META_TEMPLATE.format(
+                sign=winrate_sign(hero['winrate']), loc_name=hero['loc_name'],
+                games=hero['games'], pick_rate=100 * hero['pick_rate'],
+                players=hero['players'],
+                bar=create_ascii_bar(hero['winrate']),
+                perc=100 * hero['winrate']))
+            parts.append("\n")
+        if not heroes:
+            parts.append("No heroes yet, profile some teams first!\n")
+        parts.append("```")
+        return_strings.append("".join(parts))
+        return return_strings
+
+    def whoplays(self, hero_id, loc_name, team_name, players, unknown,
+                 roster_age=None):
+        """Format whoplays string."""
+        title = ("Who plays " + loc_name + " " +
+                 ("on " + team_name if team_name is not None
+                  else "in the league") + ":")
+        if roster_age is not None:
+            title += " " + stale_note(roster_age, "CSL")
+        return_strings = [title]
+        parts = ["```diff\n"]
+        for steam_id, player in players.items():
+            parts.append(WHOPLAYS_TEMPLATE.format(
+                sign=winrate_sign(player['winrate']),
+                name=player_name(steam_id, player), games=player['games'],
+                bar=create_ascii_bar(player['winrate']),
+                perc=100 * player['winrate']))
+            parts.append("\n")
+        if not players:
+            parts.append("Nobody, as far as TangyBot knows!\n")
+        parts.append("```")
+        return_strings.append("".join(parts))
+        if unknown:
+            return_strings.append(
+                "Heroes not fetched yet for " + ", ".join(
+                    player_name(steam_id, player)
+                    for steam_id, player in unknown.items()) +
+                ", profile them to include them")
         return return_strings
 
     def stalk(self, users):
         """Format stalking string."""
         return_strings = ["Stalking results:"]
         for user, res in users.items():
-            return_string = user + ":\n"
-            return_string += "team: " + str(res['last_team']) + "\n"
-            return_string += "players: " + str(res['last_players']) + "\n"
+            parts = [user, ":\n",
+                     "team: ", str(res['last_team']), "\n",
+                     "players: ", str(res['last_players']), "\n"]
+            if res.get('other_team') is not None:
+                # Set by versus
+                parts.extend(("other team: ", str(res['other_team']), "\n",
+                              "other players: ", str(res['other_players']),
+                              "\n"))
+            return_strings.append("".join(parts))
+        return return_strings
+
+    def metrics(self, commands, upstreams, persist, caches, shared=None):
+        """Format metrics string."""
+        return_strings = ["Metrics:"]
+        for title, summaries in (("Commands", commands),
+                                 ("Upstreams", upstreams),
+                                 ("Persistence writes", persist)):
+            return_string = title + ":\n```\n"
+            for name, summary in summaries.items():
+                return_string += "{:20s}{:6d} calls  mean {:8.1f}ms  " \
+                                 "p50 <{:8.1f}ms  p95 <{:8.1f}ms\n".format(
+                                     str(name), summary['count'],
+                                     1000 * summary['mean'],
+                                     1000 * summary['p50'],
+                                     1000 * summary['p95'])
+            if not summaries:
+                return_string += "Nothing yet!\n"
+            return_string += "```"
             return_strings.append(return_string)
+
+        shared = shared or {}
+        return_string = "Cache hit ratios:\n```\n"
+        for name, ratio in caches.items():
+            return_string += "{:20s}{:6.1f}%".format(name, 100 * ratio)
+            if name in shared:
+                return_string += "  ({:.1f}% from other processes)".format(
+                    100 * shared[name])
+            return_string += "\n"
+        if not caches:
+            return_string += "Nothing yet!\n"
+        return_string += "```"
+        return_strings.append(return_string)
         return return_strings
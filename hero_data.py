@@ -1,8 +1,10 @@
 """Dota hero information lookup."""
 
+import difflib
 import os
+import re
 
-import requests
+from metrics import UPSTREAM_LATENCY
 
 HERO_DATA_ENDPOINT = "http://api.steampowered.com/IEconDOTA2_570/GetHeroes/v1"
 
@@ -39,6 +41,20 @@ def create_hero_dicts(api_hero_resp):
     return hero_info, hero_seq, seq_hero
 
 
+def _search_words(name):
+    """Lowercase alphanumeric words of a name, i.e. to match queries."""
+    return re.findall(r"[a-z0-9]+", name.lower())
+
+
+def _hero_params(lang):
+    """Query parameters of a GetHeroes request."""
+    # Steam key from environment vars. Get one or ask Bo Qu :)
+    params = dict(language=lang)
+    if os.environ.get("STEAM_KEY"):
+        params['key'] = os.environ["STEAM_KEY"]
+    return params
+
+
 class HeroData:
     """
     Mappings from hero ID to other information.
@@ -57,12 +73,21 @@ class HeroData:
         id: hero id; the key used to obtain this information
         loc_name: localized name
 
+    hero_seq: dict, hero_id -> int
+        Dense sequential ID of each hero, see create_hero_dicts
+
+    seq_hero: list of int
+        Hero ID of each sequential ID
+
     max_name_len: int
         The maximum length of a localized hero name.
 
+    search_names: dict, str -> hero_id
+        Localized names without case and punctuation, see find_heroes
+
     """
 
-    def __init__(self, lang="en"):
+    def __init__(self, lang="en", api_hero_resp=None):
         """
         Construct HeroData with names in the given language.
 
@@ -71,15 +96,104 @@ class HeroData:
         lang: str, default "en"
             The language to retrieve the data in.
 
+        api_hero_resp: dict or None
+            An already fetched GetHeroes response, see create_async
+            If None, fetch it (blocking!)
+
         """
-        # Steam key from environment vars. Get one or ask Bo Qu :)
-        self._api_key = os.environ.get("STEAM_KEY")
-        req = requests.get(HERO_DATA_ENDPOINT,
-                           params=dict(key=self._api_key, language=lang))
-        self.hero_info, _, _ = create_hero_dicts(req.json()['result'])
+        if api_hero_resp is None:
+            import requests
+
+            with UPSTREAM_LATENCY.time(upstream="steam_heroes",
+                                       status="error") as timer:
+                req = requests.get(HERO_DATA_ENDPOINT,
+                                   params=_hero_params(lang))
+                timer['status'] = req.status_code
+            api_hero_resp = req.json()
+        self.hero_info, self.hero_seq, self.seq_hero = create_hero_dicts(
+            api_hero_resp['result'])
 
         self.max_name_len = max(len(item['loc_name']) for _, item in
                                 self.hero_info.items())
+        self.search_names = {}
+        self._search_words = {}
+        for hero_id, item in self.hero_info.items():
+            words = _search_words(item['loc_name'])
+            self.search_names["".join(words)] = hero_id
+            self._search_words[hero_id] = words
+
+    @classmethod
+    async def create_async(cls, session, lang="en"):
+        """
+        Construct HeroData without blocking the event loop.
+
+        Parameters
+        ----------
+        session: aiohttp.ClientSession
+            The session to fetch hero data with
+
+        lang: str, default "en"
+            The language to retrieve the data in.
+
+        """
+        with UPSTREAM_LATENCY.time(upstream="steam_heroes",
+                                   status="error") as timer:
+            async with session.get(HERO_DATA_ENDPOINT,
+                                   params=_hero_params(lang)) as req:
+                timer['status'] = req.status
+                req.raise_for_status()
+                api_hero_resp = await req.json(content_type=None)
+        return cls(lang, api_hero_resp)
+
+    def find_heroes(self, query):
+        """
+        Find heroes by their localized name, or part of it.
+
+        Ignoring case and punctuation, query is tried as, in order: the
+        whole name, its initials (i.e. "qop"), the start of the name or of
+        one of its words, any part of the name (three letters or more)
+        and finally a misspelling of the name. The first of those that
+        matches any hero is used.
+
+        Parameters
+        ----------
+        query: str
+            The name to look for, i.e. "invoker", "anti mage" or "am"
+
+        Returns
+        -------
+        hero_ids: list of int
+            IDs of the heroes found, empty if none are
+
+        """
+        words = _search_words(query)
+        compact = "".join(words)
+        if not compact:
+            return []
+        if compact in self.search_names:
+            return [self.search_names[compact]]
+        matchers = (
+            lambda name, name_words: "".join(
+                word[0] for word in name_words) == compact,
+            lambda name, name_words: name.startswith(compact) or any(
+                word.startswith(compact) for word in name_words),
+            # Two letters are somewhere in too many names to mean anything
+            lambda name, name_words: len(compact) > 2 and compact in name)
+        for matches in matchers:
+            found = [hero_id for name, hero_id in self.search_names.items()
+                     if matches(name, self._search_words[hero_id])]
+            if found:
+                return found
+        return [self.search_names[name] for name in
+                difflib.get_close_matches(compact, self.search_names,
+                                          n=3, cutoff=0.75)]
+
+    def api_response(self):
+        """Rebuild the GetHeroes response, i.e. to create a copy from."""
+        return dict(result=dict(heroes=[
+            dict(id=info['id'], name=info['name'],
+                 localized_name=info['loc_name'])
+            for info in self.hero_info.values()]))
 
     def __getitem__(self, item):
         """Get hero information from hero id."""
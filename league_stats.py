@@ -0,0 +1,242 @@
+"""
+League-wide hero statistics, kept up to date as hero aggregates arrive.
+
+Every hero aggregate the backend fetches from OpenDota over LEAGUE_WINDOW
+(the last 100 matches of any lobby, the commands' default) is folded into
+running totals of games, wins and players per hero, overall and per rank
+badge, so the meta command reads them instead of profiling the league
+again. Aggregates over other windows aren't comparable and are left out.
+Each player counts once, with the aggregate fetched for them last: a new
+one replaces their old contribution, and a new rank moves it to another
+badge.
+
+Totals are arrays indexed by the dense sequential hero IDs of
+hero_data.create_hero_dicts. The same contributions also make up an
+inverted index from hero to the players who play it, for the whoplays
+command.
+"""
+
+import array
+
+# Rank badges, in rank tier order, and the buckets totals are kept for
+BADGES = ("herald", "guardian", "crusader", "archon", "legend", "ancient",
+          "divine", "immortal")
+BUCKETS = ("unranked",) + BADGES + ("all",)
+ALL = len(BUCKETS) - 1
+
+# What the heroes of a summary can be sorted by
+SORT_KEYS = ("games", "winrate", "players")
+
+# Hero aggregates counted, (number of recent matches, tourney only)
+LEAGUE_WINDOW = (100, False)
+
+
+def rank_bucket(rank_tier):
+    """Bucket of a rank tier, unranked for None."""
+    if not rank_tier:
+        return 0
+    return min(rank_tier // 10, len(BADGES))
+
+
+class LeagueStats:
+    """
+    Running totals of the heroes every player TangyBot has seen plays.
+
+    Attributes
+    ----------
+    hero_seq: dict, hero_id -> int
+        Dense index of each hero in the totals
+
+    seq_hero: list of int
+        Hero ID of each dense index
+
+    """
+
+    def __init__(self, hero_seq, seq_hero):
+        self.hero_seq = hero_seq
+        self.seq_hero = seq_hero
+        zeros = [0] * len(seq_hero)
+        # Per bucket, per dense hero index
+        self._games = [array.array('q', zeros) for _ in BUCKETS]
+        self._wins = [array.array('q', zeros) for _ in BUCKETS]
+        self._players = [array.array('q', zeros) for _ in BUCKETS]
+        # Per bucket, over every hero
+        self._total_games = array.array('q', [0] * len(BUCKETS))
+        self._total_players = array.array('q', [0] * len(BUCKETS))
+        # player -> (bucket, dense indices, games, wins) counted for them
+        self._contributions = {}
+        self._ranks = {}
+        # Per dense hero index, player -> (games, wins)
+        self._hero_players = [{} for _ in seq_hero]
+
+    def __len__(self):
+        return len(self._contributions)
+
+    def __contains__(self, player):
+        return player in self._contributions
+
+    def record_heroes(self, player, records, rank_tier=None):
+        """
+        Count a player's hero aggregate instead of their previous one.
+
+        Parameters
+        ----------
+        player: int
+            The player's Steam32 ID
+
+        records: list of HeroRecord
+            The player's hero aggregate (see api_dispatch.HeroRecord)
+
+        rank_tier: int or None
+            The player's rank tier, None to keep the one known
+
+        """
+        if rank_tier is not None:
+            self._ranks[player] = rank_tier
+        indices = array.array('l')
+        games = array.array('q')
+        wins = array.array('q')
+        for hero_id, hero_games, hero_win in records:
+            index = self.hero_seq.get(hero_id)
+            # Heroes newer than the hero table can't be counted yet
+            if hero_games and index is not None:
+                indices.append(index)
+                games.append(hero_games)
+                wins.append(hero_win)
+        previous = self._contributions.pop(player, None)
+        self._apply(previous, -1)
+        if previous is not None:
+            for index in previous[1]:
+                del self._hero_players[index][player]
+        contribution = (rank_bucket(self._ranks.get(player)), indices, games,
+                        wins)
+        self._contributions[player] = contribution
+        self._apply(contribution, 1)
+        for index, hero_games, hero_win in zip(indices, games, wins):
+            self._hero_players[index][player] = (hero_games, hero_win)
+
+    def record_rank(self, player, rank_tier):
+        """Move a player's contribution to the bucket of their rank."""
+        self._ranks[player] = rank_tier
+        contribution = self._contributions.get(player)
+        if contribution is None or \
+                contribution[0] == rank_bucket(rank_tier):
+            return
+        self._apply(contribution, -1)
+        contribution = (rank_bucket(rank_tier),) + contribution[1:]
+        self._contributions[player] = contribution
+        self._apply(contribution, 1)
+
+    def _apply(self, contribution, sign):
+        """Add (sign 1) or remove (sign -1) a contribution to the totals."""
+        if contribution is None:
+            return
+        bucket, indices, games, wins = contribution
+        for target in (bucket, ALL):
+            bucket_games = self._games[target]
+            bucket_wins = self._wins[target]
+            bucket_players = self._players[target]
+            for index, hero_games, hero_win in zip(indices, games, wins):
+                bucket_games[index] += sign * hero_games
+                bucket_wins[index] += sign * hero_win
+                bucket_players[index] += sign
+            self._total_games[target] += sign * sum(games)
+            self._total_players[target] += sign
+
+    def summary(self, bucket="all", sort="games", max_heroes=15,
+                min_players=1):
+        """
+        Summarize the heroes played by the players of a bucket.
+
+        Takes time in the number of heroes, however many players have been
+        recorded.
+
+        Parameters
+        ----------
+        bucket: str
+            One of BUCKETS
+
+        sort: str
+            One of SORT_KEYS, most first
+
+        max_heroes: int
+            Maximum number of heroes to report
+
+        min_players: int
+            Minimum number of players of a hero to report it
+
+        Returns
+        -------
+        data: dict
+            players and games of the bucket, and heroes, a list of dicts
+            with hero_id, games, win, winrate, players and pick_rate (the
+            share of the bucket's games played on the hero)
+
+        """
+        target = BUCKETS.index(bucket)
+        games = self._games[target]
+        wins = self._wins[target]
+        players = self._players[target]
+        total_games = self._total_games[target]
+        keys = dict(games=games.__getitem__, players=players.__getitem__,
+                    winrate=lambda index: wins[index] / games[index])
+        indices = sorted((index for index in range(len(self.seq_hero))
+                          if games[index] and players[index] >= min_players),
+                         key=keys[sort], reverse=True)[:max_heroes]
+        return dict(players=self._total_players[target], games=total_games,
+                    heroes=[dict(hero_id=self.seq_hero[index],
+                                 games=games[index], win=wins[index],
+                                 winrate=wins[index] / games[index],
+                                 players=players[index],
+                                 pick_rate=games[index] / total_games)
+                            for index in indices])
+
+    def players_of(self, hero_id, players=None, min_games=1):
+        """
+        Get who plays a hero, most games first.
+
+        Parameters
+        ----------
+        hero_id: int
+            The hero to look for
+
+        players: iterable of int or None
+            Steam32 IDs to limit the search to, None for every player
+
+        min_games: int
+            Minimum number of games on the hero to report a player
+
+        Returns
+        -------
+        played: list of tuple
+            (player, games, win) of each player found
+
+        """
+        index = self.hero_seq.get(hero_id)
+        played = {} if index is None else self._hero_players[index]
+        if players is None:
+            rows = played.items()
+        else:
+            rows = ((player, played[player]) for player in players
+                    if player in played)
+        return sorted(((player, games, win) for player, (games, win) in rows
+                       if games >= min_games),
+                      key=lambda row: row[1], reverse=True)
+
+    def state(self):
+        """Get the contributions by hero ID, i.e. for a snapshot."""
+        return {player: (self._ranks.get(player),
+                         [(self.seq_hero[index], hero_games, hero_win)
+                          for index, hero_games, hero_win in
+                          zip(indices, games, wins)])
+                for player, (_, indices, games, wins) in
+                self._contributions.items()}
+
+    def load(self, state):
+        """Record the contributions of state for players not yet counted."""
+        missing = [player for player in state
+                   if player not in self._contributions]
+        for player in missing:
+            rank_tier, records = state[player]
+            self.record_heroes(player, records, rank_tier)
+        return len(missing)
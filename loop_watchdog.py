@@ -0,0 +1,132 @@
+"""
+Event loop lag watchdog for TangyBot.
+
+Everything TangyBot serves (Discord's gateway heartbeats included) shares one
+event loop, so a callback that blocks it delays every other user. The
+watchdog schedules a heartbeat on the loop and watches it from a separate
+thread; when the loop falls behind by more than the threshold, it prints
+the stack the loop thread is stuck in, and once the loop recovers, for how
+long it was blocked. Loop lag is also exported as a histogram.
+
+It is on by default with a 100ms threshold; set TANGYBOT_LOOP_WATCHDOG_MS to
+change the threshold, or to 0 to turn it off.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+from metrics import LOOP_LAG, LOOP_STALLS
+
+DEFAULT_THRESHOLD_MS = 100
+
+
+class LoopWatchdog:
+    """
+    Reports callbacks that block the event loop.
+
+    Attributes
+    ----------
+    threshold: float
+        Seconds the loop may lag before it counts as blocked
+
+    interval: float
+        Seconds between heartbeats
+
+    max_lag: float
+        Largest lag seen, in seconds
+
+    stalls: int
+        Number of times the loop was blocked for longer than threshold
+
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD_MS / 1000, interval=None):
+        self.threshold = threshold
+        self.interval = interval or min(threshold / 2, 0.05)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._loop = None
+        self._loop_thread = None
+        self._due = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_env(cls):
+        """Create a watchdog from environment variables, or None."""
+        threshold_ms = float(os.environ.get("TANGYBOT_LOOP_WATCHDOG_MS",
+                                            DEFAULT_THRESHOLD_MS))
+        if threshold_ms <= 0:
+            return None
+        return cls(threshold_ms / 1000)
+
+    @property
+    def running(self):
+        return self._loop is not None and not self._stopped.is_set()
+
+    def start(self):
+        """Start watching the running loop, call from inside it."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped.clear()
+        self._due = time.perf_counter()
+        self._loop.call_soon(self._beat)
+        threading.Thread(target=self._watch, name="tangybot-loop-watchdog",
+                         daemon=True).start()
+
+    def stop(self):
+        """Stop watching."""
+        self._stopped.set()
+
+    def reset(self):
+        """Forget the lag seen so far."""
+        self.max_lag = 0.0
+        self.stalls = 0
+
+    def _beat(self):
+        """Heartbeat on the loop, measuring how late it ran."""
+        if self._stopped.is_set():
+            return
+        now = time.perf_counter()
+        lag = max(0.0, now - self._due)
+        LOOP_LAG.observe(lag)
+        self.max_lag = max(self.max_lag, lag)
+        if lag >= self.threshold:
+            self.stalls += 1
+            LOOP_STALLS.inc()
+            print("Event loop was blocked for {:.0f}ms".format(lag * 1000))
+        self._due = now + self.interval
+        self._loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        """Print the loop thread's stack whenever a heartbeat is overdue."""
+        reported = None
+        while not self._stopped.wait(self.interval):
+            due = self._due
+            lag = time.perf_counter() - due
+            if lag < self.threshold or reported == due:
+                continue
+            # Only once per stall
+            reported = due
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            print("Event loop blocked for {:.0f}ms so far, in:\n{}".format(
+                lag * 1000, "".join(traceback.format_stack(frame))),
+                end="")
+
+
+_watchdog = None
+
+
+def start_from_env():
+    """Start the watchdog on the running loop unless it is running already."""
+    global _watchdog
+    if _watchdog is None:
+        _watchdog = LoopWatchdog.from_env()
+    if _watchdog is not None and not _watchdog.running:
+        _watchdog.start()
+    return _watchdog
@@ -0,0 +1,377 @@
+"""
+Latency and cache metrics for TangyBot.
+
+Metrics live in the module level METRICS registry and are rendered in the
+Prometheus text exposition format, either to a file (TANGYBOT_METRICS_FILE)
+or over HTTP on /metrics (TANGYBOT_METRICS_PORT).
+"""
+
+import asyncio
+import contextlib
+import os
+import time
+
+# Upper bounds in seconds of the histogram buckets, +Inf is implied
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+
+def _label_string(label_names, label_values, extra=()):
+    """Format labels as {a="1",b="2"} for the text format."""
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(name + "=\"" + str(value).replace("\"", "\\\"") +
+                          "\"" for name, value in pairs) + "}"
+
+
+class Counter:
+    """
+    Monotonically increasing count, split by label values.
+
+    Attributes
+    ----------
+    name: str
+        Prometheus metric name
+
+    help: str
+        Description of the metric
+
+    label_names: tuple of str
+        Names of the labels every observation must provide
+
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        """Increment the counter for the given labels."""
+        key = tuple(labels[name] for name in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Get the current count for the given labels."""
+        return self._values.get(tuple(labels[name] for name in
+                                      self.label_names), 0)
+
+    def samples(self):
+        """Iterate over (label values, count)."""
+        return sorted(self._values.items(), key=str)
+
+    def render(self):
+        """Render the counter in Prometheus text format."""
+        lines = []
+        for key, value in self.samples():
+            lines.append(self.name + _label_string(self.label_names, key) +
+                         " " + repr(float(value)))
+        return lines
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets.
+
+    Attributes
+    ----------
+    name: str
+        Prometheus metric name
+
+    help: str
+        Description of the metric
+
+    label_names: tuple of str
+        Names of the labels every observation must provide
+
+    buckets: tuple of float
+        Upper bounds of the buckets
+
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        """Record a single observation for the given labels."""
+        key = tuple(labels[name] for name in self.label_names)
+        try:
+            series = self._values[key]
+        except KeyError:
+            series = self._values[key] = [0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe the wall time spent in the with block.
+
+        The yielded dict holds the labels, so labels only known at the end
+        (i.e. a response status) can be filled in inside the block.
+        """
+        timer = dict(labels)
+        start = time.perf_counter()
+        try:
+            yield timer
+        finally:
+            self.observe(time.perf_counter() - start, **timer)
+
+    def summary(self, **labels):
+        """
+        Summarize the observations matching labels.
+
+        Labels that are not given are aggregated over, i.e. summary of
+        command="lookup" covers every outcome of lookup.
+
+        Returns
+        -------
+        summary: dict or None
+            count, mean and estimated p50 and p95 of the observations,
+            or None if nothing was observed.
+            Percentiles are the upper bound of the bucket they fall in.
+
+        """
+        series = None
+        for key, values in self._values.items():
+            key_labels = dict(zip(self.label_names, key))
+            if any(key_labels[name] != value for name, value in
+                   labels.items()):
+                continue
+            if series is None:
+                series = list(values)
+            else:
+                series = [total + value for total, value in
+                          zip(series, values)]
+        if series is None:
+            return None
+        count = sum(series[:-1])
+        return dict(count=count, mean=series[-1] / count,
+                    p50=self._quantile(series, count, 0.5),
+                    p95=self._quantile(series, count, 0.95))
+
+    def label_values(self, label):
+        """Get the distinct values seen for label."""
+        index = self.label_names.index(label)
+        return sorted({key[index] for key in self._values}, key=str)
+
+    def _quantile(self, series, count, quantile):
+        running = 0
+        for index, bound in enumerate(self.buckets):
+            running += series[index]
+            if running >= quantile * count:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        """Iterate over (label values, label dict) pairs observed so far."""
+        return [(key, dict(zip(self.label_names, key)))
+                for key in sorted(self._values, key=str)]
+
+    def render(self):
+        """Render the histogram in Prometheus text format."""
+        lines = []
+        for key, _ in self.samples():
+            series = self._values[key]
+            running = 0
+            for index, bound in enumerate(self.buckets + (float("inf"),)):
+                running += series[index]
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(self.name + "_bucket" +
+                             _label_string(self.label_names, key,
+                                           [("le", le)]) +
+                             " " + repr(float(running)))
+            labels = _label_string(self.label_names, key)
+            lines.append(self.name + "_sum" + labels + " " +
+                         repr(float(series[-1])))
+            lines.append(self.name + "_count" + labels + " " +
+                         repr(float(running)))
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics that can be rendered together."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, label_names=()):
+        """Create and register a Counter."""
+        return self._register(Counter(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        """Create and register a Histogram."""
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric " + metric.name + " already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Render every metric in Prometheus text format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append("# HELP " + metric.name + " " + metric.help)
+            lines.append("# TYPE " + metric.name + " " + metric.kind)
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Atomically write the rendered metrics to path."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as out:
+            out.write(self.render())
+        os.replace(tmp_path, path)
+
+
+METRICS = MetricsRegistry()
+
+COMMAND_LATENCY = METRICS.histogram(
+    "tangybot_command_seconds",
+    "Backend time spent per command", ("command", "outcome"))
+
+FRONTEND_LATENCY = METRICS.histogram(
+    "tangybot_frontend_seconds",
+    "End to end time per command including formatting and sending",
+    ("frontend", "command"))
+
+UPSTREAM_LATENCY = METRICS.histogram(
+    "tangybot_upstream_seconds",
+    "Time per upstream request", ("upstream", "status"))
+
+PERSIST_WRITE_LATENCY = METRICS.histogram(
+    "tangybot_persist_write_seconds",
+    "Time per persistent storage write", ("backend", "resource"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+             0.5, 1.0))
+
+MESSAGES_PER_COMMAND = METRICS.histogram(
+    "tangybot_messages_per_command",
+    "Chat messages sent per command", ("frontend", "command"),
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20))
+
+SEND_LATENCY = METRICS.histogram(
+    "tangybot_send_seconds",
+    "Time from queueing a command's output to its last message being sent",
+    ("frontend",))
+
+LOOP_LAG = METRICS.histogram(
+    "tangybot_loop_lag_seconds",
+    "How late event loop heartbeats ran",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+             2.5))
+
+LOOP_STALLS = METRICS.counter(
+    "tangybot_loop_stalls_total",
+    "Times the event loop was blocked for longer than the watchdog allows")
+
+UPSTREAM_HEDGES = METRICS.counter(
+    "tangybot_upstream_hedges_total",
+    "Duplicate upstream requests sent for requests slower than p95",
+    ("upstream",))
+
+PARTIAL_PLAYERS = METRICS.counter(
+    "tangybot_partial_players_total",
+    "Players left out of a response, pending at the deadline or unavailable",
+    ("status",))
+
+CIRCUIT_TRANSITIONS = METRICS.counter(
+    "tangybot_circuit_transitions_total",
+    "Upstream circuit breaker state changes, by the state entered",
+    ("upstream", "state"))
+
+CIRCUIT_REJECTIONS = METRICS.counter(
+    "tangybot_circuit_rejections_total",
+    "Upstream calls refused because the circuit breaker was open",
+    ("upstream",))
+
+CACHE_LOOKUPS = METRICS.counter(
+    "tangybot_cache_lookups_total",
+    "Backend cache lookups", ("cache", "result"))
+
+BACKGROUND_REFRESHES = METRICS.counter(
+    "tangybot_background_refreshes_total",
+    "Cache entries fetched again ahead of expiry while idle",
+    ("cache", "outcome"))
+
+
+def cache_hit_ratios(results=("hit", "shared")):
+    """
+    Get the hit ratio of every cache that has been looked up.
+
+    Lookups answered from the cache tier shared with other processes (see
+    shared_cache.py) count as hits, pass results=("shared",) to only count
+    those.
+    """
+    totals = {}
+    for (cache_name, result), count in CACHE_LOOKUPS.samples():
+        hits, lookups = totals.get(cache_name, (0, 0))
+        # Shared hits and stale fallbacks come after a miss that was
+        # already counted
+        totals[cache_name] = (hits + (count if result in results else 0),
+                              lookups + (count if result in ("hit", "miss")
+                                         else 0))
+    return {name: hits / lookups for name, (hits, lookups) in totals.items()
+            if lookups}
+
+
+async def write_periodically(path, interval=15):
+    """Write the metrics to path every interval seconds, forever."""
+    while True:
+        METRICS.write(path)
+        await asyncio.sleep(interval)
+
+
+async def serve(port, host="127.0.0.1"):
+    """Serve the metrics on http://host:port/metrics, returns the runner."""
+    from aiohttp import web
+
+    async def handle_metrics(_):
+        return web.Response(text=METRICS.render(),
+                            content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# Exporters started so far, the file writing task and the server's runner
+_exporters = {}
+
+
+async def start_exporters():
+    """
+    Start the exporters configured through environment variables.
+
+    Exporters already running are left alone, so frontends can call this
+    whenever they (re)connect, i.e. from discord's on_ready.
+    """
+    metrics_file = os.environ.get("TANGYBOT_METRICS_FILE")
+    metrics_port = os.environ.get("TANGYBOT_METRICS_PORT")
+    writer = _exporters.get('file')
+    if metrics_file and (writer is None or writer.done()):
+        _exporters['file'] = asyncio.ensure_future(
+            write_periodically(metrics_file))
+    if metrics_port and 'port' not in _exporters:
+        _exporters['port'] = await serve(int(metrics_port))
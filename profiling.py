@@ -0,0 +1,189 @@
+"""
+Opt-in sampled profiling of TangyBot commands.
+
+Profiling is off unless TANGYBOT_PROFILE_DIR is set. When it is, commands
+are profiled under cProfile and dumped to that directory as pstats files
+(readable by snakeviz, flameprof, gprof2dot, ...) next to a json file with
+the command's args and timings. The following variables tune it:
+
+    TANGYBOT_PROFILE_EVERY          profile 1 in N commands (default 20)
+    TANGYBOT_PROFILE_THRESHOLD_MS   instead keep every command slower than
+                                    this, profiling whenever possible
+    TANGYBOT_PROFILE_KEEP           number of dumps to keep (default 100)
+
+cProfile sees everything running on the event loop while it is enabled, so
+a profile also contains the other commands that were running concurrently;
+the json file records how many tasks that was. Only one command is profiled
+at a time. Commands that could not be profiled but exceed the threshold
+still get a json dump with their timings.
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import itertools
+import json
+import os
+import time
+
+# Stages of a command, in the order they run
+STAGES = ("backend", "format")
+
+# Trace of the stage being profiled in this context, if any
+_current_trace = contextvars.ContextVar("tangybot_trace", default=None)
+
+# Trace of the last stage that finished in this context, so the formatting
+# of a command follows the sampling decision made for its backend dispatch
+_last_trace = contextvars.ContextVar("tangybot_last_trace", default=None)
+
+
+def _follows(previous, stage):
+    """Whether stage comes after the previous one in STAGES."""
+    if previous not in STAGES or stage not in STAGES:
+        return False
+    return STAGES.index(stage) > STAGES.index(previous)
+
+
+def _running_tasks():
+    """Count the asyncio tasks alive on the running loop, if any."""
+    import asyncio
+    try:
+        return len(asyncio.all_tasks())
+    except RuntimeError:
+        return 0
+
+
+class CommandProfiler:
+    """
+    Sampling cProfile hook for command stages.
+
+    Attributes
+    ----------
+    dump_dir: str
+        Directory to write dumps to
+
+    sample_every: int
+        Profile 1 in sample_every commands, 0 to rely on threshold only
+
+    threshold: float or None
+        Keep dumps of stages slower than this many seconds
+
+    max_dumps: int
+        Number of dumps to keep before deleting the oldest
+
+    """
+
+    def __init__(self, dump_dir, sample_every=20, threshold=None,
+                 max_dumps=100):
+        self.dump_dir = dump_dir
+        self.sample_every = sample_every
+        self.threshold = threshold
+        self.max_dumps = max_dumps
+        self._counter = itertools.count()
+        self._active = False
+        os.makedirs(dump_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        """Create a profiler from environment variables, or None."""
+        dump_dir = os.environ.get("TANGYBOT_PROFILE_DIR")
+        if not dump_dir:
+            return None
+        threshold_ms = os.environ.get("TANGYBOT_PROFILE_THRESHOLD_MS")
+        return cls(dump_dir,
+                   sample_every=int(os.environ.get(
+                       "TANGYBOT_PROFILE_EVERY", 0 if threshold_ms else 20)),
+                   threshold=(float(threshold_ms) / 1000 if threshold_ms
+                              else None),
+                   max_dumps=int(os.environ.get("TANGYBOT_PROFILE_KEEP",
+                                                100)))
+
+    def _wants_profile(self, seq):
+        if self._active:
+            return False
+        if self.threshold is not None:
+            return True
+        return self.sample_every > 0 and seq % self.sample_every == 0
+
+    @contextlib.contextmanager
+    def trace(self, stage, command, args=None, username=None):
+        """
+        Profile a stage of a command if it is sampled.
+
+        Parameters
+        ----------
+        stage: str
+            Name of the stage, i.e. "backend" or "format"
+
+        command: str
+            The command being run
+
+        args: dict or None
+            Arguments of the command, recorded in the dump
+
+        username: str or None
+            The user running the command, recorded in the dump
+
+        """
+        # A stage run inside another one follows it like one run after it
+        previous = _current_trace.get() or _last_trace.get()
+        if previous is not None and previous["command"] == command and \
+                _follows(previous["stage"], stage):
+            # Later stage of a command we already made a decision for
+            seq = previous["seq"]
+            sampled = previous["sampled"] and not self._active
+        else:
+            seq = next(self._counter)
+            sampled = self._wants_profile(seq)
+        # A decision is only followed by the very next stage
+        _last_trace.set(None)
+        current = dict(seq=seq, stage=stage, command=command,
+                       sampled=sampled)
+        token = _current_trace.set(current)
+
+        profile = None
+        if sampled:
+            profile = cProfile.Profile()
+            self._active = True
+            profile.enable()
+        tasks = _running_tasks()
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            _current_trace.reset(token)
+            _last_trace.set(current)
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - start_cpu
+            if profile is not None:
+                profile.disable()
+                self._active = False
+            slow = self.threshold is not None and wall >= self.threshold
+            if (sampled and self.threshold is None) or slow:
+                self._dump(seq, stage, command, profile,
+                           dict(command=command, stage=stage, args=args,
+                                username=username, wall_seconds=wall,
+                                cpu_seconds=cpu, tasks_at_start=tasks,
+                                reason="threshold" if slow else "sampled",
+                                time=time.time()))
+
+    def _dump(self, seq, stage, command, profile, info):
+        """Write one dump and rotate out the oldest ones."""
+        base = os.path.join(self.dump_dir, "{}-{:06d}-{}-{}".format(
+            time.strftime("%Y%m%d-%H%M%S"), seq, command, stage))
+        if profile is not None:
+            profile.dump_stats(base + ".prof")
+            info["profile"] = os.path.basename(base + ".prof")
+        with open(base + ".json", "w") as out:
+            json.dump(info, out, indent=1, default=str)
+        self._rotate()
+
+    def _rotate(self):
+        dumps = sorted(name for name in os.listdir(self.dump_dir)
+                       if name.endswith(".json"))
+        for name in dumps[:max(0, len(dumps) - self.max_dumps)]:
+            base = os.path.join(self.dump_dir, name[:-len(".json")])
+            for suffix in (".json", ".prof"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(base + suffix)
@@ -0,0 +1,202 @@
+"""
+Background refresh of the cache entries TangyBot's users need next.
+
+Cache entries are otherwise only fetched again once somebody asks for them
+after they expired, so the first lookup of a team on match day pays for
+scraping CSL and querying OpenDota. The refresher remembers the rosters,
+account info and hero aggregates commands used (starting with every user's
+last and other team and players), and fetches those requested within the
+last TANGYBOT_REFRESH_WINDOW seconds (default 3600) again once they are
+less than TANGYBOT_REFRESH_LEAD seconds (default 120) from expiring, or
+already gone. Entries another process sharing the cache (see
+shared_cache.py) fetched again meanwhile are taken from it instead.
+
+It refreshes one entry at a time, only while no command has run for
+QUIET_PERIOD seconds, and at most TANGYBOT_REFRESH_BUDGET upstream requests
+per minute (default 30, 0 turns it off), so it never competes with
+interactive traffic. Budget left unused while commands run is not saved
+up for later.
+"""
+
+import asyncio
+import collections
+import os
+import time
+
+import deadlines
+from circuit_breaker import CircuitOpenError
+from metrics import BACKGROUND_REFRESHES
+
+DEFAULT_BUDGET = 30
+DEFAULT_LEAD = 120
+DEFAULT_WINDOW = 3600
+
+# Seconds without commands before TangyBot counts as idle
+QUIET_PERIOD = 1.0
+
+# Seconds to leave an entry alone after refreshing it failed
+RETRY_DELAY = 60.0
+
+# Most entries remembered, the least recently requested are forgotten
+MAX_TRACKED = 1024
+
+# Hero aggregate window of players from sessions, profile's defaults
+SEED_HERO_WINDOW = (100, False)
+
+
+class Refresher:
+    """
+    Refreshes recently requested cache entries of a backend while idle.
+
+    Attributes
+    ----------
+    the_tangy: TangyBotBackend
+        The backend whose caches are refreshed
+
+    budget: float
+        Most upstream requests per minute
+
+    lead: float
+        Seconds before expiry an entry is refreshed
+
+    window: float
+        Seconds after its last request an entry is still refreshed
+
+    refreshed: int
+        Number of entries refreshed
+
+    failed: int
+        Number of refreshes that failed
+
+    """
+
+    def __init__(self, the_tangy, budget=DEFAULT_BUDGET, lead=DEFAULT_LEAD,
+                 window=DEFAULT_WINDOW):
+        self.the_tangy = the_tangy
+        self.budget = budget
+        self.lead = lead
+        self.window = window
+        self.refreshed = 0
+        self.failed = 0
+        # (cache name, key) -> when last requested, least recent first
+        self._requested = collections.OrderedDict()
+        self._retry_at = {}
+        self._task = None
+
+    @classmethod
+    def from_env(cls, the_tangy):
+        """Create a refresher from environment variables, or None."""
+        budget = float(os.environ.get("TANGYBOT_REFRESH_BUDGET",
+                                      DEFAULT_BUDGET))
+        if budget <= 0:
+            return None
+        return cls(the_tangy, budget,
+                   float(os.environ.get("TANGYBOT_REFRESH_LEAD",
+                                        DEFAULT_LEAD)),
+                   float(os.environ.get("TANGYBOT_REFRESH_WINDOW",
+                                        DEFAULT_WINDOW)))
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def __len__(self):
+        return len(self._requested)
+
+    def note(self, cache_name, key):
+        """Remember that a command requested the entry key of a cache."""
+        item = (cache_name, key)
+        self._requested[item] = time.time()
+        self._requested.move_to_end(item)
+        if len(self._requested) > MAX_TRACKED:
+            forgotten, _ = self._requested.popitem(last=False)
+            self._retry_at.pop(forgotten, None)
+
+    def seed(self, session_data):
+        """Remember the teams and players of every user's session."""
+        for session in session_data.values():
+            for slot in ("last", "other"):
+                team = session.get(slot + "_team")
+                if team is not None:
+                    self.note('roster', str(team))
+                for player in session.get(slot + "_players") or ():
+                    self.note('account', player)
+                    self.note('heroes', (player,) + SEED_HERO_WINDOW)
+
+    def start(self):
+        """Start refreshing on the running loop, call from inside it."""
+        if not self.running:
+            self.seed(self.the_tangy.persist.session_data)
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        """Stop refreshing."""
+        if self._task is not None:
+            self._task.cancel()
+
+    def idle(self):
+        """Whether no command is running or has just finished."""
+        return (self.the_tangy.commands_running == 0 and
+                time.monotonic() - self.the_tangy.last_command_at >=
+                QUIET_PERIOD)
+
+    def next_due(self, now=None):
+        """
+        Get the remembered entry that expires first, if it is due.
+
+        Forgets the entries not requested within the window along the way.
+
+        Returns
+        -------
+        item: tuple or None
+            (cache name, key) to refresh, None if nothing is due
+
+        """
+        now = time.time() if now is None else now
+        due = None
+        due_at = now + self.lead
+        for item, requested_at in list(self._requested.items()):
+            if now - requested_at > self.window:
+                del self._requested[item]
+                self._retry_at.pop(item, None)
+                continue
+            if self._retry_at.get(item, 0) > now:
+                continue
+            cache_name, key = item
+            # Entries evicted (or never fetched) are due right away
+            expires_at = self.the_tangy.caches[cache_name].expires_at(key)
+            expires_at = expires_at or 0
+            if expires_at <= due_at:
+                due, due_at = item, expires_at
+        return due
+
+    async def refresh(self, item):
+        """Fetch one entry again, True if it worked."""
+        cache_name, key = item
+        try:
+            # The command deadline also limits how long a refresh can hold
+            # a connection
+            with deadlines.deadline(self.the_tangy.deadline):
+                await self.the_tangy.refresh(cache_name, key)
+        except Exception as err:
+            self.failed += 1
+            self._retry_at[item] = time.time() + RETRY_DELAY
+            BACKGROUND_REFRESHES.inc(cache=cache_name, outcome="error")
+            # Open breakers are reported by the breakers themselves
+            if not isinstance(err, CircuitOpenError):
+                print("Refreshing", cache_name, key, "failed:", repr(err))
+            return False
+        self.refreshed += 1
+        self._retry_at.pop(item, None)
+        BACKGROUND_REFRESHES.inc(cache=cache_name, outcome="ok")
+        return True
+
+    async def _run(self):
+        interval = 60 / self.budget
+        while True:
+            await asyncio.sleep(interval)
+            if not self.idle():
+                continue
+            item = self.next_due()
+            if item is not None:
+                await self.refresh(item)
@@ -0,0 +1,219 @@
+"""
+REST API bindings for TangyBot.
+
+Every endpoint is a GET on /<command>, with the command's arguments passed
+as query parameters named after the long CLI options. Positional arguments
+use their CLI destination name, and list arguments are comma separated:
+
+    GET /lookup?team_number=839
+    GET /lookup?last=1
+    GET /profile?profiles=1234,5678&num_games=20&tourney_only=1
+    GET /draft?last=1&max_bans=3
+    GET /versus?teams=839,840
+    GET /meta?rank=legend&sort=winrate
+    GET /stalk?users=alice,bob
+
+The caller is identified for sessions by the X-TangyBot-User header,
+falling back to the user query parameter and then to "rest".
+
+GET /metrics serves the latency and cache metrics in Prometheus text format.
+
+Responses are the backend's response dicts as json, gzipped when the client
+accepts it. ETags are computed from the body, and Cache-Control max-age is
+the time until the first backend cache entry used by the command goes stale
+(no-cache for partial results, where players missed the deadline, and for
+stale ones answered while an upstream is down).
+"""
+
+import asyncio
+import hashlib
+import os
+import sys
+
+import aiohttp
+from aiohttp import web
+
+import loop_watchdog
+import metrics
+import util
+from backend import TangyBotBackend, TangyBotError
+from cache import track_freshness
+from cli import TangyBotArgParse, ArgumentParserError
+
+# Commands exposed over REST, mapped to their positional argument (if any)
+REST_COMMANDS = dict(lookup="team_number", profile="profiles",
+                     draft="team_number", stacks="team_number",
+                     versus="teams", meta=None, whoplays="hero",
+                     stalk="users")
+
+# Positional arguments that take a comma separated list
+LIST_ARGUMENTS = {"profiles", "teams", "users"}
+
+# Query values that switch on a store_true flag
+TRUE_VALUES = {"", "1", "true", "yes", "on"}
+
+DEFAULT_PORT = 8080
+
+
+def query_to_argv(command, query):
+    """
+    Convert a command and its query parameters to a TangyBot argv list.
+
+    Parameters
+    ----------
+    command: str
+        The command to run, one of REST_COMMANDS
+
+    query: Mapping, str -> str
+        Query parameters of the request
+
+    Returns
+    -------
+    argv: list of str
+        Arguments that TangyBotArgParse understands
+
+    """
+    positional_name = REST_COMMANDS[command]
+    argv = [command]
+    for key, value in query.items():
+        if key == "user":
+            continue
+        if key == positional_name:
+            if key in LIST_ARGUMENTS:
+                argv.extend(item for item in value.split(",") if item)
+            else:
+                argv.append(value)
+        elif key in ("last", "other", "tourney_only"):
+            if value.lower() in TRUE_VALUES:
+                argv.append("--" + key)
+        else:
+            argv.extend(["--" + key, value])
+    return argv
+
+
+class TangyBotRestServer:
+    """
+    aiohttp web application serving TangyBot commands as json.
+
+    Attributes
+    ----------
+    the_tangy: TangyBotBackend
+        The backend that answers the commands
+
+    arg_parse: TangyBotArgParse
+        Argument parsing for the query parameters
+
+    max_concurrency: int
+        Number of commands that may be dispatched at once
+
+    max_waiting: int
+        Number of requests that may queue for a slot before we return 503
+
+    app: web.Application
+        The aiohttp application to run
+
+    """
+
+    def __init__(self, the_tangy, max_concurrency=8, max_waiting=64):
+        self.the_tangy = the_tangy
+        self.arg_parse = TangyBotArgParse()
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", self.handle_metrics)
+        self.app.router.add_get("/{command}", self.handle_command)
+
+    async def handle_metrics(self, _):
+        """Respond with the metrics in Prometheus text format."""
+        return web.Response(text=metrics.METRICS.render(),
+                            content_type="text/plain")
+
+    async def handle_command(self, request):
+        """Run the requested command and respond with its json result."""
+        command = request.match_info["command"]
+        if command not in REST_COMMANDS:
+            return self._error(404, "Unknown command " + command)
+
+        try:
+            args = self.arg_parse.parse_args(query_to_argv(command,
+                                                           request.query))
+        except ArgumentParserError:
+            return self._error(400, self.arg_parse.get_strings_reset())
+
+        username = (request.headers.get("X-TangyBot-User") or
+                    request.query.get("user") or "rest")
+
+        if self._waiting >= self.max_waiting:
+            return self._error(503, "TangyBot is busy, try again later",
+                               headers={"Retry-After": "1"})
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            with metrics.FRONTEND_LATENCY.time(frontend="rest",
+                                               command=command), \
+                    track_freshness() as fresh:
+                api_resp = await self.the_tangy.dispatch(args, username)
+                body = util.to_json(api_resp).encode("utf-8")
+        except TangyBotError as err:
+            return self._error(400, str(err))
+        finally:
+            self._slots.release()
+
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        max_age = fresh.max_age()
+        if any('roster_age' in team or
+               any('status' in player or 'stale_age' in player
+                   for player in team.get('players', {}).values())
+               for team in [api_resp] + api_resp.get('teams', [])):
+            # Partial or stale results, may be complete and fresh next time
+            max_age = 0
+        headers = {
+            "ETag": etag,
+            "Cache-Control": ("max-age=" + str(max_age) if max_age else
+                              "no-cache")
+        }
+        if etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+
+        response = web.Response(body=body, content_type="application/json",
+                                headers=headers)
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response.enable_compression(web.ContentCoding.gzip)
+        return response
+
+    @staticmethod
+    def _error(status, message, headers=None):
+        """Build a json error response."""
+        return web.Response(status=status, headers=headers,
+                            content_type="application/json",
+                            text=util.to_json(dict(error=message)))
+
+
+async def main(backend, port):
+    """Run the REST frontend until interrupted."""
+    async with aiohttp.ClientSession() as session:
+        the_tangy = TangyBotBackend(backend=backend, session=session)
+        server = TangyBotRestServer(the_tangy)
+        runner = web.AppRunner(server.app)
+        await runner.setup()
+        await web.TCPSite(runner, port=port).start()
+        loop_watchdog.start_from_env()
+        the_tangy.start_refresher()
+        print("TangyBot REST API listening on port", port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            await the_tangy.close()
+
+
+if __name__ == "__main__":
+    rest_port = int(os.environ.get("PORT", DEFAULT_PORT))
+    asyncio.run(main(sys.argv[1] if len(sys.argv) == 2 else "file",
+                     rest_port))
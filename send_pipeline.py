@@ -0,0 +1,264 @@
+"""
+Ordered, packed message sending for chat frontends.
+
+Discord limits message content to 2000 characters (plus 2048 in an embed
+description) and rate limits each channel, so every extra message a command
+sends costs a round trip and eats into the channel's budget. SendPipeline
+packs command output into as few messages as the limits allow, keeps
+messages to a channel in order, and sends to different channels in
+parallel. Output queued for a channel while it is busy is packed together
+with the output ahead of it when both answer the same author, so one
+user's reply is never split by another user's.
+"""
+
+import asyncio
+import time
+
+from metrics import MESSAGES_PER_COMMAND, SEND_LATENCY
+
+# Discord's limits on message content and embed description length
+CONTENT_LIMIT = 2000
+EMBED_LIMIT = 2048
+
+CODE_FENCE = "```"
+
+
+def split_oversize(string, limit):
+    """
+    Split a string longer than limit at line breaks.
+
+    Code blocks that span a split are closed at the end of one piece and
+    reopened, with the same language, at the start of the next. Lines that
+    are too long on their own are cut.
+    """
+    if len(string) <= limit:
+        return [string]
+
+    closing = "\n" + CODE_FENCE
+    pieces = []
+    current = []
+    current_len = 0
+    # Opening line of the code block we are in, if any
+    fence = None
+    for line in string.split("\n"):
+        overhead = len(fence) + 1 + len(closing) if fence else 0
+        step = max(1, limit - overhead)
+        for chunk in [line[start:start + step] for start in
+                      range(0, max(1, len(line)), step)]:
+            sep = 1 if current else 0
+            reserve = len(closing) if fence else 0
+            if current and current_len + sep + len(chunk) + reserve > limit:
+                pieces.append("\n".join(current) +
+                              (closing if fence else ""))
+                current = [fence] if fence else []
+                current_len = len(fence) if fence else 0
+                sep = 1 if current else 0
+            current.append(chunk)
+            current_len += sep + len(chunk)
+        if line.startswith(CODE_FENCE):
+            fence = None if fence else line
+    pieces.append("\n".join(current))
+    return pieces
+
+
+def pack_messages(tagged_strings, content_limit=CONTENT_LIMIT, embed_limit=0):
+    """
+    Pack strings, in order, into as few messages as possible.
+
+    Greedy packing is optimal here, since strings may not be reordered.
+
+    Parameters
+    ----------
+    tagged_strings: list of (tag, str)
+        The strings to send, tagged with whatever they belong to
+
+    content_limit: int
+        Maximum characters in a message's content
+
+    embed_limit: int
+        Maximum characters in a message's embed description
+        If 0, embeds are not used
+
+    Returns
+    -------
+    messages: list of (str, str or None, set)
+        Content, embed description and the tags of the strings in each
+        message
+
+    """
+    pieces = []
+    for tag, string in tagged_strings:
+        for piece in split_oversize(string, content_limit):
+            pieces.append((tag, piece))
+
+    messages = []
+    slots = [content_limit] + ([embed_limit] if embed_limit else [])
+    parts = [[] for _ in slots]
+    lengths = [0 for _ in slots]
+    slot = 0
+    tags = set()
+    for tag, piece in pieces:
+        while True:
+            extra = len(piece) + (1 if parts[slot] else 0)
+            if lengths[slot] + extra <= slots[slot]:
+                parts[slot].append(piece)
+                lengths[slot] += extra
+                tags.add(tag)
+                break
+            elif slot + 1 < len(slots) and len(piece) <= slots[slot + 1]:
+                slot += 1
+            else:
+                messages.append(_message(parts, tags))
+                parts = [[] for _ in slots]
+                lengths = [0 for _ in slots]
+                slot = 0
+                tags = set()
+    if tags:
+        messages.append(_message(parts, tags))
+    return messages
+
+
+def _message(parts, tags):
+    content = "\n".join(parts[0])
+    embed = "\n".join(parts[1]) if len(parts) > 1 and parts[1] else None
+    return content, embed, tags
+
+
+def author_runs(batches):
+    """Split deliveries into runs of consecutive ones by one author."""
+    runs = []
+    for batch in batches:
+        if runs and batch.author is not None and \
+                runs[-1][-1].author == batch.author:
+            runs[-1].append(batch)
+        else:
+            runs.append([batch])
+    return runs
+
+
+class Delivery:
+    """
+    Output of one command and how it was sent.
+
+    Attributes
+    ----------
+    strings: list of str
+        The strings to send
+
+    command: str
+        The command that produced them
+
+    author: any
+        Who the strings answer, None if nobody in particular
+
+    messages: int
+        Number of messages the strings were (partly) sent in
+
+    queued, first_sent, last_sent: float or None
+        perf_counter timestamps of queueing and of the first and last
+        message containing these strings being sent
+
+    """
+
+    def __init__(self, strings, command, author=None):
+        self.strings = strings
+        self.command = command
+        self.author = author
+        self.messages = 0
+        self.queued = time.perf_counter()
+        self.first_sent = None
+        self.last_sent = None
+        self.done = asyncio.get_event_loop().create_future()
+
+
+class SendPipeline:
+    """
+    Per-channel ordered sender that packs output into few messages.
+
+    Attributes
+    ----------
+    send_func: coroutine function (channel, content, embed) -> None
+        Sends one message; embed is None or an embed description
+
+    frontend: str
+        Name of the frontend, for metrics
+
+    content_limit: int
+        Maximum characters per message content
+
+    embed_limit: int
+        Maximum characters per embed description, 0 to not use embeds
+
+    """
+
+    def __init__(self, send_func, frontend="discord",
+                 content_limit=CONTENT_LIMIT, embed_limit=0):
+        self.send_func = send_func
+        self.frontend = frontend
+        self.content_limit = content_limit
+        self.embed_limit = embed_limit
+        self._queues = {}
+
+    async def send(self, channel, strings, command="reply", author=None):
+        """
+        Send strings to channel after everything queued before them.
+
+        Strings are only packed into the same messages as those of the
+        same author, and never with those of no author.
+
+        Returns the Delivery once the strings have been sent, or None if
+        there was nothing to send; raises if sending failed.
+        """
+        if not strings:
+            return None
+        batch = Delivery(strings, command, author)
+        key = getattr(channel, "id", channel)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = []
+            asyncio.ensure_future(self._drain(key, channel, queue))
+        queue.append(batch)
+        await batch.done
+        return batch
+
+    async def _drain(self, key, channel, queue):
+        """Send everything queued for a channel, then retire."""
+        try:
+            while queue:
+                batches = queue[:]
+                del queue[:]
+                for run in author_runs(batches):
+                    await self._send_batches(channel, run)
+        finally:
+            del self._queues[key]
+
+    async def _send_batches(self, channel, batches):
+        messages = pack_messages(
+            [(index, string) for index, batch in enumerate(batches)
+             for string in batch.strings],
+            self.content_limit, self.embed_limit)
+        remaining = [sum(index in tags for _, _, tags in messages)
+                     for index in range(len(batches))]
+        try:
+            for content, embed, tags in messages:
+                await self.send_func(channel, content, embed)
+                now = time.perf_counter()
+                for index in tags:
+                    batch = batches[index]
+                    batch.messages += 1
+                    batch.first_sent = batch.first_sent or now
+                    batch.last_sent = now
+                    remaining[index] -= 1
+                    if not remaining[index]:
+                        self._finish(batch)
+        except Exception as err:
+            for batch in batches:
+                if not batch.done.done():
+                    batch.done.set_exception(err)
+
+    def _finish(self, batch):
+        MESSAGES_PER_COMMAND.observe(batch.messages, frontend=self.frontend,
+                                     command=batch.command)
+        SEND_LATENCY.observe(batch.last_sent - batch.queued,
+                             frontend=self.frontend)
+        batch.done.set_result(None)
@@ -0,0 +1,206 @@
+"""
+Cache tier shared by every TangyBot process on a host.
+
+The Discord bot, the CLI daemon and the REST frontend each have their own
+backend caches, so without this each of them queries CSL and OpenDota for
+the same teams and players. Point TANGYBOT_SHARED_CACHE at a file (unset
+by default, which keeps caches per process) and every backend on the host
+writes its cache entries and the hero table through to one SQLite database
+in WAL mode, and looks there before fetching anything itself: a player
+fetched by one process is a hit for all of them.
+
+Entries keep the expiry of the process that fetched them. A write only
+replaces an entry fetched earlier, in a single statement, so concurrent
+writers never leave an older value in place of a newer one. WAL lets
+readers go on while a process writes, and entries stay
+TANGYBOT_SHARED_CACHE_KEEP seconds (default a day) past their expiry as
+stale fallbacks for when an upstream is down.
+
+The database is only ever touched from a thread of its own, so waiting
+for another process's write never holds up the event loop: reads are
+awaited, writes are queued and not waited for.
+
+Values are pickles, like snapshots: only share a file with TangyBot
+processes you run yourself.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import pickle
+import sqlite3
+import time
+
+DEFAULT_KEEP = 24 * 60 * 60
+
+# Seconds to wait for another process's write to finish
+BUSY_TIMEOUT = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    cache TEXT NOT NULL,
+    key TEXT NOT NULL,
+    stored_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (cache, key)
+)
+"""
+
+UPSERT = """
+INSERT INTO entries (cache, key, stored_at, expires_at, value)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (cache, key) DO UPDATE SET
+    stored_at = excluded.stored_at,
+    expires_at = excluded.expires_at,
+    value = excluded.value
+WHERE excluded.stored_at >= entries.stored_at
+"""
+
+
+def _key_text(key):
+    """Text of a cache key, the same in every process."""
+    # Keys are strings, ints and tuples of those and bools
+    return repr(key)
+
+
+class SharedCache:
+    """
+    Cache entries in an SQLite database every local process uses.
+
+    Errors of the database are printed and otherwise treated as misses, so
+    a locked or broken file only costs the sharing. So are values that no
+    longer unpickle, whose entries are dropped.
+
+    Attributes
+    ----------
+    path: str
+        The database file
+
+    keep: float
+        Seconds expired entries are kept as stale fallbacks
+
+    """
+
+    def __init__(self, path, keep=DEFAULT_KEEP):
+        self.path = path
+        self.keep = keep
+        self._db = None
+        # Every query runs in order on this thread, off the event loop
+        self._thread = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="tangybot-shared-cache")
+        try:
+            # Once, before the backend serves anything
+            self._thread.submit(self._open).result()
+        except Exception:
+            self._thread.shutdown()
+            raise
+        self._thread.submit(self._prune)
+
+    def _open(self):
+        # Autocommit, every statement is its own transaction
+        self._db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Losing the last writes to a power cut only costs refetching
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(SCHEMA)
+
+    @classmethod
+    def from_env(cls):
+        """Open TANGYBOT_SHARED_CACHE if set, None if unset or unusable."""
+        path = os.environ.get("TANGYBOT_SHARED_CACHE")
+        if not path:
+            return None
+        keep = float(os.environ.get("TANGYBOT_SHARED_CACHE_KEEP",
+                                    DEFAULT_KEEP))
+        try:
+            return cls(path, keep)
+        except sqlite3.Error as err:
+            print("Not sharing caches through", path + ":", repr(err))
+            return None
+
+    async def get(self, cache_name, key):
+        """
+        Get the entry of key in a cache, however old.
+
+        Returns
+        -------
+        entry: tuple or None
+            (stored_at, expires_at, value), None if there is none
+
+        """
+        return await asyncio.wrap_future(
+            self._thread.submit(self._get, cache_name, _key_text(key)))
+
+    def put(self, cache_name, key, stored_at, expires_at, value):
+        """
+        Queue an entry to be stored, unless the one stored is newer.
+
+        Returns
+        -------
+        write: concurrent.futures.Future
+            Done once the entry is written (or failed to be)
+
+        """
+        # Pickled now, the value may change once handed back
+        return self._thread.submit(self._put, cache_name, _key_text(key),
+                                   stored_at, expires_at,
+                                   pickle.dumps(value))
+
+    async def prune(self):
+        """Drop the entries expired more than keep seconds ago."""
+        return await asyncio.wrap_future(self._thread.submit(self._prune))
+
+    async def close(self):
+        """Finish the writes queued so far and close the database."""
+        await asyncio.wrap_future(self._thread.submit(self._db.close))
+        self._thread.shutdown()
+
+    def _get(self, cache_name, key_text):
+        try:
+            row = self._db.execute(
+                "SELECT stored_at, expires_at, value FROM entries "
+                "WHERE cache = ? AND key = ?",
+                (cache_name, key_text)).fetchone()
+        except sqlite3.Error as err:
+            print("Shared cache read failed:", repr(err))
+            return None
+        if row is None:
+            return None
+        try:
+            return row[0], row[1], pickle.loads(row[2])
+        except Exception as err:
+            # Values another version of TangyBot pickled fail in all sorts
+            # of ways, i.e. AttributeError, ImportError or UnpicklingError
+            print("Dropping shared cache entry", cache_name, key_text + ":",
+                  repr(err))
+            self._delete(cache_name, key_text, row[0])
+            return None
+
+    def _put(self, cache_name, key_text, stored_at, expires_at, pickled):
+        try:
+            self._db.execute(UPSERT, (cache_name, key_text, stored_at,
+                                      expires_at, pickled))
+        except sqlite3.Error as err:
+            print("Shared cache write failed:", repr(err))
+
+    def _delete(self, cache_name, key_text, stored_at):
+        try:
+            # Unless another process replaced it meanwhile
+            self._db.execute(
+                "DELETE FROM entries "
+                "WHERE cache = ? AND key = ? AND stored_at = ?",
+                (cache_name, key_text, stored_at))
+        except sqlite3.Error as err:
+            print("Shared cache delete failed:", repr(err))
+
+    def _prune(self):
+        try:
+            return self._db.execute(
+                "DELETE FROM entries WHERE expires_at < ?",
+                (time.time() - self.keep,)).rowcount
+        except sqlite3.Error as err:
+            print("Shared cache prune failed:", repr(err))
+            return 0
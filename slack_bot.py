@@ -1,112 +1,293 @@
-"""Slack bindings for TangyBot (rip)."""
+"""
+Slack bindings for TangyBot.
+
+Connects to Slack's Real Time Messaging API over a websocket and handles
+every message tagging the bot as soon as it arrives, through the same
+TangyBotArgParse, TangyBotBackend and FrontendFormatter as the Discord bot.
+Pass in an existing backend to share its caches and connection pool, which
+is how discord_bot.py serves Slack from the same process.
+
+Slack users are known to the backend as slack:<user id>, and tagging a user
+(i.e. @TangyBot stalk @someone) refers to their session.
+"""
+
+import asyncio
+import html
+import itertools
 import os
-import time
-
-from slackclient import SlackClient
-
-
-class CSL_Lookup_Bot(object):
-    def __init__(self, bot_token):
-        self.slack_client = SlackClient(bot_token)
-        self.app_name = "tangy_bot"
-
-    def slack_connect(self):
-        success = self.slack_client.rtm_connect()
-        print("Connection status:", success)
-        return
-
-    def slack_read_rtm(self):
-        return self.slack_client.rtm_read()
-
-    def parse_slack_input(self, input, botID):
-        if input == []:
-            return None
-        bot_at_ID = "<@" + botID + ">"
-        if input and len(input) > 0:
-            input = input[0]
-            if 'text' in input:
-                if bot_at_ID in input['text']:
-                    print("bot was tagged in message")
-                    user = input['user']
-                    message = input['text'].split(bot_at_ID)[1].strip(" ")
-                    channel = input["channel"]
-                    print("user:", user, "Message:", message, "channel:",
-                          channel)
-                    print("MESSAGE WAS GOT:", str(message), "ON ",
-                          str(channel))
-                    return [str(user), str(message), str(channel)]
-        else:
-            return None
-
-    def get_bot_id(self, botname):
-        # call slack api
-        api_call = self.slack_client.api_call("users.list")
-        users = api_call["members"]
-        for user in users:
-            if "name" in user and botname in user.get('name') and not user.get(
-                    "deleted"):
-                return user.get("id")
-
-    def write_to_slack(self, channel, message):
-        print("Writing to slack")
-        return self.slack_client.api_call("chat.postMessage", channel=channel,
-                                          text=message, as_user=True)
-
-    def decide_to_take_action(self, message):
-        print("Deciding Whether To Take Action")
-        message = message.lower()
-        if "help" in message:
-            return 1
-        if "lookup" in message:
-            return 2
-
-        return 0
-
-    def handle_help_message(self, channel):
-        message = "How to Use: @tangy_bot lookup <team_url or team id> \n"
-        self.write_to_slack(channel, message)
-
-    def handle_lookup_message(self, message, channel):
-        message = message.split(" ")
-        team_id = message[1]
-        team_id = team_id.strip(">")
-        if "http" in team_id:
-            team_id = team_id[team_id.rfind("/") + 1:]
-        print(team_id)
-        return_messages = look_up_team(team_id)
-        for return_message in return_messages:
-            if return_message == "":
-                return_message = "404 error"
-            self.write_to_slack(channel, return_message)
-
-    def run(self):
-        self.slack_connect()
-        my_name = self.app_name
-        my_id = self.get_bot_id(my_name)
-        print("My id is", my_id)
+import re
+import shlex
+import sys
+import traceback
+
+import aiohttp
+
+import loop_watchdog
+import metrics
+from backend import TangyBotBackend, TangyBotError
+from cli import TangyBotArgParse, ArgumentParserError
+from frontend import FrontendFormatter
+from send_pipeline import SendPipeline
+
+SLACK_API = "https://slack.com/api/"
+
+# Slack truncates messages longer than this
+SLACK_MESSAGE_LIMIT = 4000
+
+# Seconds to wait before reconnecting, by number of failures in a row
+RECONNECT_DELAYS = (1, 2, 5, 10, 30)
+
+# Errors that reconnecting won't fix
+FATAL_ERRORS = ("invalid_auth", "not_authed", "account_inactive")
+
+# Slack markup of user mentions, <@U123> or <@U123|name>
+USER_MARKUP = re.compile(r"<@(\w+)(?:\|[^<>]*)?>")
+# Slack markup of links and channels, <http://url|label> or <#C123|name>
+LINK_MARKUP = re.compile(r"<([^<>|]+)(?:\|[^<>]*)?>")
+# Slack clients like to replace the quotes shlex needs
+SMART_QUOTES = str.maketrans({"\u201c": '"', "\u201d": '"',
+                              "\u2018": "'", "\u2019": "'"})
+
+
+class SlackApiError(Exception):
+    """A Slack Web API call did not succeed."""
+
+    def __init__(self, method, error):
+        super(SlackApiError, self).__init__(
+            "Slack " + method + " failed: " + str(error))
+        self.error = error
+
+
+def slack_username(user_id):
+    """Name a Slack user for TangyBotBackend sessions."""
+    return "slack:" + user_id
+
+
+def clean_message_text(text):
+    """Turn Slack's message markup back into what the user typed."""
+    text = USER_MARKUP.sub(lambda match: slack_username(match.group(1)), text)
+    text = LINK_MARKUP.sub(r"\1", text)
+    return html.unescape(text).translate(SMART_QUOTES)
+
+
+def escape_message_text(text):
+    """Escape the characters Slack reserves for markup."""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">",
+                                                                  "&gt;")
+
+
+class TangyBotSlackClient:
+    """
+    Event-driven Slack client for TangyBot.
+
+    Attributes
+    ----------
+    token: str
+        The Slack bot token
+
+    the_tangy: TangyBotBackend
+        The backend, possibly shared with other frontends
+
+    arg_parse: TangyBotArgParse
+        Argument parsing for the bot
+
+    frontend_format: FrontendFormatter
+        The formatter to use to make the response pretty
+
+    send_pipeline: SendPipeline
+        Packs responses into few messages and sends them in order per channel
+
+    user_id: str or None
+        The bot's own Slack user id, once connected
+
+    """
+
+    def __init__(self, token, the_tangy=None, backend="file"):
+        """
+        Parameters
+        ----------
+        token: str
+            The Slack bot token
+
+        the_tangy: TangyBotBackend or None
+            Backend to share, if None create one using backend
+
+        backend: str
+            Backend to create if the_tangy is None
+
+        """
+        self.token = token
+        self.the_tangy = the_tangy or TangyBotBackend(backend=backend)
+        self.arg_parse = TangyBotArgParse()
+        self.frontend_format = FrontendFormatter(
+            buffer=False, profiler=self.the_tangy.profiler)
+        self.send_pipeline = SendPipeline(
+            self.post_message, frontend="slack",
+            content_limit=SLACK_MESSAGE_LIMIT)
+        self.user_id = None
+        self._ws = None
+        self._event_ids = itertools.count(1)
+        # Keep references to running handlers, asyncio only keeps weak ones
+        self._handlers = set()
+
+    async def api_call(self, method, **params):
+        """
+        Call a Slack Web API method, waiting out rate limits.
+
+        Raises
+        ------
+        SlackApiError
+            If Slack says the call failed
+
+        """
+        headers = {"Authorization": "Bearer " + self.token}
+        while True:
+            async with self.the_tangy.session.post(SLACK_API + method,
+                                                   data=params,
+                                                   headers=headers) as req:
+                if req.status == 429:
+                    await asyncio.sleep(float(req.headers.get("Retry-After",
+                                                              1)))
+                    continue
+                req.raise_for_status()
+                resp = await req.json()
+            if not resp.get("ok"):
+                raise SlackApiError(method, resp.get("error"))
+            return resp
+
+    async def run(self):
+        """Handle events until cancelled, reconnecting when dropped."""
+        failures = 0
         while True:
-            result = self.parse_slack_input(self.slack_read_rtm(), my_id)
+            try:
+                await self._listen()
+                failures = 0
+            except SlackApiError as e:
+                if e.error in FATAL_ERRORS:
+                    raise
+                print(e)
+                failures += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print("Slack connection failed:", repr(e))
+                failures += 1
+            await asyncio.sleep(
+                RECONNECT_DELAYS[min(failures, len(RECONNECT_DELAYS) - 1)])
+
+    async def _listen(self):
+        """Connect to RTM and handle events until disconnected."""
+        rtm = await self.api_call("rtm.connect")
+        self.user_id = rtm["self"]["id"]
+        print("Slack connected as", rtm["self"]["name"], self.user_id)
+        async with self.the_tangy.session.ws_connect(rtm["url"],
+                                                     heartbeat=30) as ws:
+            self._ws = ws
+            try:
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    event = msg.json()
+                    if event.get("type") == "goodbye":
+                        break
+                    if event.get("type") == "message":
+                        self._spawn(self.on_message(event))
+            finally:
+                self._ws = None
+        print("Slack disconnected")
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._handlers.add(task)
+        task.add_done_callback(self._handler_done)
+
+    def _handler_done(self, task):
+        self._handlers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # Like discord.Client.on_error, report and keep going
+            print("Ignoring exception in Slack message handler",
+                  file=sys.stderr)
+            traceback.print_exception(type(task.exception()),
+                                      task.exception(),
+                                      task.exception().__traceback__)
+
+    async def on_message(self, event):
+        """Handle one message event."""
+        # Edits, joins, bot messages etc. come with a subtype
+        if event.get("subtype") or event.get("user") == self.user_id:
+            return
+        text = event.get("text", "")
+        channel = event["channel"]
+        author = event.get("user")
+
+        if text == "TangyBot":
+            await self.send_pipeline.send(channel, ["Present"],
+                                          author=author)
+        tag = "<@" + self.user_id + ">"
+        if tag not in text:
+            return
+        print("tagged")
+        read_message = clean_message_text(text.split(tag, 1)[1])
+        print(read_message)
+
+        await self.send_typing(channel)
+
+        try:
+            res = self.arg_parse.parse_args(shlex.split(read_message))
+
+            with metrics.FRONTEND_LATENCY.time(frontend="slack",
+                                               command=res.command):
+                api_resp = await self.the_tangy.dispatch(
+                    res, slack_username(event["user"]))
+                strings = self.frontend_format.dispatch(res.command, api_resp)
+                await self.send_pipeline.send(channel, strings, res.command,
+                                              author)
+
+        except ArgumentParserError:
+            await self.send_argparse_vals(channel, author)
+        except ValueError as e:
+            # shlex failed, i.e. on unbalanced quotes
+            await self.send_pipeline.send(channel,
+                                          ["```\n" + str(e) + "\n```"],
+                                          author=author)
+        except TangyBotError as e:
+            await self.send_pipeline.send(channel,
+                                          ["```\n" + str(e) + "\n```"],
+                                          author=author)
+
+    async def send_typing(self, channel):
+        """Show the typing indicator in a channel."""
+        if self._ws is not None and not self._ws.closed:
+            await self._ws.send_json(dict(id=next(self._event_ids),
+                                          type="typing", channel=channel))
+
+    async def post_message(self, channel, content, _=None):
+        """Post one message to a channel."""
+        await self.api_call("chat.postMessage", channel=channel,
+                            text=escape_message_text(content))
 
-            if result is not None:
-                user = result[0]
-                message = result[1]
-                channel = result[2]
-                print(user, message, channel)
-                proceed = self.decide_to_take_action(message)
-                if proceed > 0:
-                    if proceed == 1:
-                        self.handle_help_message(channel)
+    async def send_argparse_vals(self, channel, author=None):
+        """Send the argparse helper vals to Slack."""
+        await self.send_pipeline.send(channel,
+                                      ["```\n" +
+                                       self.arg_parse.get_strings() +
+                                       "\n```"], author=author)
 
-                    if proceed == 2:
-                        self.handle_lookup_message(message, channel)
 
-            time.sleep(1)
+async def main(backend, token):
+    """Run the Slack bot on its own."""
+    async with aiohttp.ClientSession() as session:
+        the_tangy = TangyBotBackend(backend=backend, session=session)
+        await metrics.start_exporters()
+        loop_watchdog.start_from_env()
+        the_tangy.start_refresher()
+        try:
+            await TangyBotSlackClient(token, the_tangy).run()
+        finally:
+            await the_tangy.close()
 
 
 if __name__ == "__main__":
-    # create instance of bot
-    # run bot
-    bot_token = os.environ.get("BOT_TOKEN")
-    print(bot_token)
-    bot_instance = CSL_Lookup_Bot(bot_token)
-    bot_instance.run()
+    # BOT_TOKEN is what the old slackclient bot used
+    slack_token = (os.environ.get("SLACK_BOT_TOKEN") or
+                   os.environ.get("BOT_TOKEN"))
+    asyncio.run(main(sys.argv[1] if len(sys.argv) == 2 else "aws",
+                     slack_token))
@@ -0,0 +1,242 @@
+"""
+Snapshots of TangyBot's persistent data and warm caches.
+
+A snapshot bundles the persistent data (profiles and sessions), the backend
+caches (rosters, account info, hero aggregates), the hero table, the
+league statistics and the match history of stacks and profile windows
+into a single versioned, gzipped pickle. Point TANGYBOT_SNAPSHOT at one
+and the backend loads it when it starts, so a fresh dyno starts warm
+instead of querying every upstream again:
+
+    $ python3 snapshot.py export snapshot.pkl.gzip --teams 839 840
+    $ python3 snapshot.py show snapshot.pkl.gzip
+    $ TANGYBOT_SNAPSHOT=snapshot.pkl.gzip python3 discord_bot.py
+
+Cache entries younger than TANGYBOT_SNAPSHOT_MAX_AGE seconds (default a
+day) are loaded with the time they were fetched: they expire when they
+would have, and expired ones still serve as stale fallbacks while an
+upstream is down. Older entries are dropped.
+Persistent data from a snapshot only fills in keys the backend doesn't
+already have, so the aws backend still scans DynamoDB at startup and
+newer data there always wins.
+
+Snapshots are pickles: only load ones you made yourself.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+import hero_data
+import util
+
+# Bump when the layout of the bundle changes
+SNAPSHOT_VERSION = 5
+
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+# Username the export warms caches as, left out of the snapshot
+WARM_USERNAME = "snapshot"
+
+
+def export_snapshot(the_tangy, path):
+    """
+    Write a snapshot of a backend to path.
+
+    Parameters
+    ----------
+    the_tangy: TangyBotBackend
+        The backend to snapshot
+
+    path: str
+        Where to write the snapshot
+
+    Returns
+    -------
+    counts: dict
+        Number of items written per part of the snapshot
+
+    """
+    persist = the_tangy.persist
+    bundle = dict(
+        version=SNAPSHOT_VERSION,
+        created=time.time(),
+        persist=dict(profile=dict(persist.profile_data),
+                     session={username: session for username, session in
+                              persist.session_data.items()
+                              if username != WARM_USERNAME}),
+        caches={name: list(cache.items())
+                for name, cache in the_tangy.caches.items()},
+        heroes=(the_tangy.hero_info.api_response()
+                if the_tangy.hero_info is not None else None),
+        league=(the_tangy.league.state()
+                if the_tangy.league is not None else {}),
+        matches=the_tangy.match_history.state())
+    util.save(bundle, path)
+    return _counts(bundle)
+
+
+def import_snapshot(the_tangy, path, max_age=DEFAULT_MAX_AGE):
+    """
+    Load a snapshot into a backend.
+
+    Parameters
+    ----------
+    the_tangy: TangyBotBackend
+        The backend to load into
+
+    path: str
+        The snapshot to load
+
+    max_age: float
+        Seconds after which snapshotted cache entries are left out
+
+    Raises
+    ------
+    ValueError
+        If the snapshot is from an incompatible version
+
+    Returns
+    -------
+    counts: dict
+        Number of items loaded per part of the snapshot
+
+    """
+    bundle = util.load(path)
+    if not isinstance(bundle, dict) or \
+            bundle.get('version') != SNAPSHOT_VERSION:
+        raise ValueError("Snapshot " + path + " is not a version " +
+                         str(SNAPSHOT_VERSION) + " snapshot")
+
+    counts = {}
+    for resource, data in bundle['persist'].items():
+        target = getattr(the_tangy.persist, resource + "_data")
+        missing = [key for key in data if key not in target]
+        for key in missing:
+            target[key] = data[key]
+        counts[resource] = len(missing)
+
+    now = time.time()
+    for name, entries in bundle['caches'].items():
+        cache = the_tangy.caches.get(name)
+        if cache is None:
+            continue
+        fresh = [(key, stored_at, value) for key, stored_at, value in entries
+                 if now - stored_at <= max_age and key not in cache]
+        for key, stored_at, value in fresh:
+            cache.put(key, value, stored_at=stored_at)
+        counts[name] = len(fresh)
+
+    if bundle['heroes'] is not None and the_tangy.hero_info is None:
+        the_tangy.hero_info = hero_data.HeroData(
+            api_hero_resp=bundle['heroes'])
+        counts['hero_table'] = len(the_tangy.hero_info.hero_info)
+
+    # The league statistics need the hero table for their indices
+    if bundle['league'] and the_tangy.get_league() is not None:
+        counts['league'] = the_tangy.league.load(bundle['league'])
+    # Only new matches are fetched on top of these, whatever their age
+    counts['matches'] = the_tangy.match_history.load(bundle['matches'])
+    return counts
+
+
+def import_from_env(the_tangy):
+    """Load TANGYBOT_SNAPSHOT into a backend if set, never raising."""
+    path = os.environ.get("TANGYBOT_SNAPSHOT")
+    if not path:
+        return
+    max_age = float(os.environ.get("TANGYBOT_SNAPSHOT_MAX_AGE",
+                                   DEFAULT_MAX_AGE))
+    try:
+        counts = import_snapshot(the_tangy, path, max_age)
+    except FileNotFoundError:
+        print("No snapshot at", path + ", starting cold")
+    except Exception as err:
+        # A bad snapshot only costs us a cold start
+        print("Ignoring snapshot", path + ":", repr(err))
+    else:
+        print("Loaded snapshot", path, counts)
+
+
+def _counts(bundle):
+    counts = {resource: len(data) for resource, data in
+              bundle['persist'].items()}
+    counts.update({name: len(entries) for name, entries in
+                   bundle['caches'].items()})
+    if bundle['heroes'] is not None:
+        counts['hero_table'] = len(bundle['heroes']['result']['heroes'])
+    counts['league'] = len(bundle['league'])
+    counts['matches'] = len(bundle['matches'])
+    return counts
+
+
+async def _warm(the_tangy, teams, parallel=4):
+    """Look up and profile teams so their data is in the caches."""
+    from cli import TangyBotArgParse
+
+    arg_parse = TangyBotArgParse()
+    slots = asyncio.Semaphore(parallel)
+
+    async def warm_team(team):
+        async with slots:
+            lookup = await the_tangy.dispatch(
+                arg_parse.parse_args(["lookup", str(team)]), WARM_USERNAME)
+            await the_tangy.dispatch(
+                arg_parse.parse_args(["profile"] +
+                                     [str(player) for player in
+                                      lookup['players']]), WARM_USERNAME)
+            print("Warmed team", team, lookup['team_name'])
+
+    results = await asyncio.gather(*(warm_team(team) for team in teams),
+                                   return_exceptions=True)
+    for team, result in zip(teams, results):
+        if isinstance(result, Exception):
+            print("Could not warm team", team + ":", repr(result))
+
+
+async def export_main(path, backend, teams):
+    """Warm a backend with teams, then export it to path."""
+    import aiohttp
+    from backend import TangyBotBackend
+
+    async with aiohttp.ClientSession() as session:
+        the_tangy = TangyBotBackend(backend=backend, session=session)
+        await the_tangy.warm_up()
+        await _warm(the_tangy, teams)
+        await the_tangy.persist.flush()
+        return export_snapshot(the_tangy, path)
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="snapshot.py",
+                                     description="Export or inspect "
+                                                 "TangyBot snapshots")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    export_parser = subparsers.add_parser(
+        "export", help="Write a snapshot, warming the given teams first")
+    export_parser.add_argument("path")
+    export_parser.add_argument("-b", "--backend", default="file",
+                               choices=("file", "aws"))
+    export_parser.add_argument("-t", "--teams", nargs="*", default=[],
+                               help="CSL teams to look up and profile (with "
+                                    "default arguments) before exporting")
+    show_parser = subparsers.add_parser("show", help="Summarize a snapshot")
+    show_parser.add_argument("path")
+    opts = parser.parse_args(argv)
+
+    if opts.action == "export":
+        counts = asyncio.run(export_main(opts.path, opts.backend, opts.teams))
+        print("Wrote snapshot", opts.path, counts)
+    else:
+        bundle = util.load(opts.path)
+        print("version", bundle.get('version'))
+        print("age {:.0f}s".format(time.time() - bundle['created']))
+        print("size {} bytes".format(os.path.getsize(opts.path)))
+        print(_counts(bundle))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,202 @@
+"""
+Recent matches of players, which of them queue together and what they play.
+
+The stacks command and profile --windows need players' recent matches from
+OpenDota. MatchHistory keeps them between commands, so asking again only
+fetches the days since the last fetch (OpenDota's date parameter) and
+merges them in. find_stacks groups the players by the matches they played
+on the same side, and hero_records counts their heroes over any number of
+their last matches, so one fetch serves every window of a profile.
+"""
+
+import collections
+import itertools
+import math
+import time
+
+from api_dispatch import HeroRecord
+
+# Seconds a player's matches are used without asking OpenDota for new ones
+MATCHES_TTL = 600
+
+# Largest group of players looked for, a full party
+MAX_STACK = 5
+
+
+class MatchHistory:
+    """
+    Recent matches of each player, merged fetch after fetch.
+
+    Matches are kept per key, (Steam32 ID, lobby only) in the backend, since
+    lobby matches are fetched separately.
+
+    Attributes
+    ----------
+    ttl: float
+        Seconds a player's matches are used without fetching new ones
+
+    """
+
+    def __init__(self, ttl=MATCHES_TTL):
+        self.ttl = ttl
+        # key -> (fetched_at, depth, matches newest first), depth being how
+        # many matches back the fetches went
+        self._players = {}
+
+    def __len__(self):
+        return len(self._players)
+
+    def plan(self, key, num_games, now=None):
+        """
+        What to fetch to know the last num_games matches of key.
+
+        Returns
+        -------
+        request: dict or None
+            matches_limit and days (None for any age) to fetch with, see
+            api_dispatch.get_account_matches_async, None if the matches
+            stored are recent enough
+
+        """
+        now = time.time() if now is None else now
+        entry = self._players.get(key)
+        if entry is None or entry[1] < num_games:
+            return dict(matches_limit=num_games, days=None)
+        age = now - entry[0]
+        if age < self.ttl:
+            return None
+        return dict(matches_limit=entry[1],
+                    days=max(1, math.ceil(age / 86400)))
+
+    def merge(self, key, matches, matches_limit, days, now=None):
+        """Store the matches a fetch following plan returned."""
+        now = time.time() if now is None else now
+        entry = self._players.get(key)
+        # With as many new matches as asked for, the old ones may not follow
+        # on from them
+        if entry is None or days is None or len(matches) >= matches_limit:
+            merged = sorted(matches, key=lambda match: match.start_time,
+                            reverse=True)
+        else:
+            by_id = {match.match_id: match for match in entry[2]}
+            by_id.update((match.match_id, match) for match in matches)
+            merged = sorted(by_id.values(),
+                            key=lambda match: match.start_time, reverse=True)
+        self._players[key] = (now, matches_limit,
+                              tuple(merged[:matches_limit]))
+
+    def recent(self, key, num_games):
+        """
+        Get the last num_games matches stored for key, however old.
+
+        Returns
+        -------
+        matches: tuple of MatchRecord or None
+            Newest first, None if they were never fetched
+
+        fetched_at: float or None
+            When they were last fetched
+
+        """
+        entry = self._players.get(key)
+        if entry is None:
+            return None, None
+        return entry[2][:num_games], entry[0]
+
+    def state(self):
+        """Get every key's matches, i.e. for a snapshot."""
+        return dict(self._players)
+
+    def load(self, state):
+        """Keep the matches of state for keys not stored yet."""
+        missing = [key for key in state if key not in self._players]
+        for key in missing:
+            self._players[key] = state[key]
+        return len(missing)
+
+
+def hero_records(matches):
+    """
+    Count a player's games and wins per hero over their matches.
+
+    Returns
+    -------
+    played_heroes: list of HeroRecord
+        Every hero played, most played first, as /players/{id}/heroes
+        counts the same matches
+
+    """
+    games = collections.Counter()
+    wins = collections.Counter()
+    for match in matches:
+        games[match.hero_id] += 1
+        wins[match.hero_id] += match.win
+    return [HeroRecord(hero_id, count, wins[hero_id])
+            for hero_id, count in games.most_common()]
+
+
+def find_stacks(matches_by_player, min_games=3):
+    """
+    Find the players who play together, from their recent matches.
+
+    Players are together in a match when they were on the same side of it.
+    Every match is keyed by (match_id, side) into a hash table of the
+    players in it, so this takes time linear in the matches fetched rather
+    than scanning the match lists of every pair of players.
+
+    Parameters
+    ----------
+    matches_by_player: dict, int -> iterable of MatchRecord
+        Steam32 ID -> the player's recent matches
+
+    min_games: int
+        Minimum number of matches together to report a group
+
+    Returns
+    -------
+    pairs: list of dict
+        players (a tuple of two Steam32 IDs), games and win of every pair
+        together in at least min_games matches, most games first, leaving
+        out those only ever seen as part of a bigger group
+
+    groups: list of dict
+        The same for groups of three or more players
+
+    """
+    sides = collections.defaultdict(list)
+    side_won = {}
+    for player, matches in matches_by_player.items():
+        for match in matches:
+            side = (match.match_id, match.radiant)
+            sides[side].append(player)
+            side_won[side] = match.win
+
+    games = collections.Counter()
+    wins = collections.Counter()
+    for side, players in sides.items():
+        if len(players) < 2:
+            continue
+        players.sort()
+        for size in range(2, min(len(players), MAX_STACK) + 1):
+            for group in itertools.combinations(players, size):
+                games[group] += 1
+                wins[group] += side_won[side]
+
+    frequent = {group: count for group, count in games.items()
+                if count >= min_games}
+    everyone = set(matches_by_player)
+
+    def inside_bigger(group):
+        # Counts only shrink as groups grow, so one player more is enough
+        return any(frequent.get(tuple(sorted(group + (player,)))) ==
+                   frequent[group] for player in everyone.difference(group))
+
+    pairs = []
+    groups = []
+    for group, count in sorted(frequent.items(),
+                               key=lambda item: (-item[1], -len(item[0]))):
+        if inside_bigger(group):
+            continue
+        stack = dict(players=group, games=count, win=wins[group])
+        (pairs if len(group) == 2 else groups).append(stack)
+    return pairs, groups
@@ -0,0 +1,238 @@
+"""
+Storage backends for TangyBot's persistent data.
+
+PersistentData keeps every resource ("profile" and "session") in memory and
+writes changed items through a StorageBackend, which only has to store and
+retrieve whole items by key:
+
+    load(resource)                  every item, read once at startup
+    get(resource, key)              one item, or None
+    put(resource, key, item)        create or replace one item
+    batch_put(resource, items)      put many items at once
+    flush()                         make everything put so far durable
+    close()                         release whatever the backend holds
+
+Backends are called from a single writer thread, never concurrently, and
+own the items handed to them. Pick one by name with create_storage, or pass
+an instance wherever a backend name is accepted. bench/storage_suite.py
+holds the conformance tests and benchmarks each backend must pass.
+"""
+
+import abc
+import os
+
+import util
+
+RESOURCES = ("profile", "session")
+
+# Mapping of resource to primary key values on aws
+RESOURCE_KEY_NAMES = dict(session="username", profile="steamid")
+
+# Names of the DynamoDB tables holding each resource
+DYNAMODB_TABLES = dict(session="TangyBot_Session", profile="TangyBot_Profile")
+
+
+class StorageBackend(abc.ABC):
+    """
+    Interface of the storages PersistentData writes through.
+
+    load, get and put are abstract, the rest build on them.
+
+    Attributes
+    ----------
+    name: str
+        Name of the backend, i.e. for metrics
+
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def load(self, resource):
+        """
+        Read every item of a resource.
+
+        Returns
+        -------
+        items: dict
+            Resource key -> item, a dict the caller may keep and change
+
+        """
+
+    @abc.abstractmethod
+    def get(self, resource, key):
+        """Read one item of a resource, None if there is none."""
+
+    @abc.abstractmethod
+    def put(self, resource, key, item):
+        """Create or replace one item of a resource."""
+
+    def batch_put(self, resource, items):
+        """
+        Create or replace many items of a resource.
+
+        Parameters
+        ----------
+        resource: str
+            The resource to write to
+
+        items: dict
+            Resource key -> item
+
+        """
+        for key, item in items.items():
+            self.put(resource, key, item)
+
+    def flush(self):
+        """Make every put so far durable."""
+        pass
+
+    def close(self):
+        """Flush and release the backend."""
+        self.flush()
+
+
+class FileStorage(StorageBackend):
+    """
+    Gzipped pickle file per resource, rewritten as a whole on flush.
+
+    Attributes
+    ----------
+    directory: str
+        Directory holding the <resource>.pkl.gzip files
+
+    """
+
+    name = "file"
+
+    def __init__(self, directory="."):
+        self.directory = directory
+        # resource -> the items as last put, what gets written
+        self._items = {}
+        self._dirty = set()
+
+    def _path(self, resource):
+        return os.path.join(self.directory, resource + '.pkl.gzip')
+
+    def _resource_items(self, resource):
+        if resource not in self._items:
+            try:
+                self._items[resource] = util.load(self._path(resource))
+            except FileNotFoundError:
+                self._items[resource] = {}
+        return self._items[resource]
+
+    def load(self, resource):
+        # Copies, our items must not change under the writer
+        return {key: dict(item) for key, item in
+                self._resource_items(resource).items()}
+
+    def get(self, resource, key):
+        item = self._resource_items(resource).get(key)
+        return dict(item) if item is not None else None
+
+    def put(self, resource, key, item):
+        self._resource_items(resource)[key] = item
+        self._dirty.add(resource)
+
+    def flush(self):
+        while self._dirty:
+            resource = self._dirty.pop()
+            path = self._path(resource)
+            # Replace the file in one go, never leave half of one behind
+            util.save(self._items[resource], path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+
+class DynamoStorage(StorageBackend):
+    """
+    DynamoDB table per resource, written item by item.
+
+    Attributes
+    ----------
+    tables: dict, str -> DynamoDB Table
+        The table holding each resource
+
+    """
+
+    name = "aws"
+
+    def __init__(self, tables=None, region_name='us-east-2'):
+        """
+        Parameters
+        ----------
+        tables: dict or None
+            Resource -> boto3 Table (or an imitation, see
+            bench/fake_dynamodb.py), if None the TangyBot tables on aws
+
+        region_name: str
+            Region of the TangyBot tables, if tables is None
+
+        """
+        if tables is None:
+            # Only the aws backend pays for importing boto3
+            import boto3
+
+            dynamodb = boto3.resource('dynamodb', region_name=region_name)
+            tables = {resource: dynamodb.Table(table_name) for
+                      resource, table_name in DYNAMODB_TABLES.items()}
+        self.tables = tables
+
+    def _from_item(self, resource, item):
+        # Even though numeric keys have the weird type Decimal('123') they
+        # still compare (and hash) fine when we try to access their values
+        return item.pop(RESOURCE_KEY_NAMES[resource]), item
+
+    def _to_item(self, resource, key, item):
+        # AWS wants the data in this format lol
+        aws_dict = dict(item)
+        aws_dict[RESOURCE_KEY_NAMES[resource]] = key
+        return aws_dict
+
+    def load(self, resource):
+        table = self.tables[resource]
+        items = {}
+        scan_kwargs = {}
+        # A scan returns at most 1MB, follow it through every page
+        while True:
+            resp = table.scan(**scan_kwargs)
+            for item in resp['Items']:
+                key, item = self._from_item(resource, item)
+                items[key] = item
+            if 'LastEvaluatedKey' not in resp:
+                return items
+            scan_kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    def get(self, resource, key):
+        resp = self.tables[resource].get_item(
+            Key={RESOURCE_KEY_NAMES[resource]: key})
+        if 'Item' not in resp:
+            return None
+        return self._from_item(resource, resp['Item'])[1]
+
+    def put(self, resource, key, item):
+        self.tables[resource].put_item(
+            Item=self._to_item(resource, key, item))
+
+    def batch_put(self, resource, items):
+        if len(items) == 1:
+            (key, item), = items.items()
+            self.put(resource, key, item)
+            return
+        # Up to 25 items per request, retrying unprocessed ones
+        with self.tables[resource].batch_writer() as batch:
+            for key, item in items.items():
+                batch.put_item(Item=self._to_item(resource, key, item))
+
+
+STORAGE_BACKENDS = dict(file=FileStorage, aws=DynamoStorage)
+
+
+def create_storage(name):
+    """Create the storage backend of the given name."""
+    try:
+        storage_class = STORAGE_BACKENDS[name]
+    except KeyError:
+        raise ValueError("Backend must be one of " +
+                         ", ".join(STORAGE_BACKENDS))
+    return storage_class()
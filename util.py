@@ -1,6 +1,8 @@
 """Random Utilities for TangyBot."""
 
+import decimal
 import gzip
+import json
 import pickle
 
 
@@ -16,3 +18,18 @@ def load(path):
     with gzip.open(path, 'rb') as pkl_file:
         obj = pickle.load(pkl_file)
     return obj
+
+
+def _json_default(obj):
+    """Convert the odd types backend responses contain for json."""
+    # DynamoDB hands numbers back as Decimal('123')
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError("Cannot serialize " + type(obj).__name__ + " to json")
+
+
+def to_json(obj):
+    """Serialize a backend response to a compact json string."""
+    return json.dumps(obj, default=_json_default, separators=(',', ':'))